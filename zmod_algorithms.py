@@ -1,10 +1,16 @@
 import networkx as nx
+import math
+import numpy as np
 import time
 import sys
 
 import zmod_costs
 import zmod_pairwise
 import zmod_epanet
+import zmod_shortest_paths
+import zmod_cache
+import zmod_greedy
+import zmod_reduction
 
 ########################################################################################################
 ########################################################################################################
@@ -12,34 +18,165 @@ import zmod_epanet
 ########################################################################################################
 ########################################################################################################
 
-def precompute_data_lb_algorithms(G):
+def precompute_data_lb_algorithms(G, backend="networkx", paths="lists", sources="all", origin=None, workers=1, cache_dir=None, max_memory_bytes=None, max_rows=1024, max_budget=None, reduce=False):
     """
     Given an initial city street graph with all the necessary information, precompute essential data for the LB algorithm.
     This improves A LOT the efficiency of the original LB algorithm of REWATnet, but also may require huge ammount of RAM memory in the system.
+    With backend "dense" the shortest path lengths are stored in a single float32 matrix (4 bytes per pair) instead of dicts,
+    and with paths "predecessors" the paths are not stored at all, only an int32 predecessor matrix (4 bytes per pair).
+    With sources "consumers" only the rows of the consumption nodes (and the origin) are computed, |C| x |V| instead of
+    |V| x |V|. The algorithms only ask for paths that end in a consumption node, which are answered from its row.
+    The result is the union of a topology layer (see 'precompute_topology') and a demand layer (see 'precompute_demand'),
+    so when only the consumptions change use 'refresh_demand' instead.
+    With backend "lazy" nothing is computed in advance: each row is solved the first time it is needed and kept in a
+    bounded LRU cache, which suits small budgets where the algorithms only touch a few rows.
+    With 'max_budget' only the pairs that a network within that budget can use are computed: a candidate path costs at
+    least get_min_costs_diameter() per meter, so the algorithms discard every path longer than
+    max_budget/get_min_costs_diameter() meters. Each Dijkstra stops at that distance and the rows only store the nodes
+    within it (see 'zmod_shortest_paths.SparseRows').
+    With 'reduce' everything is computed on the graph with the chains of degree 2 nodes without consumption contracted
+    (see 'zmod_reduction.contract_chains'), and the algorithms have to be called with 'reduce' too: they contract G the
+    same way, run on the reduced graph and expand the returned network back to the street segments.
         
     Args:
         G (nx undirected graph): initial city street graph with all the necessary information.
+        backend (string): "networkx" stores the lengths as dict of dicts, "dense" computes them with scipy over a CSR matrix
+            and stores them in a float32 matrix behind a 'MatrixTable' (still indexed as [u][v]). The path consumptions
+            are then accumulated over the predecessor trees in a matrix aligned with the distances. "lazy" solves the rows
+            on demand (see 'zmod_shortest_paths.LazyRows').
+        paths (string): "lists" stores every shortest path as a list, "predecessors" (only with backend "dense" or "lazy",
+            required by "lazy") stores the predecessor matrix behind a 'PathTable' that rebuilds each path when it is indexed.
+        sources (string): "all" computes the tables from every node, "consumers" (only with paths "predecessors") only from
+            the consumption nodes and the origin. Pairs where neither node is a source raise KeyError.
+        origin (int): Origin node of the reuse network graph, added to the sources if given.
+        workers (int): number of processes sharing the Dijkstra runs (only with backend "dense"). Each one writes its rows
+            straight into shared memory.
+        cache_dir (string): if given (only with backend "dense", other backends raise ValueError), the distance,
+            predecessor and consumption matrices are stored there as .npy files keyed by a hash of the node ids and edge
+            lengths (plus the consumptions for the path consumptions), and reopened as read only memory maps next time.
+            Any change gives a new key.
+        max_memory_bytes (int): if given, the storage is planned to fit this budget (see 'zmod_shortest_paths.plan_storage')
+            and overrides 'backend', 'paths' and 'sources': dense backend with predecessors and, by decreasing budget, every
+            row, the consumer rows only, or the consumer rows streamed in chunks to memory mapped files in 'cache_dir'
+            (a temporary directory if None, removed once the precomputed data is dropped). Pass the origin so that its
+            row is planned too.
+        max_rows (int): maximum number of rows kept in memory by backend "lazy".
+        max_budget (double): if given (only with paths "predecessors"), the largest budget (in €) the data will be used
+            with. Farther pairs are unreachable: their length is inf and their path raises KeyError. Not compatible with
+            'max_memory_bytes'.
+        reduce (bool): if True, precompute the data of the reduced graph (requires the origin, which is never
+            contracted). The designs are an approximation of the ones of the full graph (see 'zmod_reduction').
     Returns:
         precomputed_data (object): Includes the following:
             "n_cons" (dict): Dictionary keyed by node that shows the consumption of reclaimed water demanded by the node.
             "cons_nodes" (set): Set of nodes that demand reclaimed water (no all nodes in graph G demand water).
-            "shortest_paths" (dict): Precomputed shortest paths (list) for all node pairs (u,v) and (v,u) in G (dict of dicts).
-            "shortest_paths_length" (dict): Precomputed shortest paths lengths (double) for all node pairs (u,v) and (v,u) in G (dict of dicts).
-            "total_cons" (double): Total reclaimed water in m3/day demanded by G. 
+            "demand_fingerprint" (string): hash of the consumptions of the nodes (see 'zmod_cache.array_fingerprint').
+            "shortest_paths" (dict or PathTable): Precomputed shortest paths (list) for all node pairs (u,v) and (v,u) in G (dict of dicts).
+            "shortest_paths_length" (dict or MatrixTable): Precomputed shortest paths lengths (double) for all node pairs (u,v) and (v,u) in G (dict of dicts).
+            "total_cons" (dict or ConsumptionTable): Reclaimed water in m3/day demanded by the nodes of each shortest path, origin excluded (dict of dicts). 
             "edge_lengths" (dict): Dict keyed for each (u,v) and (v,u) edges in G with value the length of the specified edge. 
+            "storage" (object): the plan from 'zmod_shortest_paths.plan_storage', only if 'max_memory_bytes' is given.
+                With layout "disk" and no 'cache_dir', it keeps the temporary directory in "temporary" (see
+                'zmod_cache.TemporaryCache').
+            "reduced" (bool): True, only if 'reduce' is given.
+            Plus the internal entries of the topology layer (see 'precompute_topology').
     """
     
-    # First, get all the nodes that demand reused water. For each consumption node save its consumption in a dict.   
-    n_cons = {}
-    cons_nodes = set()
-    for node, data in G.nodes(data = True):
-        if data["consumption"] > 0:
-            cons_nodes.add(node)
-        n_cons[node] = data["consumption"]
+    if reduce:
+        if origin is None:
+            raise ValueError("'reduce' requires the origin.")
+        G = zmod_reduction.contract_chains(G, keep=[origin])
+    
+    max_distance = None
+    if max_budget is not None:
+        if max_memory_bytes is not None:
+            raise ValueError("'max_budget' can not be combined with 'max_memory_bytes'.")
+        max_distance = max_budget/zmod_costs.get_min_costs_diameter()
+    
+    storage = None
+    if max_memory_bytes is not None:
+        consumers = {node for node, data in G.nodes(data = True) if data["consumption"] > 0}
+        if origin is not None:
+            consumers.add(origin)
+        storage = zmod_shortest_paths.plan_storage(G.number_of_nodes(), len(consumers), max_memory_bytes)
+        backend, paths = "dense", "predecessors"
+        sources = "all" if storage["layout"] == "dense" else "consumers"
+        if storage["layout"] == "disk":
+            if cache_dir is None:
+                # Removed when the precomputed data (which keeps the plan) is dropped.
+                storage["temporary"] = zmod_cache.TemporaryCache()
+                cache_dir = storage["temporary"].path
+            storage["directory"] = cache_dir
+    
+    if sources not in ("all", "consumers"):
+        raise ValueError("Unknown sources: " + str(sources))
+    if sources == "consumers" and paths != "predecessors":
+        raise ValueError("Sources 'consumers' requires paths storage 'predecessors'.")
+    
+    source_nodes = None
+    if sources == "consumers":
+        source_nodes = {node for node, data in G.nodes(data = True) if data["consumption"] > 0}
+        if origin is not None:
+            source_nodes.add(origin)
+    topology = precompute_topology(G, backend, paths, source_nodes, workers, cache_dir, storage, max_rows, max_distance)
+    demand = precompute_demand(G, topology, cache_dir)
+    precomputed_data = {**topology, **demand}
+    if reduce:
+        precomputed_data["reduced"] = True
+    return precomputed_data
+
+def precompute_topology(G, backend="networkx", paths="lists", source_nodes=None, workers=1, cache_dir=None, storage=None, max_rows=1024, max_distance=None):
+    """
+    Precomputes the data that only depends on the street topology and lengths: shortest paths and their lengths.
+    Check func "precompute_data_lb_algorithms" for the meaning of the arguments.
+        
+    Args:
+        G (nx undirected graph): initial city street graph with all the necessary information.
+        backend (string): "networkx", "dense" or "lazy".
+        paths (string): "lists" or "predecessors".
+        source_nodes (set): nodes to compute rows from (only with paths "predecessors"), all the nodes by default.
+            Ignored by backend "lazy", where any node gets its row when needed.
+        workers (int): number of processes sharing the Dijkstra runs (only with backend "dense").
+        cache_dir (string): directory of the .npy cache (only with backend "dense", other backends raise ValueError).
+            The key ignores the consumptions.
+        storage (object): storage plan (see 'zmod_shortest_paths.plan_storage'). With layout "disk" the rows are written
+            chunk by chunk into memory maps in 'cache_dir' instead of being built in memory.
+        max_rows (int): maximum number of rows kept in memory by backend "lazy".
+        max_distance (double): if given (only with paths "predecessors"), maximum length of the computed shortest paths.
+            With backend "dense" the rows are stored sparse (see 'zmod_shortest_paths.SparseRows'), and the workers and
+            the storage plan are not used.
+    Returns:
+        topology (object): Includes the following:
+            "backend" (string): backend used.
+            "max_distance" (double): the given maximum length, or None.
+            "storage" (object): the given storage plan, or None.
+            "fingerprint" (string): hash of the node ids and edge lengths (see 'zmod_cache.graph_fingerprint').
+            "shortest_paths" (dict or PathTable): see "precompute_data_lb_algorithms".
+            "shortest_paths_length" (dict or MatrixTable): see "precompute_data_lb_algorithms".
+            "edge_lengths" (dict): see "precompute_data_lb_algorithms".
+            Only with backend "dense":
+            "nodes" (list), "index" (dict): node of each index and index of each node (see 'zmod_shortest_paths.build_node_index').
+            "csr" (scipy csr_matrix): weighted adjacency matrix.
+            "sources" (numpy array): node index of each stored row, or None if every node has a row.
+            "predecessors" (PathTable): predecessor trees of the rows, even when the paths are stored as lists.
+            "sparse_rows" (SparseRows): only with 'max_distance', the rows behind the sparse tables.
+            Only with backend "lazy":
+            "nodes" (list), "index" (dict), "csr" (scipy csr_matrix): as with backend "dense".
+            "lazy_rows" (LazyRows): cache of the solved rows, shared by the lazy tables (it counts its hits and misses).
+    """
     
-    # Compute all the shortest paths in advance.
-    shortest_paths = nx.shortest_path(G, weight='length')
-    shortest_paths_length = dict(nx.shortest_path_length(G, weight='length'))
+    if paths not in ("lists", "predecessors"):
+        raise ValueError("Unknown paths storage: " + str(paths))
+    if paths == "predecessors" and backend not in ("dense", "lazy"):
+        raise ValueError("Paths storage 'predecessors' requires backend 'dense' or 'lazy'.")
+    if backend == "lazy" and paths != "predecessors":
+        raise ValueError("Backend 'lazy' requires paths storage 'predecessors'.")
+    if source_nodes is not None and paths != "predecessors":
+        raise ValueError("Computing only some source rows requires paths storage 'predecessors'.")
+    if max_distance is not None and paths != "predecessors":
+        raise ValueError("A maximum distance requires paths storage 'predecessors'.")
+    if cache_dir is not None and backend != "dense":
+        raise ValueError("A cache directory requires backend 'dense'.")
     
     # Length of all the edges (s/d and d/s).
     edge_lengths = {}
@@ -47,37 +184,251 @@ def precompute_data_lb_algorithms(G):
         edge_lengths[(u,v)] = data['length']
         edge_lengths[(v,u)] = data['length']
     
+    topology = {
+        "backend": backend,
+        "storage": storage,
+        "fingerprint": zmod_cache.graph_fingerprint(G, consumption=False),
+        "max_distance": max_distance,
+        "edge_lengths": edge_lengths
+    }
+    
+    # Compute all the shortest paths in advance.
+    if backend == "dense" and max_distance is not None:
+        # Only the pairs within the maximum distance, in sparse rows.
+        nodes, index = zmod_shortest_paths.build_node_index(G)
+        csr = zmod_shortest_paths.build_csr_graph(G, index)
+        source_indices = None
+        cache_key = topology["fingerprint"] + "-all"
+        if source_nodes is not None:
+            source_indices = np.array(sorted(index[node] for node in source_nodes), dtype=np.int32)
+            cache_key = topology["fingerprint"] + "-" + zmod_cache.array_fingerprint(source_indices)
+        cache_key += "-max" + repr(float(max_distance))
+        cached = None
+        if cache_dir is not None:
+            cached = zmod_cache.load_arrays(cache_dir, cache_key, ["indptr", "indices", "dist", "pred"])
+        sparse_rows = zmod_shortest_paths.SparseRows(csr, source_indices, max_distance, arrays=cached)
+        if cache_dir is not None and cached is None:
+            zmod_cache.save_arrays(cache_dir, cache_key, sparse_rows.arrays())
+        predecessors = zmod_shortest_paths.SparsePathTable(sparse_rows, nodes, index, source_indices)
+        topology.update({
+            "nodes": nodes,
+            "index": index,
+            "csr": csr,
+            "sources": source_indices,
+            "cache_key": cache_key,
+            "sparse_rows": sparse_rows,
+            "predecessors": predecessors,
+            "shortest_paths": predecessors,
+            "shortest_paths_length": zmod_shortest_paths.SparseMatrixTable(sparse_rows, nodes, index, source_indices)
+        })
+    elif backend == "dense":
+        nodes, index = zmod_shortest_paths.build_node_index(G)
+        csr = zmod_shortest_paths.build_csr_graph(G, index)
+        source_indices = None
+        cache_key = topology["fingerprint"] + "-all"
+        if source_nodes is not None:
+            source_indices = np.array(sorted(index[node] for node in source_nodes), dtype=np.int32)
+            cache_key = topology["fingerprint"] + "-" + zmod_cache.array_fingerprint(source_indices)
+        cached = None
+        if cache_dir is not None:
+            cached = zmod_cache.load_arrays(cache_dir, cache_key, ["dist", "pred"])
+        if cached is not None:
+            dist, pred = cached["dist"], cached["pred"]
+        elif storage is not None and storage["layout"] == "disk":
+            n_rows = len(nodes) if source_indices is None else len(source_indices)
+            tmp_entry, arrays = zmod_cache.create_arrays(cache_dir, cache_key, {"dist": ((n_rows, len(nodes)), np.float32), "pred": ((n_rows, len(nodes)), np.int32)})
+            zmod_shortest_paths.shortest_path_rows(csr, None, source_indices, workers, out=(arrays["dist"], arrays["pred"]), block=storage["block"])
+            cached = zmod_cache.commit_arrays(cache_dir, cache_key, tmp_entry, arrays)
+            dist, pred = cached["dist"], cached["pred"]
+        else:
+            dist, pred = zmod_shortest_paths.shortest_path_rows(csr, None, source_indices, workers, block=None if storage is None else storage["block"])
+            if cache_dir is not None:
+                zmod_cache.save_arrays(cache_dir, cache_key, {"dist": dist, "pred": pred})
+        predecessors = zmod_shortest_paths.PathTable(pred, nodes, index, source_indices)
+        shortest_paths = predecessors
+        if paths == "lists":
+            shortest_paths = {u: dict(predecessors[u]) for u in nodes}
+        topology.update({
+            "nodes": nodes,
+            "index": index,
+            "csr": csr,
+            "sources": source_indices,
+            "cache_key": cache_key,
+            "predecessors": predecessors,
+            "shortest_paths": shortest_paths,
+            "shortest_paths_length": zmod_shortest_paths.MatrixTable(dist, nodes, index, source_indices)
+        })
+    elif backend == "lazy":
+        nodes, index = zmod_shortest_paths.build_node_index(G)
+        csr = zmod_shortest_paths.build_csr_graph(G, index)
+        lazy_rows = zmod_shortest_paths.LazyRows(csr, max_rows, np.inf if max_distance is None else max_distance)
+        topology.update({
+            "nodes": nodes,
+            "index": index,
+            "csr": csr,
+            "lazy_rows": lazy_rows,
+            "shortest_paths": zmod_shortest_paths.LazyPathTable(lazy_rows, nodes, index),
+            "shortest_paths_length": zmod_shortest_paths.LazyMatrixTable(lazy_rows, nodes, index)
+        })
+    elif backend == "networkx":
+        topology["shortest_paths"] = nx.shortest_path(G, weight='length')
+        topology["shortest_paths_length"] = dict(nx.shortest_path_length(G, weight='length'))
+    else:
+        raise ValueError("Unknown precompute backend: " + str(backend))
+    return topology
+
+def precompute_demand(G, topology, cache_dir=None):
+    """
+    Precomputes the data that depends on the consumptions of the nodes, on top of an already computed topology layer.
+    It is cheap compared to the topology layer: no shortest path is computed.
+        
+    Args:
+        G (nx undirected graph): city street graph with the (new) "consumption" node attribute.
+        topology (object): topology layer (see 'precompute_topology').
+        cache_dir (string): directory of the .npy cache (only with backend "dense", other backends raise ValueError).
+            With storage layout "disk" the directory of the plan is used instead.
+    Returns:
+        demand (object): "n_cons", "cons_nodes", "demand_fingerprint" and "total_cons" entries (see "precompute_data_lb_algorithms").
+    """
+    
+    if cache_dir is not None and topology["backend"] != "dense":
+        raise ValueError("A cache directory requires backend 'dense'.")
+    
+    # First, get all the nodes that demand reused water. For each consumption node save its consumption in a dict.   
+    n_cons = {}
+    cons_nodes = set()
+    for node, data in G.nodes(data = True):
+        if data["consumption"] > 0:
+            cons_nodes.add(node)
+        n_cons[node] = data["consumption"]
+    
     # From all paths get extra data.
-    total_cons = {}
-    for origin in shortest_paths.keys():
-        total_cons[origin] = {}
-        for destination, path in shortest_paths[origin].items():
-            if destination != origin:
-                cons = 0
-                for i in range(1,len(path)):
-                    if n_cons[path[i]] > 0:
-                        cons += n_cons[path[i]]
-                total_cons[origin][destination] = cons
+    if topology.get("sparse_rows") is not None:
+        # Accumulated over the stored entries of the sparse rows.
+        nodes = topology["nodes"]
+        cons_array = np.array([n_cons[node] for node in nodes], dtype=np.float64)
+        total_cons = zmod_shortest_paths.SparseConsumptionTable(topology["sparse_rows"], nodes, topology["index"], cons_array, topology["sources"])
+    elif topology["backend"] == "dense":
+        # Accumulate the consumptions over the shortest path trees, aligned with the distances.
+        nodes = topology["nodes"]
+        cons_array = np.array([n_cons[node] for node in nodes], dtype=np.float64)
+        cache_key = topology["cache_key"] + "-" + zmod_cache.array_fingerprint(cons_array)
+        cached = None
+        if cache_dir is not None:
+            cached = zmod_cache.load_arrays(cache_dir, cache_key, ["total_cons"])
+        if cached is not None:
+            total_cons_matrix = cached["total_cons"]
+        elif topology["storage"] is not None and topology["storage"]["layout"] == "disk":
+            pred = topology["predecessors"].pred
+            directory = topology["storage"]["directory"]
+            tmp_entry, arrays = zmod_cache.create_arrays(directory, cache_key, {"total_cons": (pred.shape, np.float64)})
+            zmod_shortest_paths.path_consumptions(pred, cons_array, out=arrays["total_cons"], block=topology["storage"]["block"])
+            total_cons_matrix = zmod_cache.commit_arrays(directory, cache_key, tmp_entry, arrays)["total_cons"]
+        else:
+            total_cons_matrix = zmod_shortest_paths.path_consumptions(topology["predecessors"].pred, cons_array)
+            if cache_dir is not None:
+                zmod_cache.save_arrays(cache_dir, cache_key, {"total_cons": total_cons_matrix})
+        total_cons = zmod_shortest_paths.ConsumptionTable(total_cons_matrix, nodes, topology["index"], cons_array, topology["sources"])
+    elif topology["backend"] == "lazy":
+        # Accumulated per row when the row is first needed.
+        nodes = topology["nodes"]
+        cons_array = np.array([n_cons[node] for node in nodes], dtype=np.float64)
+        total_cons = zmod_shortest_paths.LazyConsumptionTable(topology["lazy_rows"], nodes, topology["index"], cons_array)
+    else:
+        shortest_paths = topology["shortest_paths"]
+        total_cons = {}
+        for origin in shortest_paths.keys():
+            total_cons[origin] = {}
+            for destination, path in shortest_paths[origin].items():
+                if destination != origin:
+                    cons = 0
+                    for i in range(1,len(path)):
+                        if n_cons[path[i]] > 0:
+                            cons += n_cons[path[i]]
+                    total_cons[origin][destination] = cons
                 
     return {
         "n_cons": n_cons, 
         "cons_nodes": cons_nodes, 
-        "shortest_paths": shortest_paths, 
-        "shortest_paths_length": shortest_paths_length, 
-        "total_cons": total_cons, 
-        "edge_lengths": edge_lengths
+        "demand_fingerprint": zmod_cache.array_fingerprint(np.array(list(n_cons.values()), dtype=np.float64)),
+        "total_cons": total_cons
     }
 
-########################################################################################################
+def refresh_demand(G, precomputed_data, cache_dir=None):
+    """
+    Rebuilds the demand layer of some precomputed data after the consumptions of G changed (e.g. after 'link_json_consumptions'
+    or 'link_publicgarden_consumptions'), reusing its topology layer. Only valid if the streets and their lengths did not change.
+    If only some source rows were computed, the rows of the new consumption nodes are added first.
+        
+    Args:
+        G (nx undirected graph): city street graph with the new "consumption" node attribute.
+        precomputed_data (object): data from "precompute_data_lb_algorithms" (it is not modified).
+        cache_dir (string): directory of the .npy cache (only with backend "dense", other backends raise ValueError).
+    Returns:
+        precomputed_data (object): new data with the same topology layer and the new demand layer.
+    """
+    
+    if precomputed_data.get("reduced", False):
+        # The consumption nodes are kept by the contraction, so the reduced topology depends on them.
+        raise ValueError("The data of a reduced graph has to be precomputed again.")
+    if zmod_cache.graph_fingerprint(G, consumption=False) != precomputed_data["fingerprint"]:
+        raise ValueError("The street topology or lengths changed, the data has to be precomputed again.")
+    topology = {key: value for key, value in precomputed_data.items() if key not in ("n_cons", "cons_nodes", "demand_fingerprint", "total_cons")}
+    
+    if topology["backend"] == "dense" and topology["sources"] is not None:
+        index = topology["index"]
+        rows = topology["predecessors"].rows
+        missing = np.array(sorted(index[node] for node, data in G.nodes(data = True) if data["consumption"] > 0 and index[node] not in rows), dtype=np.int32)
+        if len(missing) > 0:
+            sources = np.concatenate([topology["sources"], missing])
+            nodes = topology["nodes"]
+            storage = topology["storage"]
+            cache_key = topology["fingerprint"] + "-" + zmod_cache.array_fingerprint(sources)
+            if topology.get("sparse_rows") is not None:
+                # Sparse rows are cheap to solve again with the new sources.
+                cache_key += "-max" + repr(float(topology["max_distance"]))
+                sparse_rows = zmod_shortest_paths.SparseRows(topology["csr"], sources, topology["max_distance"])
+                topology["sparse_rows"] = sparse_rows
+                predecessors = zmod_shortest_paths.SparsePathTable(sparse_rows, nodes, index, sources)
+                lengths = zmod_shortest_paths.SparseMatrixTable(sparse_rows, nodes, index, sources)
+            else:
+                if storage is not None and storage["layout"] == "disk":
+                    # Copy the old rows and solve the new ones into a new entry, without loading the matrices.
+                    n_old = len(topology["sources"])
+                    shapes = {"dist": ((len(sources), len(nodes)), np.float32), "pred": ((len(sources), len(nodes)), np.int32)}
+                    tmp_entry, arrays = zmod_cache.create_arrays(storage["directory"], cache_key, shapes)
+                    for start in range(0, n_old, storage["block"]):
+                        stop = min(start+storage["block"], n_old)
+                        arrays["dist"][start:stop] = topology["shortest_paths_length"].matrix[start:stop]
+                        arrays["pred"][start:stop] = topology["predecessors"].pred[start:stop]
+                    zmod_shortest_paths.shortest_path_rows(topology["csr"], None, missing, out=(arrays["dist"][n_old:], arrays["pred"][n_old:]), block=storage["block"])
+                    cached = zmod_cache.commit_arrays(storage["directory"], cache_key, tmp_entry, arrays)
+                    dist, pred = cached["dist"], cached["pred"]
+                else:
+                    dist, pred = zmod_shortest_paths.all_sources_distances(topology["csr"], missing, return_predecessors=True)
+                    dist = np.concatenate([topology["shortest_paths_length"].matrix, dist])
+                    pred = np.concatenate([topology["predecessors"].pred, pred])
+                predecessors = zmod_shortest_paths.PathTable(pred, nodes, index, sources)
+                lengths = zmod_shortest_paths.MatrixTable(dist, nodes, index, sources)
+            topology["sources"] = sources
+            topology["cache_key"] = cache_key
+            topology["predecessors"] = predecessors
+            topology["shortest_paths"] = predecessors
+            topology["shortest_paths_length"] = lengths
+    
+    demand = precompute_demand(G, topology, cache_dir)
+    return {**topology, **demand}
+
 ########################################################################################################
 ################################### BUDGETED ALGORITHM V2 ###########################################
 ########################################################################################################
 ########################################################################################################
     
-def lb_algorithm_v2(G, b, origin, precomputed_data, debug=False):
+def lb_algorithm_v2(G, b, origin, precomputed_data, reduce=False, debug=False):
     """
     Returns the optimal reclaimed water network maximizing water served, minimizing costs without resilience in mind.
     It is v2, improves efficiency from the original LB algorithm from REWATnet v1.
+    Preset of 'zmod_greedy.greedy_network' with the max flow cost model and no second path.
         
     Args:
         G (nx undirected graph): original graph.
@@ -85,6 +436,8 @@ def lb_algorithm_v2(G, b, origin, precomputed_data, debug=False):
         origin (int): Origin node of the reuse network graph. Must be a node in G.
         precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
             Check func "precompute_data_lb_algorithms" for more info.
+        reduce (bool): run on the reduced graph, as the precomputed data (see "precompute_data_lb_algorithms"), and
+            return the network expanded to the street segments of G.
         debug (bool): If true, print messages to the console.
         
     Returns:
@@ -94,134 +447,9 @@ def lb_algorithm_v2(G, b, origin, precomputed_data, debug=False):
             computation_time (double): Seconds elapsed in the computation. 
     """
     
-    start = time.time()
-    stop = False
-    cons_nodes_remaining = precomputed_data["cons_nodes"].copy()
-    if origin in cons_nodes_remaining:
-        cons_nodes_remaining.remove(origin)
-    cons_nodes_added = set()
-    added_nodes = set()
-    added_nodes.add(origin)
-    added_edges = set()
-    
-    remaining_budget = b
-    
-    G_new = nx.create_empty_copy(G)
-    G_original = nx.Graph(G)
-    
-    while not stop and len(cons_nodes_remaining) > 0:
-        
-        candidates = []
-        
-        for cons_node in cons_nodes_remaining:
-            min_path_length = float('inf')
-            min_path = []
-            min_path_total_cons = 0
-            for node in added_nodes:
-                if precomputed_data["shortest_paths_length"][node][cons_node] < min_path_length:
-                    min_path_length = precomputed_data["shortest_paths_length"][node][cons_node]
-                    min_path = precomputed_data["shortest_paths"][node][cons_node]
-                    min_path_total_cons = precomputed_data["total_cons"][node][cons_node]
-            
-            # Treshold to not add a candidate if the minimum cost (in €) of the shortest path passes the budget.
-            min_cost = zmod_costs.get_min_costs_diameter()*min_path_length
-            if min_cost < remaining_budget:
-                profit = min_path_total_cons/min_path_length
-                candidates.append((min_path, profit, min_path_total_cons, min_path_length))
-        
-        candidates_sorted = sorted(candidates, key = lambda x: x[1], reverse = True)
-        if len(candidates_sorted) > 0:
-            n_can = 0
-            for candidate in candidates_sorted:
-
-                min_path = candidate[0]
-                profit = candidate[1]
-                total_cons = candidate[2]
-                min_path_length = candidate[3]
-
-                # From the shortest path get the consumption nodes and edge path.
-                # Add the edges from the edge path that are not yet in the new graph:
-                cons_nodes = set()
-                new_edges_path = []
-                edges_path = []
-                for v, w in zmod_pairwise.pairwise(min_path):
-                    edges_path.append((v,w))
-                    if w in precomputed_data["cons_nodes"]:
-                        cons_nodes.add(w)
-                    if (v,w) not in added_edges:
-                        G_new.add_edge(v,w)
-                        new_edges_path.append((v,w))
-
-                # Cost of the new network.
-                cost, diameters_dict = zmod_costs.get_construction_costs(G_new, origin, cons_nodes_added.union(cons_nodes), total_cons, precomputed_data)
-                n_can += 1
-                if cost < b:
-                    # Solution found: break the loop and add the new edges to 'added_edges'.
-                    for edge in new_edges_path:
-                        added_edges.add(edge)
-                        added_edges.add((edge[1],edge[0]))
-                    break
-                else:
-                    for edge in new_edges_path:
-                        G_new.remove_edge(*edge)
-
-            if cost < b:
-                # Add nodes to "added_nodes" and remove them from "cons_nodes".
-                for node in min_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
-
-                remaining_budget = b - cost
-            else:
-                # No more candidates.
-                if debug:
-                    print(" - No more candidates available.")
-                stop = True
-            if debug:
-                print(" - Candidates evaluated: (",n_can,"/",len(candidates_sorted),"). Current cost: (",int(cost),"/",b,"€).")
-        else:
-            # No more candidates.
-            if debug:
-                print(" - No more candidates available.")
-            stop = True
-            
-    # The resulting network has all nodes in G, so it is necessary to remove unconnected nodes (extract biggest component). 
-    G_new_full = nx.Graph(G_original)
-    attrs = {}
-    for u,v,data in G_original.edges(data=True):
-        if not G_new.has_edge(u,v):
-            G_new_full.remove_edge(u,v)
-        else:
-            attrs[(u,v)] = {"diameter": diameters_dict[(u,v)], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(diameters_dict[(u,v)])}
-    nx.set_edge_attributes(G_new_full, attrs)
-    Gcc = sorted(nx.connected_components(G_new_full), key=len, reverse=True)
-    G_new_full = G_new_full.subgraph(Gcc[0])
-    
-    # Get the total consumption of new and original network.
-    total_cons = 0
-    for node in added_nodes:
-        total_cons += precomputed_data["n_cons"][node]
-    total_cons_original = sum(list(precomputed_data["n_cons"].values()))
-    
-    
-    # Get the total network pipe distance (in m)
-    pipe_distance = int(G_new_full.size(weight="length"))
-        
-    end = time.time()
-    
-    # Resulting data structure.
-    result_data = {
-        "added_nodes": added_nodes,
-        "cons_nodes": cons_nodes_added,
-        "total_cons": total_cons,
-        "pipe_distance": pipe_distance,
-        "percentage_served": round(total_cons / total_cons_original * 100, 1),
-        "execution_time": end-start,
-        "failure_rate": 100*(0.4*(pipe_distance/1000))/G_new_full.number_of_edges()
-    }
-    return G_new_full, result_data
+    G_run = _reduced_graph(G, origin, precomputed_data, reduce)
+    G_new_full, result_data, evaluation = zmod_greedy.greedy_network(G_run, b, origin, precomputed_data, debug=debug, **_PRESETS["lb_algorithm_v2"][0])
+    return _expand_result(G, G_run, (G_new_full, result_data))
 
 def get_size(obj, seen=None):
     """Recursively finds size of objects"""
@@ -256,9 +484,10 @@ def get_size(obj, seen=None):
 ########################################################################################################
 ########################################################################################################
 
-def lb_algorithm_v1_efficient_hydro(G, b, origin, precomputed_data, debug=False):
+def lb_algorithm_v1_efficient_hydro(G, b, origin, precomputed_data, parallel_candidates=1, memo=None, reduce=False, debug=False):
     """
     Returns the optimal reclaimed water network maximizing water served, minimizing costs without resilience in mind.
+    Preset of 'zmod_greedy.greedy_network' with the hydraulic (EPANET) cost model and no second path.
         
     Args:
         G (nx undirected graph): original graph.
@@ -266,6 +495,15 @@ def lb_algorithm_v1_efficient_hydro(G, b, origin, precomputed_data, debug=False)
         origin (int): Origin node of the reuse network graph. Must be a node in G.
         precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
             Check func "precompute_data_lb_algorithms" for more info.
+        parallel_candidates (int): candidates evaluated at the same time, each in its own process (see 
+            'zmod_greedy.greedy_network'). The result does not change.
+        memo (zmod_greedy.EvaluationMemo): if given, cache of the EPANET simulations, that can be shared by the runs on
+            the same street graph (e.g. one per budget). Only the simulations are cached: the costs and tank capacity
+            of each candidate at every speed are always computed (they are cheap, see 'zmod_greedy.staged_evaluation'),
+            and a simulation is reused only for the same edges with the same diameters and valves. None (default)
+            simulates every network, including the ones already simulated by earlier speed retries, iterations or runs.
+        reduce (bool): run on the reduced graph, as the precomputed data (see "precompute_data_lb_algorithms"), and
+            return the network expanded to the street segments of G.
         debug (bool): If true, print messages to the console.
         
     Returns:
@@ -275,168 +513,10 @@ def lb_algorithm_v1_efficient_hydro(G, b, origin, precomputed_data, debug=False)
             computation_time (double): Seconds elapsed in the computation. 
     """
     
-    start = time.time()
-    stop = False
-    cons_nodes_remaining = precomputed_data["cons_nodes"].copy()
-    if origin in cons_nodes_remaining:
-        cons_nodes_remaining.remove(origin)
-    cons_nodes_added = set()
-    added_nodes = set()
-    added_nodes.add(origin)
-    added_edges = set()
-    
-    remaining_budget = b
-    
-    G_new = nx.create_empty_copy(G)
-    G_original = nx.Graph(G)
-    G_connectivity_check = nx.Graph(G)
-    
-    # Check if disconnecting an edge disconnects the graph.
-    connect_dict = {}
-    for u,v in G_connectivity_check.edges():
-        G_connectivity_check.remove_edge(u,v)
-        if nx.is_connected(G_connectivity_check):
-            connect_dict[(u,v)] = True
-            connect_dict[(v,u)] = True
-        else:
-            connect_dict[(u,v)] = False
-            connect_dict[(v,u)] = False
-        G_connectivity_check.add_edge(u,v)
-    
-    while not stop and len(cons_nodes_remaining) > 0:
-        
-        candidates = []
-        
-        for cons_node in cons_nodes_remaining:
-            min_path_length = float('inf')
-            min_path = []
-            min_path_total_cons = 0
-            for node in added_nodes:
-                if precomputed_data["shortest_paths_length"][node][cons_node] < min_path_length:
-                    min_path_length = precomputed_data["shortest_paths_length"][node][cons_node]
-                    min_path = precomputed_data["shortest_paths"][node][cons_node]
-                    min_path_total_cons = precomputed_data["total_cons"][node][cons_node]
-            
-            # Treshold to not add a candidate if the minimum cost (in €) of the shortest path passes the budget.
-            min_cost = zmod_costs.get_min_costs_diameter()*min_path_length
-            if min_cost < remaining_budget:
-                profit = min_path_total_cons/min_path_length
-                candidates.append((min_path, profit, min_path_total_cons, min_path_length))
-        
-        candidates_sorted = sorted(candidates, key = lambda x: x[1], reverse = True)
-        if len(candidates_sorted) > 0:
-            n_can = 0
-            for candidate in candidates_sorted:
-
-                min_path = candidate[0]
-                profit = candidate[1]
-                total_cons = candidate[2]
-                min_path_length = candidate[3]
-                
-                # From the shortest path get the consumption nodes and edge path.
-                # Add the edges from the edge path that are not yet in the new graph:
-                cons_nodes = set()
-                new_edges_path = []
-                edges_path = []
-                for v, w in zmod_pairwise.pairwise(min_path):
-                    if connect_dict[(v,w)]:
-                        edges_path.append((v,w))
-                    if w in precomputed_data["cons_nodes"]:
-                        cons_nodes.add(w)
-                    if (v,w) not in added_edges:
-                        G_new.add_edge(v,w)
-                        new_edges_path.append((v,w))
-
-                # Cost of the new network. Try to compute EPANET to validate hydraulically feasible.
-                # If not (detected reduction in demand) try to variate speed.
-                min_speed = 0.6
-                max_speed = 1
-                success = False
-                while not success and min_speed >= 0.4:
-                    test_graph, cost, t_capacity = zmod_costs.diameter_selection_and_cost_v2(G_new, origin, precomputed_data, total_cons, min_speed, max_speed)
-                    test_graph.remove_nodes_from(list(nx.isolates(test_graph)))
-                    node_data, link_data, result_data = zmod_epanet.compute_epanet(test_graph, t_capacity, origin)
-                    success = result_data["success"]
-                    min_speed -= 0.05
-                
-                n_can += 1
-                if cost < b:
-                    # Solution found: break the loop and add the new edges to 'added_edges'.
-                    #  Also store EPANET result.
-                    epanet_result = {
-                        "node_data": node_data, 
-                        "link_data": link_data, 
-                        "result_data": result_data
-                    }
-                    for edge in new_edges_path:
-                        added_edges.add(edge)
-                        added_edges.add((edge[1],edge[0]))
-                    break
-                else:
-                    for edge in new_edges_path:
-                        if G_new.has_edge(*edge):
-                            G_new.remove_edge(*edge)
-
-            if cost < b:
-                # Add nodes to "added_nodes" and remove them from "cons_nodes".
-                for node in min_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
-
-                remaining_budget = b - cost
-            else:
-                # No more candidates.
-                if debug:
-                    print(" - No more candidates available.")
-                stop = True
-            if debug:
-                print(" - Candidates evaluated: (",n_can,"/",len(candidates_sorted),"). Current cost: (",int(cost),"/",b,"€). 2K =",second_path)
-        else:
-            # No more candidates.
-            if debug:
-                print(" - No more candidates available.")
-            stop = True
-            
-    # The resulting network has all nodes in G, so it is necessary to remove unconnected nodes (extract biggest component). 
-    G_new_full = nx.Graph(G_original)
-    attrs = {}
-    for u,v,data in G_original.edges(data=True):
-        if not G_new.has_edge(u,v):
-            G_new_full.remove_edge(u,v)
-        else:
-            attrs[(u,v)] = {"flow": test_graph[u][v]["flow"], "diameter": test_graph[u][v]["diameter"], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(test_graph[u][v]["diameter"])}
-            if "valve" in test_graph[u][v]:
-                attrs[(u,v)]["valve"] = test_graph[u][v]["valve"]
-    nx.set_edge_attributes(G_new_full, attrs)
-    Gcc = sorted(nx.connected_components(G_new_full), key=len, reverse=True)
-    G_new_full = G_new_full.subgraph(Gcc[0])
-    
-    # Get the total consumption of new and original network.
-    total_cons = 0
-    for node in added_nodes:
-        total_cons += precomputed_data["n_cons"][node]
-    total_cons_original = sum(list(precomputed_data["n_cons"].values()))
-    
-    
-    # Get the total network pipe distance (in m)
-    pipe_distance = int(G_new_full.size(weight="length"))
-        
-    end = time.time()
-    
-    # Resulting data structure.
-    result_data = {
-        "added_nodes": added_nodes,
-        "cons_nodes": cons_nodes_added,
-        "total_cons": total_cons,
-        "pipe_distance": pipe_distance,
-        "percentage_served": round(total_cons / total_cons_original * 100, 1),
-        "execution_time": end-start,
-        "failure_rate": 100*((0.4/12)*(pipe_distance/1000))/G_new_full.number_of_edges(),
-        "tank_capacity": t_capacity
-    }
-    return G_new_full, result_data, epanet_result
+    G_run = _reduced_graph(G, origin, precomputed_data, reduce)
+    G_new_full, result_data, evaluation = zmod_greedy.greedy_network(G_run, b, origin, precomputed_data, parallel_candidates=parallel_candidates, memo=memo, debug=debug, **_PRESETS["lb_algorithm_v1_efficient_hydro"][0])
+    epanet_result = None if evaluation is None else evaluation["epanet"]
+    return _expand_result(G, G_run, (G_new_full, result_data, epanet_result))
 
 ########################################################################################################
 ########################################################################################################
@@ -444,10 +524,11 @@ def lb_algorithm_v1_efficient_hydro(G, b, origin, precomputed_data, debug=False)
 ########################################################################################################
 ########################################################################################################
     
-def lbr_algorithm_old(G, b, origin, precomputed_data, debug=False):
+def lbr_algorithm_old(G, b, origin, precomputed_data, second_path="legacy", reduce=False, debug=False):
     """
     Returns the optimal reclaimed water network maximizing water served, minimizing costs with resilience in mind, 
     trying to achieve a K=2 edge connectivity.
+    Preset of 'zmod_greedy.greedy_network' with the consumption aggregation cost model and the legacy second path.
         
     Args:
         G (nx undirected graph): original graph.
@@ -455,6 +536,12 @@ def lbr_algorithm_old(G, b, origin, precomputed_data, debug=False):
         origin (int): Origin node of the reuse network graph. Must be a node in G.
         precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
             Check func "precompute_data_lb_algorithms" for more info.
+        second_path (string): second path strategy. "legacy" (default) removes the path edges from G for each search, as
+            the original algorithm, "masked" searches the same paths on a read only copy, without modifying G, and "disjoint_pair" chooses the
+            path and its second path together, as the pair of edge-disjoint paths with the minimum total length (see
+            'zmod_greedy.LegacySecondPath', 'zmod_greedy.MaskedSecondPath' and 'zmod_greedy.DisjointPairPath').
+        reduce (bool): run on the reduced graph, as the precomputed data (see "precompute_data_lb_algorithms"), and
+            return the network expanded to the street segments of G.
         debug (bool): If true, print messages to the console.
         
     Returns:
@@ -464,188 +551,20 @@ def lbr_algorithm_old(G, b, origin, precomputed_data, debug=False):
             computation_time (double): Seconds elapsed in the computation. 
     """
     
-    start = time.time()
-    stop = False
-    cons_nodes_remaining = precomputed_data["cons_nodes"].copy()
-    if origin in cons_nodes_remaining:
-        cons_nodes_remaining.remove(origin)
-    cons_nodes_added = set()
-    added_nodes = set()
-    added_nodes.add(origin)
-    added_edges = set()
-    
-    remaining_budget = b
-    
-    G_new = nx.create_empty_copy(G)
-    G_original = nx.Graph(G)
-    G_connectivity_check = nx.Graph(G)
-    
-    # Check if disconnecting an edge disconnects the graph.
-    connect_dict = {}
-    for u,v in G_connectivity_check.edges():
-        G_connectivity_check.remove_edge(u,v)
-        if nx.is_connected(G_connectivity_check):
-            connect_dict[(u,v)] = True
-            connect_dict[(v,u)] = True
-        else:
-            connect_dict[(u,v)] = False
-            connect_dict[(v,u)] = False
-        G_connectivity_check.add_edge(u,v)
-    
-    while not stop and len(cons_nodes_remaining) > 0:
-        
-        candidates = []
-        
-        for cons_node in cons_nodes_remaining:
-            min_path_length = float('inf')
-            min_path = []
-            min_path_total_cons = 0
-            for node in added_nodes:
-                if precomputed_data["shortest_paths_length"][node][cons_node] < min_path_length:
-                    min_path_length = precomputed_data["shortest_paths_length"][node][cons_node]
-                    min_path = precomputed_data["shortest_paths"][node][cons_node]
-                    min_path_total_cons = precomputed_data["total_cons"][node][cons_node]
-            
-            # Treshold to not add a candidate if the minimum cost (in €) of the shortest path passes the budget.
-            min_cost = zmod_costs.get_min_costs_diameter()*min_path_length
-            if min_cost < remaining_budget:
-                profit = min_path_total_cons/(min_path_length*2)
-                candidates.append((min_path, profit, min_path_total_cons, min_path_length))
-        
-        candidates_sorted = sorted(candidates, key = lambda x: x[1], reverse = True)
-        if len(candidates_sorted) > 0:
-            n_can = 0
-            for candidate in candidates_sorted:
-
-                min_path = candidate[0]
-                profit = candidate[1]
-                total_cons = candidate[2]
-                min_path_length = candidate[3]
-                
-                # From the shortest path get the consumption nodes and edge path.
-                # Add the edges from the edge path that are not yet in the new graph:
-                cons_nodes = set()
-                new_edges_path = []
-                edges_path = []
-                for v, w in zmod_pairwise.pairwise(min_path):
-                    if connect_dict[(v,w)]:
-                        edges_path.append((v,w))
-                    if w in precomputed_data["cons_nodes"]:
-                        cons_nodes.add(w)
-                    if (v,w) not in added_edges:
-                        G_new.add_edge(v,w)
-                        new_edges_path.append((v,w))
-
-                # Recompute a second shortest path without the original one to add resilience (only if still the graph is connected).
-                G.remove_edges_from(edges_path)
-
-                try:
-                    second_path = True
-                    new_cons_nodes_path = set()
-                    new_shortest_path = nx.shortest_path(G, min_path[0], min_path[len(min_path)-1], weight='length')
-                    for i in range(1,len(new_shortest_path)):
-                        if precomputed_data["n_cons"][new_shortest_path[i]] > 0:
-                            new_cons_nodes_path.add(new_shortest_path[i])
-                            cons_nodes.add(new_shortest_path[i])
-                            total_cons += precomputed_data["n_cons"][new_shortest_path[i]]
-                        if (new_shortest_path[i-1],new_shortest_path[i]) not in added_edges:
-                            new_edges_path.append((new_shortest_path[i-1],new_shortest_path[i]))
-                            G_new.add_edge(new_shortest_path[i-1],new_shortest_path[i])
-                except nx.NetworkXNoPath:
-                    second_path = False
-                    new_shortest_path = []
-                    pass
-
-                # Re-add the original shortest path to the original network.
-                G.add_edges_from(edges_path)
-
-                # Cost of the new network.
-                cost, diameters_dict, t_capacity = zmod_costs.get_construction_costs_v2(G_new, origin, cons_nodes_added.union(cons_nodes), total_cons, precomputed_data)
-                n_can += 1
-                if cost < b:
-                    # Solution found: break the loop and add the new edges to 'added_edges'.
-                    for edge in new_edges_path:
-                        added_edges.add(edge)
-                        added_edges.add((edge[1],edge[0]))
-                    break
-                else:
-                    for edge in new_edges_path:
-                        if G_new.has_edge(*edge):
-                            G_new.remove_edge(*edge)
-
-            if cost < b:
-                # Add nodes to "added_nodes" and remove them from "cons_nodes".
-                for node in new_shortest_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
-                for node in min_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
-
-                remaining_budget = b - cost
-            else:
-                # No more candidates.
-                if debug:
-                    print(" - No more candidates available.")
-                stop = True
-            if debug:
-                print(" - Candidates evaluated: (",n_can,"/",len(candidates_sorted),"). Current cost: (",int(cost),"/",b,"€). 2K =",second_path)
-        else:
-            # No more candidates.
-            if debug:
-                print(" - No more candidates available.")
-            stop = True
-            
-    # The resulting network has all nodes in G, so it is necessary to remove unconnected nodes (extract biggest component). 
-    G_new_full = nx.Graph(G_original)
-    attrs = {}
-    for u,v,data in G_original.edges(data=True):
-        if not G_new.has_edge(u,v):
-            G_new_full.remove_edge(u,v)
-        else:
-            attrs[(u,v)] = {"diameter": diameters_dict[(u,v)], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(diameters_dict[(u,v)])}
-    nx.set_edge_attributes(G_new_full, attrs)
-    Gcc = sorted(nx.connected_components(G_new_full), key=len, reverse=True)
-    G_new_full = G_new_full.subgraph(Gcc[0])
-    
-    # Get the total consumption of new and original network.
-    total_cons = 0
-    for node in added_nodes:
-        total_cons += precomputed_data["n_cons"][node]
-    total_cons_original = sum(list(precomputed_data["n_cons"].values()))
-    
-    
-    # Get the total network pipe distance (in m)
-    pipe_distance = int(G_new_full.size(weight="length"))
-        
-    end = time.time()
-    
-    # Resulting data structure.
-    result_data = {
-        "added_nodes": added_nodes,
-        "cons_nodes": cons_nodes_added,
-        "total_cons": total_cons,
-        "pipe_distance": pipe_distance,
-        "percentage_served": round(total_cons / total_cons_original * 100, 1),
-        "execution_time": end-start,
-        "failure_rate": 100*((0.4/12)*(pipe_distance/1000))/G_new_full.number_of_edges(),
-        "tank_capacity": t_capacity
-    }
-    return G_new_full, result_data
+    G_run = _reduced_graph(G, origin, precomputed_data, reduce)
+    G_new_full, result_data, evaluation = zmod_greedy.greedy_network(G_run, b, origin, precomputed_data, debug=debug, **_preset_options("lbr_algorithm_old", second_path))
+    return _expand_result(G, G_run, (G_new_full, result_data))
 
 ########################################################################################################
 ########################################################################################################
 ################################### BUDGETED ALGORITHM RESIL ###########################################
 ########################################################################################################
 ########################################################################################################
-def lbr_algorithm_hydraulic(G, b, origin, precomputed_data, debug=False):
+def lbr_algorithm_hydraulic(G, b, origin, precomputed_data, parallel_candidates=1, second_path="legacy", memo=None, reduce=False, debug=False):
     """
     Returns the optimal reclaimed water network maximizing water served, minimizing costs with resilience in mind, 
     trying to achieve a K=2 edge connectivity, and ensuring hydraulical feasibility.
+    Preset of 'zmod_greedy.greedy_network' with the hydraulic (EPANET) cost model and the legacy second path.
         
     Args:
         G (nx undirected graph): original graph.
@@ -653,6 +572,19 @@ def lbr_algorithm_hydraulic(G, b, origin, precomputed_data, debug=False):
         origin (int): Origin node of the reuse network graph. Must be a node in G.
         precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
             Check func "precompute_data_lb_algorithms" for more info.
+        parallel_candidates (int): candidates evaluated at the same time, each in its own process (see 
+            'zmod_greedy.greedy_network'). The result does not change.
+        second_path (string): second path strategy. "legacy" (default) removes the path edges from G for each search, as
+            the original algorithm, "masked" searches the same paths on a read only copy, without modifying G, and "disjoint_pair" chooses the
+            path and its second path together, as the pair of edge-disjoint paths with the minimum total length (see
+            'zmod_greedy.LegacySecondPath', 'zmod_greedy.MaskedSecondPath' and 'zmod_greedy.DisjointPairPath').
+        memo (zmod_greedy.EvaluationMemo): if given, cache of the EPANET simulations, that can be shared by the runs on
+            the same street graph (e.g. one per budget). Only the simulations are cached: the costs and tank capacity
+            of each candidate at every speed are always computed (they are cheap, see 'zmod_greedy.staged_evaluation'),
+            and a simulation is reused only for the same edges with the same diameters and valves. None (default)
+            simulates every network, including the ones already simulated by earlier speed retries, iterations or runs.
+        reduce (bool): run on the reduced graph, as the precomputed data (see "precompute_data_lb_algorithms"), and
+            return the network expanded to the street segments of G.
         debug (bool): If true, print messages to the console.
         
     Returns:
@@ -662,197 +594,102 @@ def lbr_algorithm_hydraulic(G, b, origin, precomputed_data, debug=False):
             computation_time (double): Seconds elapsed in the computation. 
     """
     
-    start = time.time()
-    stop = False
-    cons_nodes_remaining = precomputed_data["cons_nodes"].copy()
-    if origin in cons_nodes_remaining:
-        cons_nodes_remaining.remove(origin)
-    cons_nodes_added = set()
-    added_nodes = set()
-    added_nodes.add(origin)
-    added_edges = set()
-    
-    remaining_budget = b
-    
-    G_new = nx.create_empty_copy(G)
-    G_original = nx.Graph(G)
-    G_connectivity_check = nx.Graph(G)
-    
-    # Check if disconnecting an edge disconnects the graph.
-    connect_dict = {}
-    for u,v in G_connectivity_check.edges():
-        G_connectivity_check.remove_edge(u,v)
-        if nx.is_connected(G_connectivity_check):
-            connect_dict[(u,v)] = True
-            connect_dict[(v,u)] = True
-        else:
-            connect_dict[(u,v)] = False
-            connect_dict[(v,u)] = False
-        G_connectivity_check.add_edge(u,v)
-    
-    while not stop and len(cons_nodes_remaining) > 0:
-        
-        candidates = []
-        
-        for cons_node in cons_nodes_remaining:
-            min_path_length = float('inf')
-            min_path = []
-            min_path_total_cons = 0
-            for node in added_nodes:
-                if precomputed_data["shortest_paths_length"][node][cons_node] < min_path_length:
-                    min_path_length = precomputed_data["shortest_paths_length"][node][cons_node]
-                    min_path = precomputed_data["shortest_paths"][node][cons_node]
-                    min_path_total_cons = precomputed_data["total_cons"][node][cons_node]
-            
-            # Treshold to not add a candidate if the minimum cost (in €) of the shortest path passes the budget.
-            min_cost = zmod_costs.get_min_costs_diameter()*min_path_length
-            if min_cost < remaining_budget:
-                profit = min_path_total_cons/(min_path_length*2)
-                candidates.append((min_path, profit, min_path_total_cons, min_path_length))
-        
-        candidates_sorted = sorted(candidates, key = lambda x: x[1], reverse = True)
-        if len(candidates_sorted) > 0:
-            n_can = 0
-            for candidate in candidates_sorted:
-
-                min_path = candidate[0]
-                profit = candidate[1]
-                total_cons = candidate[2]
-                min_path_length = candidate[3]
-                
-                # From the shortest path get the consumption nodes and edge path.
-                # Add the edges from the edge path that are not yet in the new graph:
-                cons_nodes = set()
-                new_edges_path = []
-                edges_path = []
-                for v, w in zmod_pairwise.pairwise(min_path):
-                    if connect_dict[(v,w)]:
-                        edges_path.append((v,w))
-                    if w in precomputed_data["cons_nodes"]:
-                        cons_nodes.add(w)
-                    if (v,w) not in added_edges:
-                        G_new.add_edge(v,w)
-                        new_edges_path.append((v,w))
-
-                # Recompute a second shortest path without the original one to add resilience (only if still the graph is connected).
-                G.remove_edges_from(edges_path)
-
-                try:
-                    second_path = True
-                    new_cons_nodes_path = set()
-                    new_shortest_path = nx.shortest_path(G, min_path[0], min_path[len(min_path)-1], weight='length')
-                    for i in range(1,len(new_shortest_path)):
-                        if precomputed_data["n_cons"][new_shortest_path[i]] > 0:
-                            new_cons_nodes_path.add(new_shortest_path[i])
-                            cons_nodes.add(new_shortest_path[i])
-                            total_cons += precomputed_data["n_cons"][new_shortest_path[i]]
-                        if (new_shortest_path[i-1],new_shortest_path[i]) not in added_edges:
-                            new_edges_path.append((new_shortest_path[i-1],new_shortest_path[i]))
-                            G_new.add_edge(new_shortest_path[i-1],new_shortest_path[i])
-                except nx.NetworkXNoPath:
-                    print(" - NO PATH!")
-                    second_path = False
-                    new_shortest_path = []
-                    pass
+    G_run = _reduced_graph(G, origin, precomputed_data, reduce)
+    G_new_full, result_data, evaluation = zmod_greedy.greedy_network(G_run, b, origin, precomputed_data, parallel_candidates=parallel_candidates, memo=memo, debug=debug, **_preset_options("lbr_algorithm_hydraulic", second_path))
+    epanet_result = None if evaluation is None else evaluation["epanet"]
+    return _expand_result(G, G_run, (G_new_full, result_data, epanet_result))
 
-                # Re-add the original shortest path to the original network.
-                G.add_edges_from(edges_path)
-
-                # Cost of the new network. Try to compute EPANET to validate hydraulically feasible.
-                # If not (detected reduction in demand) try to variate speed.
-                min_speed = 0.6
-                max_speed = 1
-                success = False
-                while not success and min_speed >= 0.4:
-                    test_graph, cost, t_capacity = zmod_costs.diameter_selection_and_cost_v2(G_new, origin, precomputed_data, total_cons, min_speed, max_speed)
-                    test_graph.remove_nodes_from(list(nx.isolates(test_graph)))
-                    node_data, link_data, result_data = zmod_epanet.compute_epanet(test_graph, t_capacity, origin)
-                    success = result_data["success"]
-                    min_speed -= 0.05
-                
-                n_can += 1
-                if cost < b:
-                    # Solution found: break the loop and add the new edges to 'added_edges'.
-                    #  Also store EPANET result.
-                    epanet_result = {
-                        "node_data": node_data, 
-                        "link_data": link_data, 
-                        "result_data": result_data
-                    }
-                    for edge in new_edges_path:
-                        added_edges.add(edge)
-                        added_edges.add((edge[1],edge[0]))
-                    break
-                else:
-                    for edge in new_edges_path:
-                        if G_new.has_edge(*edge):
-                            G_new.remove_edge(*edge)
+########################################################################################################
+########################################################################################################
+################################### BUDGET SWEEP #######################################################
+########################################################################################################
+########################################################################################################
 
-            if cost < b:
-                # Add nodes to "added_nodes" and remove them from "cons_nodes".
-                for node in new_shortest_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
-                for node in min_path:
-                    added_nodes.add(node)
-                    if node in cons_nodes_remaining:
-                        cons_nodes_remaining.remove(node)
-                        cons_nodes_added.add(node)
+# Options of 'zmod_greedy.greedy_network' of each algorithm preset, and whether it returns the EPANET results.
+_PRESETS = {
+    "lb_algorithm_v2": ({"cost_model": zmod_greedy.flow_cost_model, "failure_rate": 0.4}, False),
+    "lb_algorithm_v1_efficient_hydro": ({"cost_model": zmod_greedy.IncrementalHydraulicCost}, True),
+    "lbr_algorithm_old": ({"profit": zmod_greedy.resilient_profit, "second_path": zmod_greedy.LegacySecondPath, "cost_model": zmod_greedy.aggregation_cost_model}, False),
+    "lbr_algorithm_hydraulic": ({"profit": zmod_greedy.resilient_profit, "second_path": lambda G: zmod_greedy.LegacySecondPath(G, warn=True), "cost_model": zmod_greedy.IncrementalHydraulicCost}, True)
+}
+
+# Second path strategies that can replace the legacy one of the resilient presets.
+_SECOND_PATHS = {
+    "masked": zmod_greedy.MaskedSecondPath,
+    "disjoint_pair": zmod_greedy.DisjointPairPath
+}
+
+def _preset_options(name, second_path="legacy"):
+    # Options of a preset with the given second path strategy (see 'lbr_algorithm_old').
+    options = dict(_PRESETS[name][0])
+    if second_path == "legacy":
+        return options
+    if "second_path" not in options:
+        raise ValueError("The algorithm '" + name + "' has no second path")
+    if second_path not in _SECOND_PATHS:
+        raise ValueError("Unknown second path '" + second_path + "'")
+    options["second_path"] = _SECOND_PATHS[second_path]
+    return options
+
+def _reduced_graph(G, origin, precomputed_data, reduce):
+    # Graph the algorithms run on: G with its chains contracted as in the precomputation (see its 'reduce' option), or G.
+    if reduce != precomputed_data.get("reduced", False):
+        raise ValueError("'reduce' has to be the same in the precomputation and the algorithm.")
+    if not reduce:
+        return G
+    return zmod_reduction.contract_chains(G, keep=[origin])
+
+def _expand_result(G, G_run, result):
+    # Expands the network and the EPANET link results of an algorithm run on a reduced graph to the street segments of G.
+    if G_run is G:
+        return result
+    expanded = (zmod_reduction.expand_graph(G, result[0], G_run),) + tuple(result[1:])
+    if len(result) > 2 and result[2] is not None and isinstance(result[2]["link_data"], dict):
+        epanet_result = dict(result[2])
+        epanet_result["link_data"] = zmod_reduction.expand_links(G_run, epanet_result["link_data"])
+        expanded = expanded[:2] + (epanet_result,)
+    return expanded
+
+def sweep(algorithm, G, budgets, origin, precomputed_data, workers=1, second_path="legacy", memo=None, reduce=False, debug=False):
+    """
+    Runs an algorithm preset for several budgets, sharing the greedy iterations that are the same for all of them
+    (see 'zmod_greedy.sweep'). The results are the same as calling the algorithm once per budget.
 
-                remaining_budget = b - cost
-            else:
-                # No more candidates.
-                if debug:
-                    print(" - No more candidates available.")
-                stop = True
-            if debug:
-                print(" - Candidates evaluated: (",n_can,"/",len(candidates_sorted),"). Current cost: (",int(cost),"/",b,"€). 2K =",second_path)
-        else:
-            # No more candidates.
-            if debug:
-                print(" - No more candidates available.")
-            stop = True
-            
-    # The resulting network has all nodes in G, so it is necessary to remove unconnected nodes (extract biggest component). 
-    G_new_full = nx.Graph(G_original)
-    attrs = {}
-    for u,v,data in G_original.edges(data=True):
-        if not G_new.has_edge(u,v):
-            G_new_full.remove_edge(u,v)
-        else:
-            attrs[(u,v)] = {"flow": test_graph[u][v]["flow"], "diameter": test_graph[u][v]["diameter"], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(test_graph[u][v]["diameter"])}
-            if "valve" in test_graph[u][v]:
-                attrs[(u,v)]["valve"] = test_graph[u][v]["valve"]
-    nx.set_edge_attributes(G_new_full, attrs)
-    Gcc = sorted(nx.connected_components(G_new_full), key=len, reverse=True)
-    G_new_full = G_new_full.subgraph(Gcc[0])
-    
-    # Get the total consumption of new and original network.
-    total_cons = 0
-    for node in added_nodes:
-        total_cons += precomputed_data["n_cons"][node]
-    total_cons_original = sum(list(precomputed_data["n_cons"].values()))
-    
-    
-    # Get the total network pipe distance (in m)
-    pipe_distance = int(G_new_full.size(weight="length"))
+    Args:
+        algorithm (function): one of 'lb_algorithm_v2', 'lb_algorithm_v1_efficient_hydro', 'lbr_algorithm_old' and
+            'lbr_algorithm_hydraulic'.
+        G (nx undirected graph): original graph.
+        budgets (list): maximum costs (in €) of the generated networks.
+        origin (int): Origin node of the reuse network graph. Must be a node in G.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "precompute_data_lb_algorithms" for more info.
+        workers (int): processes used to run the budgets once they take different decisions.
+        second_path (string): second path strategy of the resilient algorithms (see 'lbr_algorithm_old').
+        memo (zmod_greedy.EvaluationMemo): cache of the EPANET simulations of the hydraulic algorithms, shared by all
+            the budgets (see 'lbr_algorithm_hydraulic'). None (default) caches nothing.
+        reduce (bool): run on the reduced graph and expand the networks (see 'lb_algorithm_v2').
+        debug (bool): If true, print messages to the console.
         
-    end = time.time()
-    
-    # Resulting data structure.
-    result_data = {
-        "added_nodes": added_nodes,
-        "cons_nodes": cons_nodes_added,
-        "total_cons": total_cons,
-        "pipe_distance": pipe_distance,
-        "percentage_served": round(total_cons / total_cons_original * 100, 1),
-        "execution_time": end-start,
-        "failure_rate": 100*((0.4/12)*(pipe_distance/1000))/G_new_full.number_of_edges(),
-        "tank_capacity": t_capacity
-    }
-    return G_new_full, result_data, epanet_result
+    Returns:
+        results (dict): Dict keyed by budget with the values returned by the algorithm for it (G_new and result_data,
+            plus the EPANET results for the hydraulic algorithms).
+    """
+    if algorithm.__name__ not in _PRESETS:
+        raise ValueError("Unknown algorithm '" + algorithm.__name__ + "'")
+    options, epanet = _preset_options(algorithm.__name__, second_path), _PRESETS[algorithm.__name__][1]
+    if memo is not None:
+        if not epanet:
+            raise ValueError("The algorithm '" + algorithm.__name__ + "' has no EPANET evaluations to cache")
+        options["memo"] = memo
+    G_run = _reduced_graph(G, origin, precomputed_data, reduce)
+    results = zmod_greedy.sweep(G_run, budgets, origin, precomputed_data, workers=workers, debug=debug, **options)
+    outputs = {}
+    for b, (G_new_full, result_data, evaluation) in results.items():
+        if epanet:
+            outputs[b] = _expand_result(G, G_run, (G_new_full, result_data, None if evaluation is None else evaluation["epanet"]))
+        else:
+            outputs[b] = _expand_result(G, G_run, (G_new_full, result_data))
+    return outputs
 
 ########################################################################################################
 ########################################################################################################
@@ -943,16 +780,37 @@ def improve_resilience(G, to_improve, b, origin, precomputed_data, total_cons, d
                 to_improve.add_edges_from(edges_to_add)
 
                 # Cost of the new network. Try to compute EPANET to validate hydraulically feasible.
-                # If not (detected reduction in demand) try to variate speed.
-                min_speed = 0.6
+                # If not (detected reduction in demand) try to variate speed. The flows are computed once and priced
+                # at every speed level, and over budget candidates are rejected without EPANET (see 'zmod_greedy.staged_evaluation').
                 max_speed = 1
-                success = False
-                while not success and min_speed >= 0.4:
-                    test_graph, cost, t_capacity = zmod_costs.diameter_selection_and_cost_v2_improvement(nx.Graph(to_improve), origin, precomputed_data, total_cons, min_speed, max_speed)
-                    test_graph.remove_nodes_from(list(nx.isolates(test_graph)))
-                    node_data, link_data, result_data = zmod_epanet.compute_epanet(test_graph, t_capacity, origin)
-                    success = result_data["success"]
-                    min_speed -= 0.05
+                improved = nx.Graph(to_improve)
+                flows = zmod_costs.diameter_flows(improved, origin, precomputed_data, consumption=precomputed_data['n_cons'], presets=True)
+                selections = zmod_costs.level_selections(flows, zmod_greedy.speed_levels, max_speed)
+                t_capacity = zmod_costs.tank_cost(total_cons)[1]
+                costs = [math.inf if selection is None else selection["cost"] for selection in selections]
+
+                def level_graph(level):
+                    selection = selections[level]
+                    if selection is None:
+                        # Raises the IndexError of the diameter selection.
+                        selection = zmod_costs.select_diameters(flows, zmod_greedy.speed_levels[level], max_speed)
+                    graph = nx.Graph(improved)
+                    zmod_costs.set_diameter_attributes(graph, flows, selection)
+                    graph.remove_nodes_from(list(nx.isolates(graph)))
+                    return graph
+
+                def simulate(level):
+                    graph = level_graph(level)
+                    return graph, zmod_epanet.compute_epanet(graph, t_capacity, origin)
+
+                level, simulation = zmod_greedy.staged_evaluation(costs, simulate, b)
+                cost = costs[level]
+                if simulation is not None:
+                    test_graph, (node_data, link_data, result_data) = simulation
+                elif selections[level] is not None:
+                    # Rejected on budget: the network of the level is still built (the last one sets the diameters of
+                    # the result), without simulating it.
+                    test_graph = level_graph(level)
                 
                 n_can += 1
                 if cost < b:
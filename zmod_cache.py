@@ -0,0 +1,149 @@
+########################################################################################################
+########################################################################################################
+################################### PRECOMPUTE CACHE ###################################################
+########################################################################################################
+########################################################################################################
+
+import hashlib
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+
+def graph_fingerprint(G, weight='length', consumption=True):
+    """
+    Returns a content hash of a street graph: node ids (in graph order), edge weights and, optionally, node consumptions.
+    Two graphs with the same fingerprint give the same precomputed tables, in the same node order.
+
+    Args:
+        G (nx undirected graph): city street graph.
+        weight (string): edge attribute hashed as edge length.
+        consumption (bool): if true, the 'consumption' node attribute is hashed too.
+    Returns:
+        fingerprint (string): hex digest.
+    """
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    h = hashlib.sha256()
+    h.update(repr(nodes).encode())
+
+    # Edges in canonical order, so that the insertion order of the edges does not matter.
+    edges = np.array([(min(index[u], index[v]), max(index[u], index[v]), w) for u, v, w in G.edges(data=weight, default=1)], dtype=np.float64).reshape(-1, 3)
+    edges = edges[np.lexsort((edges[:,1], edges[:,0]))]
+    h.update(edges.tobytes())
+
+    if consumption:
+        h.update(np.array([data["consumption"] for _, data in G.nodes(data=True)], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def array_fingerprint(array):
+    """
+    Returns a short content hash of a numpy array (e.g. the node consumptions or the source rows).
+
+    Args:
+        array (numpy array): array to hash.
+    Returns:
+        fingerprint (string): hex digest.
+    """
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()[:16]
+
+def load_arrays(cache_dir, key, names):
+    """
+    Opens cached arrays as read only memory maps, so that several processes share one page cached copy.
+
+    Args:
+        cache_dir (string): cache root directory.
+        key (string): cache entry (see 'graph_fingerprint').
+        names (list): names of the arrays to open.
+    Returns:
+        arrays (dict): Dict keyed by name with the memory mapped arrays, or None if the entry is missing or incomplete.
+    """
+    entry = os.path.join(cache_dir, key)
+    paths = [os.path.join(entry, name + ".npy") for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    return {name: np.load(path, mmap_mode='r') for name, path in zip(names, paths)}
+
+def save_arrays(cache_dir, key, arrays):
+    """
+    Stores arrays as .npy files of a cache entry. The entry is written in a temporary directory and renamed when complete,
+    so a concurrent reader never sees half of it.
+
+    Args:
+        cache_dir (string): cache root directory.
+        key (string): cache entry (see 'graph_fingerprint').
+        arrays (dict): Dict keyed by name with the numpy arrays to store.
+    """
+    entry = os.path.join(cache_dir, key)
+    tmp_entry = entry + ".tmp" + str(os.getpid())
+    os.makedirs(tmp_entry, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_entry, name + ".npy"), array)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another process stored the same entry first.
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+def create_arrays(cache_dir, key, shapes):
+    """
+    Creates the .npy files of a cache entry as writable memory maps, to fill arrays that do not fit in memory.
+    The files live in a temporary directory until 'commit_arrays' is called.
+
+    Args:
+        cache_dir (string): cache root directory.
+        key (string): cache entry (see 'graph_fingerprint').
+        shapes (dict): Dict keyed by name with (shape, dtype) tuples.
+    Returns:
+        tmp_entry (string): temporary directory of the entry.
+        arrays (dict): Dict keyed by name with the writable memory maps.
+    """
+    tmp_entry = os.path.join(cache_dir, key) + ".tmp" + str(os.getpid())
+    os.makedirs(tmp_entry, exist_ok=True)
+    arrays = {name: np.lib.format.open_memmap(os.path.join(tmp_entry, name + ".npy"), mode='w+', dtype=dtype, shape=shape) for name, (shape, dtype) in shapes.items()}
+    return tmp_entry, arrays
+
+def commit_arrays(cache_dir, key, tmp_entry, arrays):
+    """
+    Flushes the memory maps created by 'create_arrays' and publishes the entry, then reopens it read only.
+
+    Args:
+        cache_dir (string): cache root directory.
+        key (string): cache entry (see 'graph_fingerprint').
+        tmp_entry (string): temporary directory returned by 'create_arrays'.
+        arrays (dict): Dict keyed by name with the memory maps returned by 'create_arrays'.
+    Returns:
+        arrays (dict): Dict keyed by name with the read only memory maps of the entry.
+    """
+    names = list(arrays)
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    try:
+        os.rename(tmp_entry, os.path.join(cache_dir, key))
+    except OSError:
+        # Another process stored the same entry first.
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    return load_arrays(cache_dir, key, names)
+
+class TemporaryCache:
+    """
+    Temporary cache directory, removed with its files once the object is no longer referenced (e.g. when the
+    precomputed data that keeps it is dropped). Pickled copies (e.g. sent to a pool of processes) unpickle as the path
+    of the directory, so only the process that created it removes it.
+
+    Args:
+        prefix (string): prefix of the directory name.
+    """
+
+    def __init__(self, prefix="precompute-"):
+        self.path = tempfile.mkdtemp(prefix=prefix)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def __reduce__(self):
+        return (str, (self.path,))
+
+    def cleanup(self):
+        # Removes the directory now.
+        self._finalizer()
@@ -0,0 +1,153 @@
+########################################################################################################
+########################################################################################################
+################################### RESULT CHECKS ######################################################
+########################################################################################################
+########################################################################################################
+
+# Verification script: checks that the budget sweep and the parallel candidate evaluation give the same designs as
+# running the algorithms one budget at a time, one candidate at a time, and that the chain contraction of the 'reduce'
+# option keeps the shortest path lengths and expands the designs to streets of the original graph. Run as:
+#   python zmod_checks.py pickles/girona_usages.pkl <origin> <budget> [<budget> ...] [--workers N]
+
+import argparse
+import math
+import pickle
+import sys
+import networkx as nx
+
+import zmod_algorithms
+import zmod_reduction
+
+def same_result(result_a, result_b):
+    """
+    Returns True if two results of an algorithm (G_new, result_data and, for the hydraulic ones, the EPANET results)
+    have the same network (nodes, edges and their attributes), the same results (execution time aside) and the same
+    EPANET results.
+    """
+    def summary(result):
+        G_new_full, result_data = result[0], result[1]
+        nodes = dict(G_new_full.nodes(data=True))
+        edges = {frozenset((u,v)): data for u,v,data in G_new_full.edges(data=True)}
+        data = {key: value for key, value in result_data.items() if key != "execution_time"}
+        return (nodes, edges, data) + tuple(result[2:])
+    return summary(result_a) == summary(result_b)
+
+def check_sweep(algorithm, G, budgets, origin, precomputed_data, workers=1):
+    """
+    Checks that 'zmod_algorithms.sweep' gives the same results as the algorithm run once per budget.
+
+    Args:
+        algorithm (function): one of the presets of 'zmod_algorithms.sweep'.
+        G (nx undirected graph): original graph. Each run gets its own copy.
+        budgets (list): maximum costs (in €).
+        origin (int): Origin node of the reuse network graph. Must be a node in G.
+        precomputed_data (object): see "zmod_algorithms.precompute_data_lb_algorithms".
+        workers (int): processes of the sweep.
+    Returns:
+        different (list): budgets whose results differ, empty if the check passes.
+    """
+    results = zmod_algorithms.sweep(algorithm, nx.Graph(G), budgets, origin, precomputed_data, workers=workers)
+    different = []
+    for b in sorted(results):
+        if not same_result(results[b], algorithm(nx.Graph(G), b, origin, precomputed_data)):
+            different.append(b)
+    return different
+
+def check_parallel(algorithm, G, budgets, origin, precomputed_data, parallel_candidates=2):
+    """
+    Checks that a hydraulic algorithm gives the same results evaluating the candidates at the same time in a pool of
+    processes as evaluating them one at a time.
+
+    Args:
+        algorithm (function): 'zmod_algorithms.lb_algorithm_v1_efficient_hydro' or
+            'zmod_algorithms.lbr_algorithm_hydraulic'.
+        G, budgets, origin, precomputed_data: see 'check_sweep'.
+        parallel_candidates (int): candidates evaluated at the same time in the parallel runs.
+    Returns:
+        different (list): budgets whose results differ, empty if the check passes.
+    """
+    different = []
+    for b in sorted(set(budgets)):
+        sequential = algorithm(nx.Graph(G), b, origin, precomputed_data)
+        parallel = algorithm(nx.Graph(G), b, origin, precomputed_data, parallel_candidates=parallel_candidates)
+        if not same_result(sequential, parallel):
+            different.append(b)
+    return different
+
+def check_reduction_lengths(G, origin):
+    """
+    Checks that the shortest path lengths between the nodes kept by 'zmod_reduction.contract_chains' are the same in
+    the reduced graph as in G.
+
+    Args:
+        G (nx undirected graph): original graph.
+        origin (int): Origin node of the reuse network graph, kept by the contraction.
+    Returns:
+        different (list): (u,v) pairs of kept nodes whose lengths differ, empty if the check passes.
+    """
+    G_reduced = zmod_reduction.contract_chains(G, keep=[origin])
+    different = []
+    for u in G_reduced.nodes():
+        lengths = nx.single_source_dijkstra_path_length(G, u, weight="length")
+        reduced_lengths = nx.single_source_dijkstra_path_length(G_reduced, u, weight="length")
+        for v in G_reduced.nodes():
+            if v not in reduced_lengths or not math.isclose(lengths[v], reduced_lengths[v]):
+                different.append((u, v))
+    return different
+
+def check_reduction_edges(algorithm, G, budgets, origin, precomputed_data):
+    """
+    Checks that the networks returned by an algorithm with 'reduce' (and the links of its EPANET results, for the
+    hydraulic ones) only have edges of the original graph.
+
+    Args:
+        algorithm (function): one of the presets of 'zmod_algorithms.sweep'.
+        G, budgets, origin: see 'check_sweep'.
+        precomputed_data (object): see "zmod_algorithms.precompute_data_lb_algorithms", with 'reduce'.
+    Returns:
+        different (list): budgets whose results have edges that are not in G, empty if the check passes.
+    """
+    different = []
+    for b in sorted(set(budgets)):
+        result = algorithm(nx.Graph(G), b, origin, precomputed_data, reduce=True)
+        edges = list(result[0].edges())
+        if len(result) > 2 and result[2] is not None and isinstance(result[2]["link_data"], dict):
+            edges += list(result[2]["link_data"])
+        if any(not G.has_edge(u, v) for u, v in edges):
+            different.append(b)
+    return different
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks the budget sweep and the parallel evaluation of the algorithms.")
+    parser.add_argument("graph", help="pickle of the street graph with its consumptions")
+    parser.add_argument("origin", type=int, help="origin node (WWTP)")
+    parser.add_argument("budgets", type=int, nargs="+", help="budgets (in €)")
+    parser.add_argument("--workers", type=int, default=2, help="processes of the sweep and the parallel runs")
+    args = parser.parse_args(argv)
+
+    with open(args.graph, "rb") as f:
+        G = nx.Graph(pickle.load(f))
+    precomputed_data = zmod_algorithms.precompute_data_lb_algorithms(nx.Graph(G))
+    algorithms = [zmod_algorithms.lb_algorithm_v2, zmod_algorithms.lb_algorithm_v1_efficient_hydro, zmod_algorithms.lbr_algorithm_old, zmod_algorithms.lbr_algorithm_hydraulic]
+    failed = False
+    for algorithm in algorithms:
+        different = check_sweep(algorithm, G, args.budgets, args.origin, precomputed_data, workers=args.workers)
+        print(algorithm.__name__, "sweep:", "OK" if len(different) == 0 else "different budgets " + str(different))
+        failed = failed or len(different) > 0
+        if algorithm in (zmod_algorithms.lb_algorithm_v1_efficient_hydro, zmod_algorithms.lbr_algorithm_hydraulic):
+            different = check_parallel(algorithm, G, args.budgets, args.origin, precomputed_data, parallel_candidates=args.workers)
+            print(algorithm.__name__, "parallel:", "OK" if len(different) == 0 else "different budgets " + str(different))
+            failed = failed or len(different) > 0
+
+    different = check_reduction_lengths(G, args.origin)
+    print("reduction lengths:", "OK" if len(different) == 0 else str(len(different)) + " different pairs")
+    failed = failed or len(different) > 0
+    reduced_data = zmod_algorithms.precompute_data_lb_algorithms(nx.Graph(G), origin=args.origin, reduce=True)
+    for algorithm in [zmod_algorithms.lb_algorithm_v2, zmod_algorithms.lbr_algorithm_hydraulic]:
+        different = check_reduction_edges(algorithm, G, args.budgets, args.origin, reduced_data)
+        print(algorithm.__name__, "reduction:", "OK" if len(different) == 0 else "different budgets " + str(different))
+        failed = failed or len(different) > 0
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
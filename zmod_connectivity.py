@@ -0,0 +1,61 @@
+########################################################################################################
+########################################################################################################
+################################### CONNECTIVITY #######################################################
+########################################################################################################
+########################################################################################################
+
+import networkx as nx
+from collections import OrderedDict
+
+import zmod_cache
+
+# Bridge indexes by graph fingerprint (see 'bridge_index'), the least recently used ones evicted beyond
+# 'max_bridge_indexes'.
+_bridge_indexes = OrderedDict()
+max_bridge_indexes = 8
+
+def bridge_index(G):
+    """
+    Returns the bridges (edges whose removal disconnects the graph) and the 2-edge-connected components of G, computed in
+    linear time by chain decomposition (nx.bridges) instead of removing each edge and checking the connectivity.
+    The index is cached by graph fingerprint, so the algorithms and the plots of the same graph compute it once. Only
+    the last 'max_bridge_indexes' graphs are kept. Hashing the graph is linear too, so callers that look up the index
+    of the same graph many times keep it instead (as the second path strategies do).
+
+    Args:
+        G (nx undirected graph): graph (e.g. the city street graph or a resulting network).
+    Returns:
+        index (dict): Data structure with:
+            "connected" (bool): True if G is connected.
+            "bridges" (set): bridges of G, both as (u,v) and (v,u).
+            "components" (dict): Dict keyed by node with the number of its 2-edge-connected component.
+    """
+    key = zmod_cache.graph_fingerprint(G, consumption=False)
+    index = _bridge_indexes.get(key)
+    if index is not None:
+        _bridge_indexes.move_to_end(key)
+        return index
+
+    bridges = set()
+    for u,v in nx.bridges(G):
+        bridges.add((u,v))
+        bridges.add((v,u))
+    # The 2-edge-connected components are the connected components left when the bridges are removed.
+    G_no_bridges = nx.restricted_view(G, [], bridges)
+    components = {}
+    for i, component in enumerate(nx.connected_components(G_no_bridges)):
+        for node in component:
+            components[node] = i
+    index = {
+        "connected": G.number_of_nodes() > 0 and nx.is_connected(G),
+        "bridges": bridges,
+        "components": components
+    }
+    _bridge_indexes[key] = index
+    if len(_bridge_indexes) > max_bridge_indexes:
+        _bridge_indexes.popitem(last=False)
+    return index
+
+def is_critical(index, u, v):
+    # True if removing the edge u-v disconnects the graph of 'index'. In a disconnected graph, every edge does.
+    return not index["connected"] or (u,v) in index["bridges"]
@@ -5,9 +5,16 @@
 ########################################################################################################
 
 import networkx as nx
+from networkx.algorithms.flow import preflow_push
 import numpy as np
 from collections import deque
+import heapq
 import math
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order, maximum_flow
+
+import zmod_network
+import zmod_shortest_paths
 
 # Cost ranges: Diameters
 diameters = [32,63,75,90,110,125,140,160,180,200,225,250,315,400,450,560,630]
@@ -113,9 +120,10 @@ def tank_cost(full_consumption):
     cost = tanks_costs[capacity]
     return cost, capacity
 
-def get_construction_costs(G, origin, cons_nodes, total_cons, precomputed_data):
+def get_construction_costs(G, origin, cons_nodes, total_cons, precomputed_data, backend="scipy"):
     """
     Given a current reclaimed network under design process, check how much will cost to build it.
+    G is not modified, so it can be the network under design itself.
         
     Args:
         G (nx undirected graph): graph under design.
@@ -124,34 +132,39 @@ def get_construction_costs(G, origin, cons_nodes, total_cons, precomputed_data):
         total_cons (double): total consumption of m3/day of the network G.
         precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
             Check func "precompute_data_lb_algorithms" for more info.
+        backend (string): maximum flow implementation:
+            "scipy": scipy.sparse.csgraph.maximum_flow on a CSR capacity matrix (see 'max_flows').
+            "networkx": networkx 'preflow_push' on a copy of G with the super nodes.
+            Maximum flows are not unique, so the two may give different flows (and costs).
     Returns:
         cost (double): Cost in Euros € to build G.
     """
     
     # First, build the flow network. For more info: https://www.cs.umd.edu/class/fall2017/cmsc451-0101/Lects/lect17-flow-circ.pdf
-    
-    # Create artificial super nodes of origin and destination of flow for reducing demand circulation problem to well-known max flow.
-    super_node_origin = 99999999999999
-    super_node_dest = 999999999999999
-    G.add_edge(super_node_origin, origin, capacity=total_cons)
-    for node in cons_nodes:
-        G.add_edge(node, super_node_dest, capacity=precomputed_data["n_cons"][node])
-    # From networkx library, 'preflow_push' seems the most efficient algorithm for maximum flows with O(n^2 x sqrt(e)), for n nodes and e edges.
-    residual_network = preflow_push(G, super_node_origin, super_node_dest)
-    flows = nx.get_edge_attributes(residual_network,'flow')
-    G.remove_node(super_node_origin)
-    G.remove_node(super_node_dest)
+    if backend == "scipy":
+        edges, edge_flows = max_flows(G, origin, cons_nodes, total_cons, precomputed_data)
+        flows = dict(zip(edges, edge_flows.tolist()))
+    elif backend == "networkx":
+        # Create artificial super nodes of origin and destination of flow for reducing demand circulation problem to well-known max flow.
+        super_node_origin = 99999999999999
+        super_node_dest = 999999999999999
+        flow_network = nx.Graph(G)
+        flow_network.add_edge(super_node_origin, origin, capacity=total_cons)
+        for node in cons_nodes:
+            flow_network.add_edge(node, super_node_dest, capacity=precomputed_data["n_cons"][node])
+        # From networkx library, 'preflow_push' seems the most efficient algorithm for maximum flows with O(n^2 x sqrt(e)), for n nodes and e edges.
+        residual_network = preflow_push(flow_network, super_node_origin, super_node_dest)
+        flows = nx.get_edge_attributes(residual_network,'flow')
+    else:
+        raise ValueError("Unknown max flow backend: %s" % backend)
     
     # 'flows' contains the computed flows, get diameters and costs from that.
     # In the 'diameters_dict' store each pipe diameter both for u,v and v,u, as it is a bidirectional graph.
     cost = 0
     diameters_dict = {} 
     for u,v,data in G.edges(data=True):
-        print("*************")
-        print(u,v)
-        print("Flows:",flows[(u,v)])
-        print("Diameter:",int(math.sqrt(abs(flows[(u,v)])/24/3600*4/math.pi)*1000))
-        index_diameter = np.searchsorted(diameters, int(math.sqrt(abs(flows[(u,v)])/24/3600*4/math.pi)*1000))
+        # Self-loops carry no flow.
+        index_diameter = np.searchsorted(diameters, int(math.sqrt(abs(flows.get((u,v), 0))/24/3600*4/math.pi)*1000))
         diameter = diameters[index_diameter]
         cost += (costs_diameter[diameter]*precomputed_data['edge_lengths'][(u,v)])
         diameters_dict[(u,v)] = diameter
@@ -170,12 +183,59 @@ def get_construction_costs(G, origin, cons_nodes, total_cons, precomputed_data):
             valve_diam = valve_diameter[index_valve_diam]
             cost += valve_costs[valve_diam]
             
-    print(diameters_dict)
-            
     # Finally return the cost with the necessary water tank.
     t_cost,t_capacity = tank_cost(total_cons)
     return cost + t_cost, diameters_dict, t_capacity
 
+def max_flows(G, origin, cons_nodes, total_cons, precomputed_data, scale=1000):
+    """
+    Flows of the flow network of 'get_construction_costs': 'total_cons' enters at the origin, each consumption node
+    takes up to its consumption, and the edges of G have no capacity limit. Solved by scipy's maximum_flow on a CSR
+    capacity matrix of the nodes with edges plus a super source and a super sink, without modifying G (so concurrent
+    evaluations can share it).
+    Capacities must be integers: they are the consumptions times 'scale' (lowered if needed to fit in int32), so the
+    flows are multiples of 1/scale m3/day. An edge is unbounded with a capacity above the total supply.
+
+    Args:
+        G (nx undirected graph): graph under design.
+        origin (int): node of origin of the water.
+        cons_nodes (int set): consumption nodes.
+        total_cons (double): total consumption of m3/day, supplied at the origin.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "precompute_data_lb_algorithms" for more info.
+        scale (int): capacity units per m3/day.
+    Returns:
+        edges (list): edges of G, in G.edges() order.
+        flows (np.array): flow of each edge of 'edges', positive from u to v and negative from v to u.
+    """
+    edges = list(G.edges())
+    index = {}
+    rows = []
+    cols = []
+    for u,v in edges:
+        rows.append(index.setdefault(u, len(index)))
+        cols.append(index.setdefault(v, len(index)))
+    for node in [origin] + list(cons_nodes):
+        index.setdefault(node, len(index))
+    source, sink = len(index), len(index)+1
+    consumptions = np.array([precomputed_data["n_cons"][node] for node in cons_nodes], dtype=float)
+    supply = max(total_cons, consumptions.sum())
+    scale = min(scale, (np.iinfo(np.int32).max - 1)/max(supply, 1))
+    unbounded = int(supply*scale) + 1
+
+    # Both directions of each edge (self-loops carry no flow), the source edge and the consumption edges.
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    loops = rows == cols
+    heads = np.concatenate((rows[~loops], cols[~loops], [source], [index[node] for node in cons_nodes]))
+    tails = np.concatenate((cols[~loops], rows[~loops], [index[origin]], np.full(len(consumptions), sink)))
+    capacities = np.concatenate((np.full(2*np.count_nonzero(~loops), unbounded), [round(total_cons*scale)], np.round(consumptions*scale)))
+    capacity_matrix = sp.csr_matrix((capacities.astype(np.int32), (heads.astype(np.int32), tails.astype(np.int32))), shape=(sink+1, sink+1))
+    flow = maximum_flow(capacity_matrix, source, sink).flow
+    flows = np.zeros(len(edges))
+    flows[~loops] = np.asarray(flow[rows[~loops], cols[~loops]]).ravel()/scale
+    return edges, flows
+
 # Consumption aggregation.
 def get_construction_costs_v2(G, origin, cons_nodes, total_cons, precomputed_data):
     """
@@ -193,54 +253,10 @@ def get_construction_costs_v2(G, origin, cons_nodes, total_cons, precomputed_dat
     """
 
     # Flow network not working as desired. Try to switch strategy to consumption aggregation through simple paths.
-    flows = {}
-    for node in cons_nodes:
-        G_new = nx.Graph(G)
-        end = False
-        shortest_path = precomputed_data["shortest_paths"][node][origin]
-        while not end:
-            edges = []
-            for v, w in zmod_pairwise.pairwise(shortest_path):
-                edges.append((v,w))
-                if (v,w) not in flows:
-                    if (w,v) in flows:
-                        flows[(w,v)] += precomputed_data["n_cons"][node]
-                    else: 
-                        flows[(v,w)] = precomputed_data["n_cons"][node]
-                else:
-                    flows[(v,w)] += precomputed_data["n_cons"][node]
-            G_new.remove_edges_from(edges)
-            try:
-                shortest_path = nx.shortest_path(G_new, node, origin, weight='length')
-            except nx.NetworkXNoPath:
-                end = True
-                pass
+    flows = aggregation_flows(G, origin, cons_nodes, precomputed_data)
 
     # Check for empty flows.
-    check_again = True
-    while check_again:
-        check_again = False
-        for u,v in G.edges():
-            if (u,v) not in flows and (v,u) not in flows:
-                # Try to interpolate flows. Check for adjacent edges and get the max value.
-                adj_flows = []
-                for n in G.neighbors(u):
-                    if n != v:
-                        if (u,n) in flows:
-                            adj_flows.append(flows[(u,n)])
-                        elif (n,u) in flows:
-                            adj_flows.append(flows[(n,u)])
-                for n in G.neighbors(v):
-                    if n != u:
-                        if (v,n) in flows:
-                            adj_flows.append(flows[(v,n)])
-                        elif (n,v) in flows:
-                            adj_flows.append(flows[(n,v)])
-                if not adj_flows:
-                    check_again = True
-                else:
-                    max_value = max(adj_flows)
-                    flows[(u,v)] = max_value
+    interpolate_flows(G, flows)
             
     # 'flows' contains the computed flows, get diameters and costs from that.
     # In the 'diameters_dict' store each pipe diameter both for u,v and v,u, as it is a bidirectional graph.
@@ -274,6 +290,12 @@ def get_construction_costs_v2(G, origin, cons_nodes, total_cons, precomputed_dat
     t_cost,t_capacity = tank_cost(total_cons)
     return cost + t_cost, diameters_dict, t_capacity
 
+def copy_network(graph):
+    # Copy of an evaluated network. A 'zmod_network.NetworkOverlay' materialises only its nodes with edges.
+    if isinstance(graph, zmod_network.NetworkOverlay):
+        return graph.to_graph()
+    return nx.Graph(graph)
+
 # This algorithm returns a BFS ordered nodes prioritized by distance.
 def bfs_distance_nodes(graph, source, precomputed_data):
     visited = set()
@@ -298,122 +320,626 @@ def bfs_distance_nodes(graph, source, precomputed_data):
 def diameter_selection_and_cost_v2(graph, wwtp, precomputed_data, total_cons, speed_min = 0.4, speed_max = 1):
     # Compute diameter, predict flow trough the 'bfs_distance_nodes' algorithm and try to have a speed >= speed_min 
     #  (often considered as 0.6 and 1.2 for max_speed).
-    visited = set()
-    accum_flows = {}
-    attrs = {}
-    cost = 0
-    bfs_ordered_nodes = sorted(bfs_distance_nodes(graph, wwtp, precomputed_data), key=lambda x: x[1], reverse = True)
-    for node,distance in bfs_ordered_nodes:
-        visited.add(node)
-        if node not in accum_flows:
-            accum_flows[node] = 0
-        n_sources = 0
-        degree = 0
-        visited_neighbors = set()
-        for neighbor in graph.neighbors(node):
-            degree += 1
-            if neighbor not in visited:
-                n_sources += 1
-            else:
-                visited_neighbors.add(neighbor)
-        # If len(visited_neighbors) > 2, then put a valve in those pipes.
-        for neighbor in graph.neighbors(node):
-            if neighbor not in visited:
-                flow = (graph.nodes[node]['consumption'] + accum_flows[node])/n_sources
-                if neighbor not in accum_flows:
-                    accum_flows[neighbor] = flow
-                else:
-                     accum_flows[neighbor] += flow
-                # Diameter selection.
-                index_diameter = 0
-                prev_speed = float('inf')
-                for diam in diameters:    
-                    speed = (4*flow/86400)/(math.pi*((diam/1000)**2))
-                    if speed <= speed_min and prev_speed <= speed_max:
-                        index_diameter -= 1
-                        break
-                    elif speed <= speed_min:
-                        break
-                    prev_speed = speed
-                    index_diameter += 1
-                diameter = diameters[index_diameter]
-                attrs[(node,neighbor)] = {"length": precomputed_data['edge_lengths'][(node,neighbor)], "flow": flow, "diameter": diameter}
-                cost += (costs_diameter[diameter]*precomputed_data['edge_lengths'][(node,neighbor)])
-            elif (node,neighbor) in attrs:
-                valve_candidate = (node,neighbor)
-            else:
-                valve_candidate = (neighbor,node)
-            if len(visited_neighbors) > 1 and neighbor in visited_neighbors:
-                index_valve_diam = np.searchsorted(valve_diameter, attrs[valve_candidate]["diameter"])
-                valve_diam = valve_diameter[index_valve_diam]
-                cost += valve_costs[valve_diam]
-                attrs[valve_candidate]["valve"] = valve_diam
-            
-    nx.set_edge_attributes(graph, attrs)
+    # Each node splits its consumption plus the flow it receives between its neighbors closer to the origin, from the
+    #  farthest node to the origin (see 'diameter_flows', which does it on arrays).
+    flows = diameter_flows(graph, wwtp, precomputed_data)
+    selection = select_diameters(flows, speed_min, speed_max)
+    set_diameter_attributes(graph, flows, selection)
     t_cost,t_capacity = tank_cost(total_cons)
-    return nx.Graph(graph), cost+t_cost, t_capacity
+    return copy_network(graph), selection["cost"]+t_cost, t_capacity
 
 # Same as before, but some diameters are already fixed in 'graph'.
 def diameter_selection_and_cost_v2_improvement(graph, wwtp, precomputed_data, total_cons, speed_min = 0.4, speed_max = 1):
     # Compute diameter, predict flow trough the 'bfs_distance_nodes' algorithm and try to have a speed >= speed_min 
     #  (often considered as 0.6 and 1.2 for max_speed).
-    visited = set()
-    accum_flows = {}
+    # Only the pipes without a preset diameter are priced (and marked as "newpipe"), the valves are always priced.
+    flows = diameter_flows(graph, wwtp, precomputed_data, consumption=precomputed_data['n_cons'], presets=True)
+    selection = select_diameters(flows, speed_min, speed_max)
+    set_diameter_attributes(graph, flows, selection)
+    t_cost,t_capacity = tank_cost(total_cons)
+    return copy_network(graph), selection["cost"], t_capacity
+
+########################################################################################################
+################################### ARRAY DIAMETER SELECTION ###########################################
+########################################################################################################
+
+# Pipe section (m2), cost per meter and valve of each diameter of 'diameters', in the same order.
+diameter_sections = np.array([math.pi*((diam/1000)**2) for diam in diameters])
+diameter_costs = np.array([costs_diameter[diam] for diam in diameters])
+valve_diameters = np.array(valve_diameter)
+valve_diameter_costs = np.array([valve_costs[diam] for diam in valve_diameter])
+
+def component_adjacency(graph, source):
+    """
+    Nodes of the component of 'source' with their neighbors in the order of 'graph', read from its adjacency dicts
+    (which a 'zmod_network.NetworkOverlay' also has), so only the component is visited.
+
+    Returns:
+        nodes (list): nodes of the component, 'source' first.
+        index (dict): Dict keyed by node with its position in 'nodes'.
+        neighbors (list): neighbors of each node of 'nodes'.
+    """
+    adjacency = graph._adj
+    nodes = [source]
+    index = {source: 0}
+    neighbors = []
+    for node in nodes:
+        row = list(adjacency[node])
+        neighbors.append(row)
+        for neighbor in row:
+            if neighbor not in index:
+                index[neighbor] = len(nodes)
+                nodes.append(neighbor)
+    return nodes, index, neighbors
+
+def diameter_flows(graph, wwtp, precomputed_data, consumption=None, presets=False):
+    """
+    Flows of the diameter selection of 'diameter_selection_and_cost_v2', computed on CSR adjacency arrays of the
+    component of 'wwtp': one BFS (neighbors by edge length, as 'bfs_distance_nodes') gives the processing order
+    (farthest first), the direction of each entry is set at once from the processing positions, and the flows are
+    accumulated towards the origin in a single pass over plain lists. Sums are done in the same order as the loop of
+    'diameter_selection_and_cost_v2' did, so flows and costs are the same.
+    The flows do not depend on the speeds, so they can be priced at several speeds (see 'select_diameters').
+
+    Args:
+        graph (nx undirected graph): network under design.
+        wwtp (int): origin node of the water.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "precompute_data_lb_algorithms" for more info.
+        consumption (dict): consumption of each node. If not given, the "consumption" node attribute of 'graph'.
+        presets (bool): if true, the "diameter" edge attributes already in 'graph' are kept (see 
+            'diameter_selection_and_cost_v2_improvement').
+    Returns:
+        flows (dict): Data structure with:
+            "nodes" (list): nodes of the component of 'wwtp'.
+            "rows", "columns" (np.array): indices in "nodes" of the two ends of each adjacency entry (both directions of
+                each edge), in processing order of the row and then in neighbor order.
+            "lengths" (np.array): length of each entry.
+            "up" (np.array): True for the entries that carry flow (to a neighbor processed later, closer to the origin).
+            "flow" (np.array): flow of each entry (0 if not 'up').
+            "valve" (np.array): True for the entries that get a valve (from a node with more than one downstream
+                neighbor), priced with the diameter of the opposite entry.
+            "opposite" (np.array): position of the opposite entry of each entry.
+            "preset" (np.array): preset diameter of each entry (0 if none), None if 'presets' is false.
+    """
+    lengths = precomputed_data['edge_lengths']
+    # CSR adjacency of the component.
+    adjacency = graph._adj
+    nodes, index, neighbors = component_adjacency(graph, wwtp)
+    n = len(nodes)
+    heads = [neighbor for row in neighbors for neighbor in row]
+    degree = np.fromiter(map(len, neighbors), dtype=np.int64, count=n)
+    indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(degree, out=indptr[1:])
+    rows = np.repeat(np.arange(n), degree)
+    columns = np.fromiter(map(index.__getitem__, heads), dtype=np.int64, count=len(heads))
+    weights = np.fromiter((lengths[(nodes[u],v)] for u, v in zip(rows.tolist(), heads)), dtype=float, count=len(heads))
+
+    # BFS from the origin visiting the neighbors of each node by edge length (a stable sort keeps the order of 'graph'
+    # between equal lengths). The distance of a node is the one through its BFS parent.
+    bfs_graph = sp.csr_matrix((np.ones(len(heads)), columns[np.lexsort((weights, rows))], indptr), shape=(n, n))
+    order, parents = breadth_first_order(bfs_graph, 0, directed=True, return_predecessors=True)
+    tree = parents[columns] == rows
+    parent_lengths = np.zeros(n)
+    parent_lengths[columns[tree]] = weights[tree]
+    distances = [0]*n
+    for node, parent, length in zip(order[1:].tolist(), parents[order[1:]].tolist(), parent_lengths[order[1:]].tolist()):
+        distances[node] = distances[parent] + length
+    # Farthest nodes first, BFS order between equal distances.
+    processing = order[np.argsort(-np.array(distances)[order], kind='stable')]
+    position = np.empty(n, dtype=np.int64)
+    position[processing] = np.arange(n)
+
+    # An entry carries flow if its neighbor is processed later. The entries are reordered by processing order of
+    # their row (the order of the loop), keeping the neighbor order.
+    entries = np.argsort(position[rows], kind='stable')
+    rows = rows[entries]
+    columns = columns[entries]
+    weights = weights[entries]
+    up = position[columns] > position[rows]
+    n_up = np.bincount(rows[up], minlength=n)
+    n_down = np.bincount(rows[~up], minlength=n)
+    keys = rows*n + columns
+    sorter = np.argsort(keys)
+    opposite = sorter[np.searchsorted(keys, columns*n + rows, sorter=sorter)]
+
+    # Accumulate the flows from the farthest node to the origin: each node splits its consumption plus the flow it
+    # received between its upstream neighbors. Each node depends on the ones processed before it, so this is a
+    # sequential pass (the received flows are added in processing order of the senders, as before).
+    cons = [graph._node[node]['consumption'] if consumption is None else consumption[node] for node in nodes]
+    flow_entries = np.flatnonzero(up)
+    upstream = columns[flow_entries].tolist()
+    # The flow entries are grouped by sender, in processing order.
+    out_start = np.concatenate(([0], np.cumsum(n_up[processing]))).tolist()
+    n_up = n_up.tolist()
+    node_flows = [0]*n
+    received = [0]*n
+    for i, node in enumerate(processing.tolist()):
+        if n_up[node] > 0:
+            flow = (cons[node] + received[node])/n_up[node]
+            node_flows[node] = flow
+            for neighbor in upstream[out_start[i]:out_start[i+1]]:
+                received[neighbor] += flow
+
+    preset = None
+    if presets:
+        preset = np.zeros(len(rows), dtype=np.int64)
+        for e in flow_entries.tolist():
+            preset[e] = adjacency[nodes[rows[e]]][nodes[columns[e]]].get('diameter', 0)
+    return {
+        "nodes": nodes,
+        "rows": rows,
+        "columns": columns,
+        "lengths": weights,
+        "up": up,
+        "flow": np.where(up, np.array(node_flows, dtype=float)[rows], 0),
+        "valve": ~up & (rows != columns) & (n_down[rows] > 1),
+        "opposite": opposite,
+        "preset": preset
+    }
+
+def select_diameters(flows, speed_min, speed_max):
+    """
+    Selects the diameter of each pipe of 'diameter_flows' at the given speeds, for all the pipes at once: the first
+    diameter with a speed <= speed_min, or the previous one if its speed is <= speed_max (as the loop of
+    'select_diameter'). Then prices the pipes without a preset diameter and the valves, as array products.
+
+    Args:
+        flows (dict): see 'diameter_flows'.
+        speed_min (double), speed_max (double): speed range used to select the diameters.
+    Returns:
+        selection (dict): Data structure with:
+            "diameter" (np.array): diameter of each entry (of the opposite one for the valve entries, 0 for the others).
+            "valve" (np.array): valve diameter of each valve entry (0 for the others).
+            "new" (np.array): True for the entries whose diameter has been selected (not preset).
+            "cost" (double): Cost in Euros € of the new pipes and the valves.
+    """
+    up = flows["up"]
+    new = up.copy()
+    if flows["preset"] is not None:
+        new &= flows["preset"] == 0
+    speeds = (4*flows["flow"][new]/86400)[:,None]/diameter_sections[None,:]
+    slow = speeds <= speed_min
+    # Like the loop, a flow too large for the widest diameter raises IndexError.
+    first = np.where(slow.any(axis=1), slow.argmax(axis=1), len(diameters))
+    previous = speeds[np.arange(len(first)), np.maximum(first-1, 0)]
+    index_diameter = first - ((first > 0) & (previous <= speed_max))
+    diameter = np.zeros(len(up), dtype=np.int64)
+    if flows["preset"] is not None:
+        diameter[up] = flows["preset"][up]
+    diameter[new] = np.array(diameters)[index_diameter]
+    items = np.zeros(len(up))
+    items[new] = diameter_costs[index_diameter]*flows["lengths"][new]
+
+    valve = flows["valve"]
+    diameter[valve] = diameter[flows["opposite"][valve]]
+    index_valve_diam = np.searchsorted(valve_diameters, diameter[valve])
+    valves = np.zeros(len(up), dtype=np.int64)
+    valves[valve] = valve_diameters[index_valve_diam]
+    items[valve] = valve_diameter_costs[index_valve_diam]
+    # Sum in the order of the loop (np.cumsum adds sequentially), so the cost is the same.
+    cost = float(np.cumsum(items)[-1]) if len(items) > 0 else 0
+    return {"diameter": diameter, "valve": valves, "new": new, "cost": cost}
+
+def level_selections(flows, speeds, speed_max):
+    """
+    Selects the diameters of the pipes of 'diameter_flows' at several minimum speeds, from the same flows.
+
+    Args:
+        flows (dict): see 'diameter_flows'.
+        speeds (list): minimum speeds.
+        speed_max (double): maximum speed.
+    Returns:
+        selections (list): selection of each speed (see 'select_diameters'), or None if a flow is too large for the
+            widest diameter at that speed ('select_diameters' raises IndexError).
+    """
+    selections = []
+    for speed_min in speeds:
+        try:
+            selections.append(select_diameters(flows, speed_min, speed_max))
+        except IndexError:
+            selections.append(None)
+    return selections
+
+def set_diameter_attributes(graph, flows, selection):
+    # Sets the "length", "flow" and "diameter" (plus "newpipe" with preset diameters, and "valve") edge attributes of
+    # a selection in 'graph'. Returns them, keyed by edge.
+    nodes = flows["nodes"]
+    rows = flows["rows"].tolist()
+    columns = flows["columns"].tolist()
+    lengths = flows["lengths"].tolist()
+    flow = flows["flow"].tolist()
+    diameter = selection["diameter"].tolist()
+    new = selection["new"].tolist()
     attrs = {}
-    cost = 0
-    bfs_ordered_nodes = sorted(bfs_distance_nodes(graph, wwtp, precomputed_data), key=lambda x: x[1], reverse = True)
-    for node,distance in bfs_ordered_nodes:
-        visited.add(node)
-        if node not in accum_flows:
-            accum_flows[node] = 0
-        n_sources = 0
-        degree = 0
-        visited_neighbors = set()
-        for neighbor in graph.neighbors(node):
-            degree += 1
-            if neighbor not in visited:
-                n_sources += 1
-            else:
-                visited_neighbors.add(neighbor)
-        # If len(visited_neighbors) > 2, then put a valve in those pipes.
-        for neighbor in graph.neighbors(node):
-            if neighbor not in visited:
-                flow = (precomputed_data['n_cons'][node] + accum_flows[node])/n_sources
-                if neighbor not in accum_flows:
-                    accum_flows[neighbor] = flow
-                else:
-                     accum_flows[neighbor] += flow
-                    
-                # Diameter selection. Check if diameter is preset.
-                if 'diameter' in graph[node][neighbor]:
-                    attrs[(node,neighbor)] = {"length": precomputed_data['edge_lengths'][(node,neighbor)], "flow": flow, "diameter": graph[node][neighbor]['diameter']}
-                elif 'diameter' in graph[neighbor][node]:
-                    attrs[(node,neighbor)] = {"length": precomputed_data['edge_lengths'][(node,neighbor)], "flow": flow, "diameter": graph[neighbor][node]['diameter']}
+    for e in np.flatnonzero(flows["up"]).tolist():
+        attrs[(nodes[rows[e]],nodes[columns[e]])] = {"length": lengths[e], "flow": flow[e], "diameter": diameter[e]}
+        if flows["preset"] is not None and new[e]:
+            attrs[(nodes[rows[e]],nodes[columns[e]])]["newpipe"] = True
+    valves = selection["valve"].tolist()
+    for e in np.flatnonzero(flows["valve"]).tolist():
+        attrs[(nodes[columns[e]],nodes[rows[e]])]["valve"] = valves[e]
+    zmod_network.set_edge_attributes(graph, attrs)
+    return attrs
+
+########################################################################################################
+################################### CONSUMPTION AGGREGATION FLOWS ######################################
+########################################################################################################
+
+def aggregation_flows(G, origin, cons_nodes, precomputed_data):
+    """
+    Flows of the consumption aggregation of 'get_construction_costs_v2': the consumption of each node goes through its
+    precomputed shortest path to the origin, and then through each path left once the edges of the previous ones are
+    removed (shortest by "length", 1 for the edges without it), until there is none.
+    The paths of all the nodes are peeled from the same CSR adjacency lists of the component of the origin, with a
+    mask of the removed edges reset for each node, instead of a copy of G per node (see
+    'zmod_shortest_paths.bidirectional_path', which finds the same paths as nx.shortest_path on the copy).
+
+    Args:
+        G (nx undirected graph): graph under design.
+        origin (int): node of origin of the water.
+        cons_nodes (int set): consumption nodes.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "precompute_data_lb_algorithms" for more info.
+    Returns:
+        flows (dict): Dict keyed by edge (in the direction of the first path through it) with its flow.
+    """
+    nodes, index, neighbors = component_adjacency(G, origin)
+    indptr = [0]
+    indices = []
+    weights = []
+    entries = {}
+    for node, row in zip(nodes, neighbors):
+        adjacency = G._adj[node]
+        for neighbor in row:
+            entries[(node,neighbor)] = len(indices)
+            indices.append(index[neighbor])
+            weights.append(adjacency[neighbor].get('length', 1))
+        indptr.append(len(indices))
+    all_edges = bytearray(b'\x01')*len(indices)
+
+    flows = {}
+    for node in cons_nodes:
+        consumption = precomputed_data["n_cons"][node]
+        available = bytearray(all_edges)
+        path = precomputed_data["shortest_paths"][node][origin]
+        while True:
+            for v, w in zip(path, path[1:]):
+                if (v,w) in flows:
+                    flows[(v,w)] += consumption
+                elif (w,v) in flows:
+                    flows[(w,v)] += consumption
                 else:
-                    index_diameter = 0
-                    prev_speed = float('inf')
-                    for diam in diameters:    
-                        speed = (4*flow/86400)/(math.pi*((diam/1000)**2))
-                        if speed <= speed_min and prev_speed <= speed_max:
-                            index_diameter -= 1
-                            break
-                        elif speed <= speed_min:
-                            break
-                        prev_speed = speed
-                        index_diameter += 1
-                    diameter = diameters[index_diameter]
-                    attrs[(node,neighbor)] = {"length": precomputed_data['edge_lengths'][(node,neighbor)], "flow": flow, "diameter": diameter, "newpipe": True}
-                    cost += (costs_diameter[diameter]*precomputed_data['edge_lengths'][(node,neighbor)])
-            elif (node,neighbor) in attrs:
-                valve_candidate = (node,neighbor)
-            else:
-                valve_candidate = (neighbor,node)
-            if len(visited_neighbors) > 1 and neighbor in visited_neighbors:
-                index_valve_diam = np.searchsorted(valve_diameter, attrs[valve_candidate]["diameter"])
-                valve_diam = valve_diameter[index_valve_diam]
-                cost += valve_costs[valve_diam]
-                attrs[valve_candidate]["valve"] = valve_diam
-            
-    nx.set_edge_attributes(graph, attrs)
-    t_cost,t_capacity = tank_cost(total_cons)
-    return nx.Graph(graph), cost, t_capacity
\ No newline at end of file
+                    flows[(v,w)] = consumption
+                if (v,w) in entries:
+                    available[entries[(v,w)]] = 0
+                    available[entries[(w,v)]] = 0
+            # Nodes out of the component of the origin have no path to it. A path without edges (from the origin
+            # itself) would never be removed.
+            if node not in index:
+                break
+            path = zmod_shortest_paths.bidirectional_path(indptr, indices, weights, available, index[node], 0)
+            if len(path) < 2:
+                break
+            path = [nodes[i] for i in path]
+    return flows
+
+def interpolate_flows(G, flows):
+    """
+    Gives each edge of G without flow the largest flow of its adjacent edges, as the passes over G.edges() of
+    'get_construction_costs_v2' did: in each pass, an edge takes the flows known at that moment (set before the pass
+    or by the previous edges of the pass). The passes are replayed with a queue keyed by (pass, position of the edge),
+    so each edge is looked at once after one of its adjacent edges gets a flow. The edges that never get a flow (no
+    flow in their component, where the passes did not end) get 0.
+
+    Args:
+        G (nx undirected graph): graph under design.
+        flows (dict): Dict keyed by edge (in one direction) with its flow. It is updated.
+    """
+    edges = list(G.edges())
+    position = {}
+    for i, (u,v) in enumerate(edges):
+        position[(u,v)] = i
+        position[(v,u)] = i
+    has_flow = lambda u, v: (u,v) in flows or (v,u) in flows
+
+    def adjacent(u, v):
+        # Adjacent edges, in the order the passes looked at them.
+        for n in G.neighbors(u):
+            if n != v:
+                yield u, n
+        for n in G.neighbors(v):
+            if n != u:
+                yield v, n
+
+    queue = [(1, i) for i, (u,v) in enumerate(edges) if not has_flow(u, v) and any(has_flow(a, b) for a, b in adjacent(u, v))]
+    while len(queue) > 0:
+        check, i = heapq.heappop(queue)
+        u, v = edges[i]
+        if has_flow(u, v):
+            continue
+        adj_flows = [flows[(a,b)] if (a,b) in flows else flows[(b,a)] for a, b in adjacent(u, v) if has_flow(a, b)]
+        flows[(u,v)] = max(adj_flows)
+        # An adjacent edge without flow takes it later in this pass, or in the next one if it comes before.
+        for a, b in adjacent(u, v):
+            if not has_flow(a, b):
+                j = position[(a,b)]
+                heapq.heappush(queue, (check if j > i else check+1, j))
+    for u, v in edges:
+        if not has_flow(u, v):
+            flows[(u,v)] = 0
+
+########################################################################################################
+################################### INCREMENTAL DIAMETER SELECTION #####################################
+########################################################################################################
+
+def select_diameter(flow, speed_min, speed_max):
+    # Diameter selection of 'diameter_selection_and_cost_v2' for a pipe with the given flow.
+    index_diameter = 0
+    prev_speed = float('inf')
+    for diam in diameters:    
+        speed = (4*flow/86400)/(math.pi*((diam/1000)**2))
+        if speed <= speed_min and prev_speed <= speed_max:
+            index_diameter -= 1
+            break
+        elif speed <= speed_min:
+            break
+        prev_speed = speed
+        index_diameter += 1
+    return diameters[index_diameter]
+
+class IncrementalDiameterCost:
+    """
+    Incremental version of 'diameter_selection_and_cost_v2' for a network that grows one candidate at a time.
+    It keeps the flow state of the accepted network: for each node its BFS distance, its upstream neighbors (the ones
+    it sends its flow to) and downstream neighbors (the ones it receives flow from, in processing order), and the flow
+    it sends through each upstream pipe. Flows do not depend on the speeds, so a candidate is priced at any speed from
+    the same state.
+    When a candidate only hangs a new path from one node of the network (the usual case without second paths), the
+    distances of the network do not change: the demand of the path is propagated upstream from that node, and only the
+    pipes whose flow changes are priced again. Any other candidate (e.g. one closing a loop) is evaluated from scratch.
+    Both give the same flows and diameters as 'diameter_selection_and_cost_v2' (costs may differ by rounding).
+    Call 'commit' when the candidate is accepted and 'rollback' when it is discarded.
+
+    Args:
+        wwtp (int): origin node of the water.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "precompute_data_lb_algorithms" for more info.
+    """
+
+    def __init__(self, wwtp, precomputed_data):
+        self.wwtp = wwtp
+        self.precomputed_data = precomputed_data
+        self.lengths = precomputed_data['edge_lengths']
+        self.n_cons = precomputed_data['n_cons']
+        # Network with only the origin.
+        self.state = {
+            "dist": {wwtp: 0},
+            "key": {wwtp: (0, 0)},
+            "up": {wwtp: []},
+            "down": {wwtp: []},
+            "out": {}
+        }
+        self.costs = {}
+        self.pending = None
+        self.pending_edges = None
+
+    def evaluate(self, graph, new_edges, total_cons, speed_min = 0.4, speed_max = 1):
+        """
+        Prices the network 'graph' (the accepted network plus the candidate edges 'new_edges').
+
+        Args:
+            graph (nx undirected graph): network under design, with the candidate edges.
+            new_edges (list): edges of the candidate that are not in the accepted network.
+            total_cons (double): consumption used to size the tank (as in 'diameter_selection_and_cost_v2').
+            speed_min (double), speed_max (double): speed range used to select the diameters.
+        Returns:
+            cost (double): Cost in Euros € to build the network, tank included.
+            t_capacity (int): tank capacity.
+        """
+        if self.pending is None or self.pending_edges != new_edges:
+            self.pending_edges = list(new_edges)
+            self.pending = self._extend(new_edges)
+            if self.pending is None:
+                self.pending = self._full_state(graph)
+        t_cost,t_capacity = tank_cost(total_cons)
+        return self._cost(self.pending, speed_min, speed_max) + t_cost, t_capacity
+
+    def graph(self, graph, speed_min = 0.4, speed_max = 1):
+        """
+        Returns the evaluated network (the last candidate, or the accepted network if there is none pending) with the
+        "length", "flow", "diameter" and "valve" edge attributes, like 'diameter_selection_and_cost_v2'.
+        The attributes are also set in 'graph'.
+        """
+        self.set_attributes(graph, speed_min, speed_max)
+        return copy_network(graph)
+
+    def set_attributes(self, graph, speed_min = 0.4, speed_max = 1):
+        # Sets the edge attributes of the 'graph' method in 'graph', without copying it. Returns them, keyed by edge.
+        get = self._getter(self.pending)
+        attrs = {}
+        for node in self._nodes(self.pending):
+            up = get("up", node)
+            if len(up) == 0:
+                continue
+            flow = get("out", node)
+            diameter = select_diameter(flow, speed_min, speed_max)
+            for neighbor in up:
+                attrs[(node,neighbor)] = {"length": self.lengths[(node,neighbor)], "flow": flow, "diameter": diameter}
+                if len(get("down", neighbor)) > 1:
+                    attrs[(node,neighbor)]["valve"] = valve_diameter[np.searchsorted(valve_diameter, diameter)]
+        zmod_network.set_edge_attributes(graph, attrs)
+        return attrs
+
+    def commit(self):
+        # The last evaluated candidate becomes part of the accepted network.
+        if self.pending is None:
+            return
+        if self.pending["full"]:
+            self.state = self.pending["state"]
+            self.costs = self.pending["costs"]
+        else:
+            for speeds in self.costs:
+                self.costs[speeds] = self._cost(self.pending, *speeds)
+            for field, values in self.pending["state"].items():
+                self.state[field].update(values)
+        self.pending = None
+        self.pending_edges = None
+
+    def rollback(self):
+        # The last evaluated candidate is discarded.
+        self.pending = None
+        self.pending_edges = None
+
+    def get_state(self):
+        # Flow state and costs of the accepted network, to price candidates from it in another process.
+        return self.state, self.costs
+
+    def set_state(self, state):
+        # Replaces the accepted network with one returned by 'get_state'. The pending candidate is discarded.
+        self.state, self.costs = state
+        self.rollback()
+
+    def _getter(self, pending):
+        # Field accessor of a pending state: overlay first, then the accepted state.
+        if pending is None:
+            return lambda field, node: self.state[field][node]
+        if pending["full"]:
+            return lambda field, node: pending["state"][field][node]
+        overlay = pending["state"]
+        return lambda field, node: overlay[field][node] if node in overlay[field] else self.state[field][node]
+
+    def _nodes(self, pending):
+        if pending is None or not pending["full"]:
+            nodes = set(self.state["dist"])
+            if pending is not None:
+                nodes.update(pending["state"]["dist"])
+            return nodes
+        return pending["state"]["dist"]
+
+    def _node_cost(self, get, node, speed_min, speed_max):
+        # Cost of the pipes from 'node' to its upstream neighbors, plus their valves.
+        up = get("up", node)
+        if len(up) == 0:
+            return 0
+        diameter = select_diameter(get("out", node), speed_min, speed_max)
+        cost = 0
+        for neighbor in up:
+            cost += costs_diameter[diameter]*self.lengths[(node,neighbor)]
+            if len(get("down", neighbor)) > 1:
+                cost += valve_costs[valve_diameter[np.searchsorted(valve_diameter, diameter)]]
+        return cost
+
+    def _cost(self, pending, speed_min, speed_max):
+        # Pipes and valves cost of the accepted network, plus the changes of a pending candidate.
+        speeds = (speed_min, speed_max)
+        if pending is not None and pending["full"]:
+            if speeds not in pending["costs"]:
+                get = self._getter(pending)
+                pending["costs"][speeds] = sum(self._node_cost(get, node, speed_min, speed_max) for node in pending["state"]["dist"])
+            return pending["costs"][speeds]
+        if speeds not in self.costs:
+            get = self._getter(None)
+            self.costs[speeds] = sum(self._node_cost(get, node, speed_min, speed_max) for node in self.state["dist"])
+        cost = self.costs[speeds]
+        if pending is not None:
+            old = self._getter(None)
+            new = self._getter(pending)
+            for node in pending["affected"]:
+                if node in self.state["dist"]:
+                    cost -= self._node_cost(old, node, speed_min, speed_max)
+                cost += self._node_cost(new, node, speed_min, speed_max)
+        return cost
+
+    def _full_state(self, graph):
+        # Same BFS ordering and flow accumulation as 'diameter_selection_and_cost_v2'.
+        state = {"dist": {}, "key": {}, "up": {}, "down": {}, "out": {}}
+        visited = set()
+        accum_flows = {}
+        bfs_ordered_nodes = sorted(bfs_distance_nodes(graph, self.wwtp, self.precomputed_data), key=lambda x: x[1], reverse = True)
+        for position, (node, distance) in enumerate(bfs_ordered_nodes):
+            visited.add(node)
+            state["dist"][node] = distance
+            state["key"][node] = (-distance, position)
+            up = [neighbor for neighbor in graph.neighbors(node) if neighbor not in visited]
+            state["up"][node] = up
+            state["down"][node] = sorted((neighbor for neighbor in graph.neighbors(node) if neighbor in visited), key=lambda n: state["key"][n])
+            if len(up) > 0:
+                flow = (self.n_cons[node] + accum_flows.get(node, 0))/len(up)
+                state["out"][node] = flow
+                for neighbor in up:
+                    if neighbor not in accum_flows:
+                        accum_flows[neighbor] = flow
+                    else:
+                        accum_flows[neighbor] += flow
+        return {"full": True, "state": state, "costs": {}}
+
+    def _extend(self, new_edges):
+        # Overlay state of a candidate that hangs a simple path from one node of the network, or None if it does not.
+        state = self.state
+        if len(new_edges) == 0:
+            return None
+        adjacency = {}
+        for v, w in new_edges:
+            adjacency.setdefault(v, []).append(w)
+            adjacency.setdefault(w, []).append(v)
+        attached = [node for node in adjacency if node in state["dist"]]
+        if len(attached) != 1 or len(adjacency[attached[0]]) != 1:
+            return None
+        chain = [attached[0]]
+        while len(chain) <= len(new_edges):
+            following = [node for node in adjacency[chain[-1]] if len(chain) < 2 or node != chain[-2]]
+            if len(following) != 1 or following[0] in state["dist"] or following[0] in chain or self.lengths[(chain[-1],following[0])] <= 0:
+                return None
+            chain.append(following[0])
+        if len(adjacency[chain[-1]]) != 1:
+            return None
+
+        a = chain[0]
+        overlay = {"dist": {}, "key": {}, "up": {}, "down": {}, "out": {}}
+        for i in range(1, len(chain)):
+            node = chain[i]
+            overlay["dist"][node] = (overlay["dist"][chain[i-1]] if i > 1 else state["dist"][a]) + self.lengths[(chain[i-1],node)]
+            overlay["key"][node] = (-overlay["dist"][node], state["key"][a][1])
+            overlay["up"][node] = [chain[i-1]]
+            overlay["down"][node] = [chain[i+1]] if i+1 < len(chain) else []
+        # The end of the path sends its consumption upstream, each node adds its own.
+        flow = 0
+        for node in reversed(chain[1:]):
+            flow = self.n_cons[node] + flow
+            overlay["out"][node] = flow
+        # The first node of the path is one more downstream neighbor of 'a'. Its position among them must be unique.
+        first = chain[1]
+        if any(state["dist"][node] == overlay["dist"][first] for node in state["down"][a]):
+            return None
+        overlay["down"][a] = sorted(state["down"][a] + [first], key=lambda n: overlay["key"][n] if n in overlay["key"] else state["key"][n])
+        affected = set(chain)
+        if len(state["down"][a]) == 1:
+            # 'a' gets its first valves, which are priced with the pipes of its downstream neighbors.
+            affected.update(state["down"][a])
+
+        # Propagate the new flows upstream, in processing order, while they change.
+        get = lambda field, node: overlay[field][node] if node in overlay[field] else state[field][node]
+        queue = [(state["key"][a], a)]
+        queued = {a}
+        while len(queue) > 0:
+            _, node = heapq.heappop(queue)
+            up = state["up"][node]
+            if len(up) == 0:
+                continue
+            down = get("down", node)
+            accum = 0
+            if len(down) > 0:
+                accum = get("out", down[0])
+                for neighbor in down[1:]:
+                    accum += get("out", neighbor)
+            flow = (self.n_cons[node] + accum)/len(up)
+            if flow == state["out"][node]:
+                continue
+            overlay["out"][node] = flow
+            affected.add(node)
+            for neighbor in up:
+                if neighbor not in queued:
+                    queued.add(neighbor)
+                    heapq.heappush(queue, (state["key"][neighbor], neighbor))
+        return {"full": False, "state": overlay, "affected": affected}
@@ -1,15 +1,25 @@
 import networkx as nx
+import os
 import subprocess
 import re
 import pandas as pd
 
 import zmod_costs
 
-def compute_epanet(graph, tank_capacity, wwtp, debug=False):
+# EPANET binary and default working directory (input and report files).
+EPANET_BIN = './EPANET-2.2/bin/runepanet'
+EPANET_DIR = './EPANET-2.2/bin'
+
+def compute_epanet(graph, tank_capacity, wwtp, debug=False, workdir=None):
     # Try to generate INP file for a graph and return simulation results.
+    # Concurrent simulations must use different 'workdir' directories, the input and report files are written there.
     title="Girona Test for Hydraulically feasible and resilient network designs"
     pipes_dict = {}
-    with open('EPANET-2.2/bin/input.inp', 'w') as f:
+    if workdir is None:
+        workdir = EPANET_DIR
+    input_file = os.path.join(workdir, 'input.inp')
+    report_file = os.path.join(workdir, 'report.txt')
+    with open(input_file, 'w') as f:
         # Title section
         f.write('[TITLE]\n')
         f.write(title+'\n')
@@ -223,7 +233,7 @@ def compute_epanet(graph, tank_capacity, wwtp, debug=False):
     # Now compute EPANET and process result file.
     if debug:
         print("Running EPANET 2.2 ...")
-    process = subprocess.Popen("./EPANET-2.2/bin/runepanet ./EPANET-2.2/bin/input.inp ./EPANET-2.2/bin/report.txt", shell=True, stdout=subprocess.PIPE)
+    process = subprocess.Popen(" ".join([EPANET_BIN, input_file, report_file]), shell=True, stdout=subprocess.PIPE)
     process.wait()
     if process.returncode == 0 and debug:
         print(" - EPANET ran successfully")
@@ -240,7 +250,7 @@ def compute_epanet(graph, tank_capacity, wwtp, debug=False):
     line_node = 0
     line_percentage = 0
     print_l = False
-    with open("./EPANET-2.2/bin/report.txt", "r") as f_in:
+    with open(report_file, "r") as f_in:
         for l in f_in:
             if print_l:
                 print_l = False
@@ -255,8 +265,8 @@ def compute_epanet(graph, tank_capacity, wwtp, debug=False):
                 line_counter += 4
                 break
     
-    node_results = pd.read_csv("./EPANET-2.2/bin/report.txt", skiprows=line_node, nrows=graph.number_of_nodes()-1, on_bad_lines='skip', header=None, sep=r"\s+", names=["Node", "Supplied demand (m3/d)", "Head (m)", "Pressure (m)"])
-    link_results = pd.read_csv("./EPANET-2.2/bin/report.txt", skiprows=line_counter, nrows=graph.number_of_edges(), on_bad_lines='skip', header=None, sep=r"\s+", names=["Link ID", "Flow (m3/d)", "Velocity (m/s)", "Headloss (/1000m)"])
+    node_results = pd.read_csv(report_file, skiprows=line_node, nrows=graph.number_of_nodes()-1, on_bad_lines='skip', header=None, sep=r"\s+", names=["Node", "Supplied demand (m3/d)", "Head (m)", "Pressure (m)"])
+    link_results = pd.read_csv(report_file, skiprows=line_counter, nrows=graph.number_of_edges(), on_bad_lines='skip', header=None, sep=r"\s+", names=["Link ID", "Flow (m3/d)", "Velocity (m/s)", "Headloss (/1000m)"])
 
     result_data = {}
     result_data["success"] = True
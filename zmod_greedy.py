@@ -0,0 +1,1225 @@
+########################################################################################################
+########################################################################################################
+################################### BUDGETED GREEDY ENGINE #############################################
+########################################################################################################
+########################################################################################################
+
+import copy
+import copyreg
+import functools
+import heapq
+import io
+import math
+import multiprocessing
+import pickle
+import shutil
+import tempfile
+import time
+import types
+from collections import OrderedDict
+import networkx as nx
+import numpy as np
+
+import zmod_connectivity
+import zmod_costs
+import zmod_epanet
+import zmod_network
+import zmod_pairwise
+import zmod_shortest_paths
+
+########################################################################################################
+################################### CANDIDATES #########################################################
+########################################################################################################
+
+def path_profit(total_cons, length):
+    # Water served per meter of pipe of the shortest path.
+    return total_cons/length
+
+def resilient_profit(total_cons, length):
+    # Same, counting the length twice as the second path roughly doubles the pipes.
+    return total_cons/(length*2)
+
+class CandidateQueue:
+    """
+    Lazy max-heap of the greedy candidates (one per remaining consumer, attached to its nearest added node), keyed by
+    profit. A candidate only changes when the attachment of its consumer changes, so instead of rebuilding and sorting
+    every candidate on each iteration only the changed ones are pushed again ('refresh'). Old entries stay in the heap
+    and are skipped when popped. Candidates whose minimum cost passes the remaining budget are parked, and only pushed
+    again if the budget grows or their attachment changes.
+    On profit ties the candidate pushed first is popped first.
+
+    Args:
+        precomputed_data (object): see "zmod_algorithms.precompute_data_lb_algorithms".
+        attachment (AttachmentIndex): nearest added node of each consumer (see 'zmod_shortest_paths.AttachmentIndex').
+        remaining (set): consumers still to be added. It is read, not modified: consumers removed from it are skipped.
+        profit (function): profit of a candidate given the consumption and the length of its path (see 'path_profit').
+    """
+
+    def __init__(self, precomputed_data, attachment, remaining, profit=path_profit):
+        self.precomputed_data = precomputed_data
+        self.attachment = attachment
+        self.remaining = remaining
+        self.profit = profit
+        self.heap = []
+        self.live = {}
+        self.parked = {}
+        self.budget = None
+        self.counter = 0
+        # Heap entries taken by 'pop_many', so that 'unpop' can put them back as they were.
+        self.taken = []
+
+    def __len__(self):
+        return len(self.live)
+
+    def __getstate__(self):
+        # Copies only keep the live entries. The order of the heap does not change, as its keys are unique.
+        state = self.__dict__.copy()
+        state["heap"] = [entry for entry in self.heap if self.live.get(entry[2][0][1]) == entry[1]]
+        heapq.heapify(state["heap"])
+        return state
+
+    def refresh(self, consumers, remaining_budget):
+        """
+        Rebuilds the candidates of the given consumers (e.g. the ones returned by 'AttachmentIndex.add_nodes') and,
+        if the budget grew, of the parked consumers that fit again.
+
+        Args:
+            consumers (iterable): consumers whose attachment changed.
+            remaining_budget (double): budget left (in €).
+        """
+        consumers = list(consumers)
+        if self.budget is not None and remaining_budget > self.budget:
+            unparked = [consumer for consumer, min_cost in self.parked.items() if min_cost < remaining_budget]
+            for consumer in unparked:
+                del self.parked[consumer]
+            consumers += unparked
+        self.budget = remaining_budget
+        for cons_node in consumers:
+            if cons_node not in self.remaining:
+                continue
+            # Plain floats (not numpy ones), cheaper to store and to copy.
+            min_node, min_path_length = self.attachment.nearest(cons_node)
+            min_path_length = float(min_path_length)
+            # Treshold to not add a candidate if the minimum cost (in €) of the shortest path passes the budget.
+            min_cost = zmod_costs.get_min_costs_diameter()*min_path_length
+            try:
+                fits = min_cost < remaining_budget
+            except BudgetDivergence:
+                # Only some budgets of a sweep can pay it: it stays, 'pop' parks it for the others.
+                fits = True
+            if fits:
+                self.parked.pop(cons_node, None)
+                min_path_total_cons = float(self.precomputed_data["total_cons"][min_node][cons_node])
+                profit = self.profit(min_path_total_cons, min_path_length)
+                # Only the end nodes are kept, the path is fetched when the candidate is evaluated (it may be rebuilt from a predecessor matrix).
+                self.push(((min_node, cons_node), profit, min_path_total_cons, min_path_length))
+            else:
+                self.live.pop(cons_node, None)
+                self.parked[cons_node] = min_cost
+
+    def push(self, candidate):
+        """
+        Pushes a candidate, replacing the previous one of its consumer.
+
+        Args:
+            candidate (tuple): ((attachment node, consumer), profit, path consumption, path length).
+        """
+        cons_node = candidate[0][1]
+        self.counter += 1
+        self.live[cons_node] = self.counter
+        heapq.heappush(self.heap, (-candidate[1], self.counter, candidate))
+
+    def pop(self, remaining_budget, taken=None):
+        """
+        Pops the candidate with the highest profit. Candidates of consumers already added are dropped, and the ones
+        that no longer fit the budget are parked.
+
+        Args:
+            remaining_budget (double): budget left (in €).
+            taken (list): if given, the live entries popped (returned or parked) are appended to it.
+        Returns:
+            candidate (tuple): ((attachment node, consumer), profit, path consumption, path length), or None if empty.
+        """
+        while len(self.heap) > 0:
+            entry = heapq.heappop(self.heap)
+            _, counter, candidate = entry
+            cons_node = candidate[0][1]
+            if self.live.get(cons_node) != counter:
+                continue
+            del self.live[cons_node]
+            if cons_node not in self.remaining:
+                continue
+            if taken is not None:
+                taken.append(entry)
+            min_cost = zmod_costs.get_min_costs_diameter()*candidate[3]
+            if min_cost >= remaining_budget:
+                self.parked[cons_node] = min_cost
+                continue
+            return candidate
+        return None
+
+    def pop_many(self, remaining_budget, k):
+        """
+        Pops the next k candidates, in the order 'pop' would return them.
+
+        Args:
+            remaining_budget (double): budget left (in €).
+            k (int): number of candidates.
+        Returns:
+            candidates (list): up to k candidates.
+        """
+        self.taken = []
+        candidates = []
+        while len(candidates) < k:
+            candidate = self.pop(remaining_budget, self.taken)
+            if candidate is None:
+                break
+            candidates.append(candidate)
+        return candidates
+
+    def unpop(self, n_used):
+        """
+        Undoes the last 'pop_many' after its first n_used candidates: the following ones (and the candidates parked
+        while looking for them) are back in the queue with their original order, as if they had never been popped.
+
+        Args:
+            n_used (int): candidates of the last 'pop_many' that were used.
+        """
+        n_returned = 0
+        for i, entry in enumerate(self.taken):
+            if n_returned == n_used:
+                break
+            if entry[2][0][1] not in self.parked:
+                n_returned += 1
+        else:
+            i = len(self.taken)
+        for entry in self.taken[i:]:
+            cons_node = entry[2][0][1]
+            self.parked.pop(cons_node, None)
+            self.live[cons_node] = entry[1]
+            heapq.heappush(self.heap, entry)
+        self.taken = []
+
+########################################################################################################
+################################### SECOND PATH STRATEGIES #############################################
+########################################################################################################
+
+class LegacySecondPath:
+    """
+    Second path of the resilient (LBR) algorithms: the shortest path between the ends of the candidate path in the street
+    graph without the edges of that path, except the bridges (edges whose removal disconnects the graph), which cannot
+    be avoided. The edges are removed from G and added back after the search, as the original algorithms did, so G is
+    modified (the edges added back have no attributes).
+
+    Args:
+        G (nx undirected graph): street graph used (and modified) by the search.
+        warn (bool): if true, print a message when there is no second path.
+    """
+
+    # The searches modify G, so the greedy engine keeps its own copy of the original graph.
+    modifies_graph = True
+
+    def __init__(self, G, warn=False):
+        self.G = G
+        self.warn = warn
+        # Neighbors of the nodes changed by each call since the last 'checkpoint', to undo speculative calls.
+        self.log = None
+        # Edges whose removal disconnects the graph (see 'zmod_connectivity.bridge_index').
+        self.bridges = zmod_connectivity.bridge_index(G)
+
+    def __call__(self, min_path):
+        """
+        Returns the second path (list of nodes) from the first to the last node of 'min_path', or [] if there is none.
+        """
+        edges_path = [(v,w) for v, w in zmod_pairwise.pairwise(min_path) if not zmod_connectivity.is_critical(self.bridges, v, w)]
+        if self.log is not None:
+            self.log.append({node: list(self.G._adj[node].items()) for edge in edges_path for node in edge})
+        self.G.remove_edges_from(edges_path)
+        try:
+            new_shortest_path = nx.shortest_path(self.G, min_path[0], min_path[len(min_path)-1], weight='length')
+        except nx.NetworkXNoPath:
+            if self.warn:
+                print(" - NO PATH!")
+            new_shortest_path = []
+        # Re-add the original shortest path to the original network.
+        self.G.add_edges_from(edges_path)
+        return new_shortest_path
+
+    def checkpoint(self, record=True):
+        # Start recording the calls, so that they can be undone (or stop recording them).
+        self.log = [] if record else None
+
+    def undo(self, n_calls):
+        """
+        Undoes the last n_calls calls since the last 'checkpoint': the edges get back their attributes and the neighbors
+        their order, so the following searches are the same as if these calls had never been made.
+        """
+        for _ in range(n_calls):
+            for node, neighbors in self.log.pop().items():
+                # The adjacency dicts are restored in place, networkx keeps the order of the neighbors there.
+                self.G._adj[node].clear()
+                self.G._adj[node].update(neighbors)
+
+class MaskedSecondPath:
+    """
+    Same second path as 'LegacySecondPath' (shortest path between the ends of the candidate path without the edges of
+    that path, except the bridges), searched on a read only CSR copy of the street graph with the path edges masked
+    out (see 'zmod_shortest_paths.masked_shortest_path'). G is never modified and the calls keep no state, so they can
+    run concurrently. Unlike the legacy searches, every edge keeps its length.
+
+    Args:
+        G (nx undirected graph): street graph (it is not modified).
+        warn (bool): if true, print a message when there is no second path.
+    """
+
+    def __init__(self, G, warn=False):
+        self.warn = warn
+        self.nodes, self.index = zmod_shortest_paths.build_node_index(G)
+        self.csr = zmod_shortest_paths.build_csr_graph(G, self.index)
+        # CSR entries of the bridges (see 'zmod_connectivity.bridge_index'), they can be in both paths.
+        self.bridges = zmod_connectivity.bridge_index(G)
+        self.shared = np.zeros(self.csr.nnz, dtype=bool)
+        for u, v in self.bridges["bridges"]:
+            self.shared[zmod_shortest_paths.csr_entry(self.csr, self.index[u], self.index[v])] = True
+
+    def _entries(self, path):
+        # CSR entries of the edges of a path that can not be shared, in both directions.
+        entries = []
+        for v, w in zmod_pairwise.pairwise(path):
+            if not zmod_connectivity.is_critical(self.bridges, v, w):
+                entries.append(zmod_shortest_paths.csr_entry(self.csr, self.index[v], self.index[w]))
+                entries.append(zmod_shortest_paths.csr_entry(self.csr, self.index[w], self.index[v]))
+        return np.array(entries, dtype=np.int64)
+
+    def _no_path(self):
+        if self.warn:
+            print(" - NO PATH!")
+        return []
+
+    def __call__(self, min_path):
+        """
+        Returns the second path (list of nodes) from the first to the last node of 'min_path', or [] if there is none.
+        """
+        path = zmod_shortest_paths.masked_shortest_path(self.csr, self.index[min_path[0]], self.index[min_path[-1]], exclude=self._entries(min_path))
+        if len(path) == 0:
+            return self._no_path()
+        return [self.nodes[i] for i in path]
+
+class DisjointPairPath(MaskedSecondPath):
+    """
+    Resilient path pair chosen as a whole: instead of the candidate path plus the shortest path without its edges, the
+    pair of edge-disjoint paths between the ends of the candidate path with the minimum total length (Suurballe, see
+    'zmod_shortest_paths.edge_disjoint_pair'). The bridges can be in both paths. Read only and stateless, like
+    'MaskedSecondPath'.
+
+    Args:
+        G (nx undirected graph): street graph (it is not modified).
+        warn (bool): if true, print a message when there is no second path.
+    """
+
+    def pair(self, min_path):
+        """
+        Returns the first and the second path (lists of nodes) between the ends of 'min_path'. If there is no pair,
+        'min_path' and [].
+        """
+        pair = zmod_shortest_paths.edge_disjoint_pair(self.csr, self.index[min_path[0]], self.index[min_path[-1]], shared=self.shared)
+        if pair is None:
+            return min_path, self._no_path()
+        return tuple([self.nodes[i] for i in path] for path in pair)
+
+    def __call__(self, min_path):
+        # Second path of the pair (the first one may not be 'min_path').
+        return self.pair(min_path)[1]
+
+########################################################################################################
+################################### COST MODELS ########################################################
+########################################################################################################
+
+# A cost model gets the network under design and returns an evaluation: a dict with its "cost" plus the data used to
+# build the result, either the "diameters" of the pipes (dict keyed by (u,v) and (v,u)) or a "graph" with the "flow",
+# "diameter" and "valve" edge attributes. Optionally "tank_capacity" and "epanet" (EPANET results).
+# 'new_edges' are the edges of the candidate that are not in the accepted network yet. A cost model can also be a class,
+# built as cost_model(origin, precomputed_data), that keeps state between candidates: its 'commit' and 'rollback' methods
+# are called when the candidate is accepted or discarded (see 'IncrementalHydraulicCost'). When candidates are evaluated
+# in a pool, its 'get_state' and 'set_state' methods copy the accepted network to the workers, and 'price' updates the
+# state with the accepted candidate before 'commit', without simulating it. 'workdir' is the EPANET
+# working directory to use (see 'zmod_epanet.compute_epanet'), given when candidates are evaluated concurrently.
+# 'budget' is the cost from which the candidate is rejected anyway (None if unknown), so that a cost model can skip the
+# work that would not change that (see 'staged_evaluation'); the evaluation then needs only its "cost", plus the
+# "attributes" it set on the edges of the network (dict keyed by (u,v)) if it has no "graph".
+
+def flow_cost_model(G_new, origin, cons_nodes, total_cons, precomputed_data, new_edges=None, workdir=None, budget=None):
+    # Max flow based costs (see 'zmod_costs.get_construction_costs'). The network is not modified, so it needs no copy.
+    cost, diameters_dict, t_capacity = zmod_costs.get_construction_costs(G_new, origin, cons_nodes, total_cons, precomputed_data)
+    return {"cost": cost, "diameters": diameters_dict, "tank_capacity": t_capacity}
+
+def aggregation_cost_model(G_new, origin, cons_nodes, total_cons, precomputed_data, new_edges=None, workdir=None, budget=None):
+    # Consumption aggregation through paths (see 'zmod_costs.get_construction_costs_v2').
+    cost, diameters_dict, t_capacity = zmod_costs.get_construction_costs_v2(G_new, origin, cons_nodes, total_cons, precomputed_data)
+    return {"cost": cost, "diameters": diameters_dict, "tank_capacity": t_capacity}
+
+class EvaluationMemo:
+    """
+    Bounded cache of the EPANET results of the networks simulated by the hydraulic cost models, keyed by design
+    fingerprint (see 'design_key'), so that a network simulated again with the same diameters and valves (e.g. by the
+    runs of several budgets) is not. Once 'maxsize' results are cached, the least recently used one is evicted. It
+    counts its hits and misses.
+    The node elevations of a street graph are assumed not to change (they are not part of the key).
+
+    Args:
+        maxsize (int): maximum number of cached results.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key):
+        # Cached results of 'key', or None.
+        results = self.cache.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return results
+
+    def put(self, key, results):
+        self.cache[key] = results
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+def design_key(G_new, origin, t_capacity, precomputed_data):
+    # Fingerprint of an EPANET simulation: the street graph and its demands, the edges of the network and their
+    # attributes (see 'zmod_network.NetworkOverlay', some may be left by the candidates evaluated before, see
+    # '_stale_evaluation'), the origin and the tank capacity. None (not cached) without edge hash or demand fingerprint.
+    if not hasattr(G_new, "edge_hash") or "demand_fingerprint" not in precomputed_data:
+        return None
+    return (precomputed_data["fingerprint"], precomputed_data["demand_fingerprint"], G_new.edge_hash, G_new.attribute_hash, origin, t_capacity)
+
+def simulate_network(memo, key, test_graph, t_capacity, origin, workdir=None):
+    # EPANET results of the network (see 'zmod_epanet.compute_epanet'), from 'memo' if it was simulated before.
+    epanet = None
+    if memo is not None and key is not None:
+        epanet = memo.get(key)
+    if epanet is None:
+        epanet = zmod_epanet.compute_epanet(test_graph, t_capacity, origin, workdir=workdir)
+        if memo is not None and key is not None:
+            memo.put(key, epanet)
+    return epanet
+
+def _speed_levels(speed_min, lowest, step):
+    # Minimum speeds from 'speed_min' down to 'lowest', with the same floating point values as the original loop.
+    levels = []
+    while speed_min >= lowest:
+        levels.append(speed_min)
+        speed_min -= step
+    return levels
+
+# Minimum speeds (m/s) the hydraulic cost models select the diameters with, in order, until EPANET validates the network.
+speed_levels = _speed_levels(0.6, 0.4, 0.05)
+
+def staged_evaluation(costs, simulate, budget=None):
+    """
+    Hydraulic validation of a network at the speed levels of 'speed_levels', running as few EPANET simulations as
+    possible. The costs of all the levels are known beforehand (the flows do not depend on the speeds), so once every
+    remaining level costs the budget or more the network is rejected without simulating it. Otherwise the levels are
+    simulated in order (the cheapest diameters first) until EPANET validates one, as the original loop did, so the
+    accepted networks are the same.
+
+    Args:
+        costs (list): cost of the network at each level (inf if its diameters can not be selected).
+        simulate (function): simulate(level) returns the evaluated graph and the EPANET results of a level.
+        budget (double): cost from which the network is rejected anyway, or None to always simulate it.
+    Returns:
+        level (int): last evaluated level.
+        simulation (tuple): the (graph, EPANET results) of that level, or None if the network was rejected on budget.
+    """
+    simulation = None
+    for level in range(len(costs)):
+        if budget is not None and min(costs[level:]) >= budget:
+            return level, None
+        simulation = simulate(level)
+        if simulation[1][2]["success"]:
+            break
+    return level, simulation
+
+def _hydraulic_evaluation(cost, t_capacity, simulation, attributes=None):
+    # Evaluation of a staged validation. Rejected on budget, only its cost is known, and the edge attributes the network
+    # got without being simulated.
+    if simulation is None:
+        evaluation = {"cost": cost, "tank_capacity": t_capacity}
+        if attributes is not None:
+            evaluation["attributes"] = attributes
+        return evaluation
+    test_graph, (node_data, link_data, result_data) = simulation
+    epanet_result = {
+        "node_data": node_data, 
+        "link_data": link_data, 
+        "result_data": result_data
+    }
+    return {"cost": cost, "graph": test_graph, "tank_capacity": t_capacity, "epanet": epanet_result}
+
+def hydraulic_cost_model(G_new, origin, cons_nodes, total_cons, precomputed_data, new_edges=None, workdir=None, budget=None, memo=None):
+    # Cost of the new network. Try to compute EPANET to validate hydraulically feasible.
+    # If not (detected reduction in demand) try to variate speed (see 'staged_evaluation'). The flows are computed once
+    # and priced at every speed level. The simulation of each level is cached in 'memo' (None to disable it).
+    max_speed = 1
+    flows = zmod_costs.diameter_flows(G_new, origin, precomputed_data)
+    selections = zmod_costs.level_selections(flows, speed_levels, max_speed)
+    t_cost,t_capacity = zmod_costs.tank_cost(total_cons)
+    costs = [math.inf if selection is None else selection["cost"]+t_cost for selection in selections]
+
+    def simulate(level):
+        selection = selections[level]
+        if selection is None:
+            # Raises the IndexError of the diameter selection.
+            selection = zmod_costs.select_diameters(flows, speed_levels[level], max_speed)
+        zmod_costs.set_diameter_attributes(G_new, flows, selection)
+        test_graph = zmod_costs.copy_network(G_new)
+        test_graph.remove_nodes_from(list(nx.isolates(test_graph)))
+        key = design_key(G_new, origin, t_capacity, precomputed_data)
+        return test_graph, simulate_network(memo, key, test_graph, t_capacity, origin, workdir)
+
+    level, simulation = staged_evaluation(costs, simulate, budget)
+    attributes = None
+    if simulation is None and selections[level] is not None:
+        # The network gets the diameters of the level, as if it had been simulated.
+        attributes = zmod_costs.set_diameter_attributes(G_new, flows, selections[level])
+    return _hydraulic_evaluation(costs[level], t_capacity, simulation, attributes)
+
+class IncrementalHydraulicCost:
+    """
+    Same evaluation as 'hydraulic_cost_model', but the diameters of each candidate are priced from the flows of the
+    accepted network, updating only the pipes upstream of the new path (see 'zmod_costs.IncrementalDiameterCost').
+    The flows are always updated (they are the state of the next candidates), the EPANET results of each simulated
+    network are cached in 'memo'.
+
+    Args:
+        origin (int): Origin node of the reuse network graph.
+        precomputed_data (object): see "zmod_algorithms.precompute_data_lb_algorithms".
+        memo (EvaluationMemo): cache of the EPANET results, None to disable it.
+    """
+
+    def __init__(self, origin, precomputed_data, memo=None):
+        self.origin = origin
+        self.precomputed_data = precomputed_data
+        self.diameters = zmod_costs.IncrementalDiameterCost(origin, precomputed_data)
+        self.memo = memo
+
+    def __call__(self, G_new, origin, cons_nodes, total_cons, precomputed_data, new_edges=None, workdir=None, budget=None):
+        max_speed = 1
+        costs = self.price(G_new, new_edges, total_cons)
+        t_capacity = zmod_costs.tank_cost(total_cons)[1]
+
+        def simulate(level):
+            test_graph = self.diameters.graph(G_new, speed_levels[level], max_speed)
+            test_graph.remove_nodes_from(list(nx.isolates(test_graph)))
+            key = design_key(G_new, origin, t_capacity, precomputed_data)
+            return test_graph, simulate_network(self.memo, key, test_graph, t_capacity, origin, workdir)
+
+        level, simulation = staged_evaluation(costs, simulate, budget)
+        attributes = None
+        if simulation is None and costs[level] < math.inf:
+            # The network gets the diameters of the level, as if it had been simulated.
+            attributes = self.diameters.set_attributes(G_new, speed_levels[level], max_speed)
+        return _hydraulic_evaluation(costs[level], t_capacity, simulation, attributes)
+
+    def price(self, G_new, new_edges, total_cons):
+        # Cost of the network at each speed level (inf if its diameters can not be selected), from the same flows.
+        if new_edges is None:
+            # Without the candidate edges the network can not be updated, evaluate it from scratch.
+            new_edges = list(G_new.edges())
+        max_speed = 1
+        costs = []
+        for speed_min in speed_levels:
+            try:
+                costs.append(self.diameters.evaluate(G_new, new_edges, total_cons, speed_min, max_speed)[0])
+            except IndexError:
+                costs.append(math.inf)
+        return costs
+
+    def commit(self):
+        self.diameters.commit()
+
+    def rollback(self):
+        self.diameters.rollback()
+
+    def get_state(self):
+        return self.diameters.get_state()
+
+    def set_state(self, state):
+        self.diameters.set_state(state)
+
+def build_cost_model(cost_model, origin, precomputed_data, memo=None):
+    # Cost model of a run: classes are built for it and, if 'memo' is given, the EPANET results are cached in it.
+    if isinstance(cost_model, type):
+        if memo is None:
+            return cost_model(origin, precomputed_data)
+        return cost_model(origin, precomputed_data, memo=memo)
+    if memo is None:
+        return cost_model
+    return functools.partial(cost_model, memo=memo)
+
+def within_budget(evaluation, b):
+    # Default feasibility check: the network costs less than the budget.
+    return evaluation["cost"] < b
+
+########################################################################################################
+################################### GREEDY ENGINE ######################################################
+########################################################################################################
+
+class GreedyRun:
+    """
+    State of a budgeted greedy design (see 'greedy_network'), advanced one iteration at a time with 'step'. The state
+    is kept in an object so that it can be copied and continued with other budgets (see 'sweep').
+
+    Args:
+        G, b, origin, precomputed_data, profit, candidates, second_path, cost_model, feasible, failure_rate, memo, debug: 
+            see 'greedy_network'.
+        pool (multiprocessing.Pool): if given, pool started with '_init_candidate_worker' where the next
+            'parallel_candidates' candidates are evaluated at the same time (see 'greedy_network').
+        parallel_candidates (int): candidates evaluated at the same time in 'pool'.
+    """
+
+    def __init__(self, G, b, origin, precomputed_data, profit=path_profit, candidates=CandidateQueue, second_path=None, cost_model=aggregation_cost_model, feasible=within_budget, failure_rate=0.4/12, memo=None, pool=None, parallel_candidates=1, debug=False):
+        self.start = time.time()
+        self.b = b
+        self.origin = origin
+        self.precomputed_data = precomputed_data
+        self.feasible = feasible
+        self.failure_rate = failure_rate
+        self.pool = pool
+        self.parallel_candidates = parallel_candidates
+        self.debug = debug
+        # The per-node state stays in sets of node ids: the precomputed tables are indexed by node id with every backend
+        # (only the dense ones have a node index), and the cost models and the results take node sets. The array
+        # indexed state is in the parts that scan the nodes (the attachment index, the network edge mask and the CSR
+        # of the second path strategies), where it pays off.
+        self.cons_nodes_remaining = precomputed_data["cons_nodes"].copy()
+        if origin in self.cons_nodes_remaining:
+            self.cons_nodes_remaining.remove(origin)
+        self.cons_nodes_added = set()
+        self.added_nodes = set()
+        self.added_nodes.add(origin)
+        # Nearest added node of each consumer, updated only with the nodes added on each iteration.
+        self.attachment = zmod_shortest_paths.AttachmentIndex(precomputed_data["shortest_paths_length"], self.cons_nodes_remaining)
+        self.attachment.add_nodes([origin])
+        # Candidates sorted by profit, rebuilt only when the attachment of their consumer changes.
+        self.queue = candidates(precomputed_data, self.attachment, self.cons_nodes_remaining, profit)
+        self.changed = list(self.cons_nodes_remaining)
+        self.added_edges = set()
+        self.accepted = None
+        
+        self.remaining_budget = b
+        
+        self.second_path = None
+        if second_path is not None:
+            self.second_path = second_path(G)
+        # The network under design is an overlay of the original graph. A legacy second path modifies G, so the overlay
+        # is built on a copy.
+        self.G_original = nx.Graph(G) if getattr(self.second_path, "modifies_graph", False) else G
+        self.G_new = zmod_network.NetworkOverlay(self.G_original)
+        self.memo = memo
+        self.cost_model = build_cost_model(cost_model, origin, precomputed_data, memo)
+        self.stop = False
+
+    def __getstate__(self):
+        # A pool can not be copied, copies evaluate their candidates one at a time.
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def rejection_budget(self):
+        # Cost from which 'feasible' rejects any evaluation, for the cost models: the budget (the largest one of a
+        # 'BudgetSet') with 'within_budget', None with other feasibility checks.
+        if self.feasible is not within_budget:
+            return None
+        if isinstance(self.b, BudgetSet):
+            return max(self.b.values)
+        return self.b
+
+    def finished(self):
+        return self.stop or len(self.cons_nodes_remaining) == 0
+
+    def candidate_edges(self, candidate):
+        # Path of a candidate, its second path, and the consumption nodes and edges they add to the network.
+        precomputed_data = self.precomputed_data
+        min_path = precomputed_data["shortest_paths"][candidate[0][0]][candidate[0][1]]
+        total_cons = candidate[2]
+        new_shortest_path = []
+        if hasattr(self.second_path, "pair"):
+            # Both paths are chosen together (see 'DisjointPairPath'), the first one may replace the shortest path.
+            first_path, new_shortest_path = self.second_path.pair(min_path)
+            if first_path != min_path:
+                min_path = first_path
+                total_cons = sum(precomputed_data["n_cons"][node] for node in min_path[1:])
+        
+        # From the shortest path get the consumption nodes and edge path.
+        # Add the edges from the edge path that are not yet in the new graph:
+        cons_nodes = set()
+        new_edges_path = []
+        for v, w in zmod_pairwise.pairwise(min_path):
+            if w in precomputed_data["cons_nodes"]:
+                cons_nodes.add(w)
+            if (v,w) not in self.added_edges:
+                new_edges_path.append((v,w))
+        
+        # Second path without the original one to add resilience.
+        if self.second_path is not None:
+            if not hasattr(self.second_path, "pair"):
+                new_shortest_path = self.second_path(min_path)
+            for i in range(1,len(new_shortest_path)):
+                if precomputed_data["n_cons"][new_shortest_path[i]] > 0:
+                    cons_nodes.add(new_shortest_path[i])
+                    total_cons += precomputed_data["n_cons"][new_shortest_path[i]]
+                if (new_shortest_path[i-1],new_shortest_path[i]) not in self.added_edges:
+                    new_edges_path.append((new_shortest_path[i-1],new_shortest_path[i]))
+        return min_path, new_shortest_path, cons_nodes, total_cons, new_edges_path
+
+    def step(self):
+        """
+        Runs one iteration: the candidates are evaluated by profit until one is feasible, which is added to the network.
+        If none is, the design is finished.
+        """
+        b = self.b
+        queue = self.queue
+        G_new = self.G_new
+        cost_model = self.cost_model
+        pool = self.pool
+        debug = self.debug
+        budget = self.rejection_budget()
+        
+        # Only the candidates whose attachment changed are rebuilt, the rest stay in the queue.
+        queue.refresh(self.changed, self.remaining_budget)
+        n_candidates = len(queue)
+        candidate = queue.pop(self.remaining_budget)
+        if candidate is None:
+            # No more candidates.
+            if debug:
+                print(" - No more candidates available.")
+            self.stop = True
+            return
+        
+        n_can = 0
+        rejected = []
+        evaluation = None
+        while candidate is not None:
+            if pool is None:
+                batch = [candidate]
+                prepared = [self.candidate_edges(candidate)]
+            else:
+                # The next candidates are evaluated at the same time, the first feasible one in profit order is accepted.
+                batch = [candidate] + queue.pop_many(self.remaining_budget, self.parallel_candidates-1)
+                if hasattr(self.second_path, "checkpoint"):
+                    self.second_path.checkpoint()
+                prepared = [self.candidate_edges(batch_candidate) for batch_candidate in batch]
+                # The edges of the network are pickled once, as they are now, with the order of the neighbors, and so
+                # is the state of a stateful cost model, so that the candidates are priced as they would be here.
+                G_pickled = pickle.dumps(G_new.active_adjacency())
+                state = pickle.dumps(cost_model.get_state()) if hasattr(cost_model, "get_state") else None
+                # Edge attributes of the network the candidates are evaluated with.
+                start = {(u,v): dict(data) for u,v,data in G_new.edges(data=True)}
+                tasks = [(G_pickled, state, batch_new_edges, self.cons_nodes_added.union(batch_cons_nodes), batch_total_cons, budget) for _, _, batch_cons_nodes, batch_total_cons, batch_new_edges in prepared]
+                evaluations = pool.imap(_evaluate_candidate, tasks)
+            
+            for candidate, (min_path, new_shortest_path, cons_nodes, total_cons, new_edges_path) in zip(batch, prepared):
+                G_new.add_edges_from(new_edges_path)
+                
+                # Cost of the new network.
+                if pool is None:
+                    evaluation = cost_model(G_new, self.origin, self.cons_nodes_added.union(cons_nodes), total_cons, self.precomputed_data, new_edges=new_edges_path, budget=budget)
+                else:
+                    evaluation = next(evaluations)
+                    if _stale_evaluation(G_new, start, evaluation):
+                        evaluation = cost_model(G_new, self.origin, self.cons_nodes_added.union(cons_nodes), total_cons, self.precomputed_data, new_edges=new_edges_path, budget=budget)
+                    elif "graph" in evaluation:
+                        # Same edge attributes as if the candidates had been evaluated here one after the other: the
+                        # network keeps the ones set by this evaluation, and the evaluated graph gets the ones set by
+                        # the previous evaluations.
+                        zmod_network.set_edge_attributes(G_new, {(u,v): data for u,v,data in evaluation["graph"].edges(data=True) if G_new.has_edge(u,v)})
+                        nx.set_edge_attributes(evaluation["graph"], {(u,v): G_new[u][v] for u,v in evaluation["graph"].edges()})
+                    elif "attributes" in evaluation:
+                        # Not simulated: the network gets the attributes the evaluation set in the worker.
+                        zmod_network.set_edge_attributes(G_new, evaluation["attributes"])
+                n_can += 1
+                if self.feasible(evaluation, b):
+                    if hasattr(cost_model, "price") and pool is not None:
+                        # Priced in the pool: the state of the cost model is updated here.
+                        cost_model.price(G_new, new_edges_path, total_cons)
+                    if hasattr(cost_model, "commit"):
+                        cost_model.commit()
+                    G_new.commit()
+                    # Solution found: break the loop and add the new edges to 'added_edges'.
+                    for edge in new_edges_path:
+                        self.added_edges.add(edge)
+                        self.added_edges.add((edge[1],edge[0]))
+                    self.accepted = evaluation
+                    break
+                if hasattr(cost_model, "rollback"):
+                    cost_model.rollback()
+                G_new.rollback()
+                rejected.append(candidate)
+            else:
+                candidate = queue.pop(self.remaining_budget)
+                continue
+            if pool is not None:
+                # The candidates after the accepted one were not needed.
+                n_used = batch.index(candidate) + 1
+                queue.unpop(n_used - 1)
+                if hasattr(self.second_path, "undo"):
+                    self.second_path.undo(len(batch) - n_used)
+            break
+        # Rejected candidates are still valid for the next iterations.
+        for rejected_candidate in rejected:
+            queue.push(rejected_candidate)
+        
+        if candidate is not None:
+            # Add nodes to "added_nodes" and remove them from "cons_nodes".
+            for node in new_shortest_path + min_path:
+                self.added_nodes.add(node)
+                if node in self.cons_nodes_remaining:
+                    self.cons_nodes_remaining.remove(node)
+                    self.cons_nodes_added.add(node)
+            self.changed = self.attachment.add_nodes(new_shortest_path) + self.attachment.add_nodes(min_path)
+            self.remaining_budget = b - evaluation["cost"]
+        else:
+            # No more candidates.
+            if debug:
+                print(" - No more candidates available.")
+            self.stop = True
+        if debug:
+            message = [" - Candidates evaluated: (",n_can,"/",n_candidates,"). Current cost: (",int(evaluation["cost"]),"/",b,"€)."]
+            if self.second_path is not None:
+                message += ["2K =",len(new_shortest_path) > 0]
+            print(*message)
+
+    def result(self):
+        """
+        Returns the designed network, its results and the accepted evaluation (see 'greedy_network').
+        """
+        precomputed_data = self.precomputed_data
+        G_original = self.G_original
+        G_new = self.G_new
+        accepted = self.accepted
+        
+        # Only the nodes and edges of the network are materialised, with the attributes of the original graph. Its
+        # unconnected parts are removed (extract biggest component).
+        G_new_full = G_new.to_graph(base_attributes=True)
+        if G_new_full.number_of_nodes() == 0:
+            # No candidate was accepted, the network is just the origin.
+            G_new_full.add_node(self.origin, **G_original.nodes[self.origin])
+        attrs = {}
+        for u,v in G_new_full.edges():
+            if "graph" in accepted:
+                test_graph = accepted["graph"]
+                attrs[(u,v)] = {"flow": test_graph[u][v]["flow"], "diameter": test_graph[u][v]["diameter"], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(test_graph[u][v]["diameter"])}
+                if "valve" in test_graph[u][v]:
+                    attrs[(u,v)]["valve"] = test_graph[u][v]["valve"]
+            else:
+                diameters_dict = accepted["diameters"]
+                attrs[(u,v)] = {"diameter": diameters_dict[(u,v)], "age": 0, "material": "PE100", "wall_thickness": zmod_costs.get_wall_thickness(diameters_dict[(u,v)])}
+        nx.set_edge_attributes(G_new_full, attrs)
+        Gcc = sorted(nx.connected_components(G_new_full), key=len, reverse=True)
+        G_new_full = G_new_full.subgraph(Gcc[0])
+        
+        # Get the total consumption of new and original network. The set of added nodes may iterate in another order
+        # once copied (see 'sweep'), so it is summed exactly.
+        total_cons = math.fsum(precomputed_data["n_cons"][node] for node in self.added_nodes)
+        total_cons_original = sum(list(precomputed_data["n_cons"].values()))
+        
+        # Get the total network pipe distance (in m)
+        pipe_distance = int(G_new_full.size(weight="length"))
+            
+        end = time.time()
+        
+        # Resulting data structure.
+        result_data = {
+            "added_nodes": self.added_nodes,
+            "cons_nodes": self.cons_nodes_added,
+            "total_cons": total_cons,
+            "pipe_distance": pipe_distance,
+            "percentage_served": round(total_cons / total_cons_original * 100, 1),
+            "execution_time": end-self.start,
+            "failure_rate": 100*(self.failure_rate*(pipe_distance/1000))/G_new_full.number_of_edges(),
+            "tank_capacity": None if accepted is None else accepted.get("tank_capacity")
+        }
+        return G_new_full, result_data, accepted
+
+def greedy_network(G, b, origin, precomputed_data, profit=path_profit, candidates=CandidateQueue, second_path=None, cost_model=aggregation_cost_model, feasible=within_budget, failure_rate=0.4/12, memo=None, parallel_candidates=1, debug=False):
+    """
+    Budgeted greedy design of a reclaimed water network, shared by the LB and LBR algorithms.
+    On each iteration the candidates (shortest path from the network to a remaining consumer) are evaluated by profit
+    until one is feasible; its path (plus its second path, if any) is added to the network and its cost sets the
+    remaining budget. It stops when no candidate is feasible.
+
+    Args:
+        G (nx undirected graph): original graph.
+        b (int): maximum cost (in €) of the generated G_new optimal graph.
+        origin (int): Origin node of the reuse network graph. Must be a node in G.
+        precomputed_data (object): Data structure including essential precomputed data to make the algorithm more efficient. 
+            Check func "zmod_algorithms.precompute_data_lb_algorithms" for more info.
+        profit (function): profit of a candidate given its path consumption and length (see 'path_profit').
+        candidates (class): candidate generator, built as candidates(precomputed_data, attachment, remaining, profit)
+            (see 'CandidateQueue').
+        second_path (class): if given, second path strategy built as second_path(G) and called with each candidate
+            path (see 'LegacySecondPath' and 'MaskedSecondPath'). If it has a 'pair' method, the path and its second
+            path are chosen together (see 'DisjointPairPath').
+        cost_model (function): evaluation of the network under design (see 'aggregation_cost_model'). If it is a class,
+            it is built as cost_model(origin, precomputed_data) (see 'IncrementalHydraulicCost').
+        feasible (function): feasibility of an evaluation given the budget (see 'within_budget').
+        failure_rate (double): pipe failures per km used for the "failure_rate" result.
+        memo (EvaluationMemo): if given, cache of the EPANET results of a hydraulic cost model (see 'EvaluationMemo').
+            It can be shared by several runs on the same street graph. Each process of the pool caches its own copy.
+        parallel_candidates (int): if greater than 1, the next 'parallel_candidates' candidates are evaluated at the same
+            time in a pool of processes, each one with its own EPANET working directory. The first feasible one in profit
+            order is accepted, so the result is the same as evaluating them one at a time. Stateful cost models (classes)
+            price the candidates in the pool from the state of the accepted network.
+        debug (bool): If true, print messages to the console.
+    Returns:
+        G_new: Generated optimal graph.
+        result_data (object): Data structure with some essential results (see 'zmod_algorithms.lb_algorithm_v2').
+        evaluation (object): evaluation of the last accepted candidate, None if no candidate was accepted.
+    """
+    
+    pool = None
+    if parallel_candidates > 1:
+        workroot = tempfile.mkdtemp(prefix="epanet_")
+        pool = multiprocessing.Pool(parallel_candidates, initializer=_init_candidate_worker, initargs=(G, cost_model, origin, precomputed_data, memo, workroot))
+    try:
+        run = GreedyRun(G, b, origin, precomputed_data, profit=profit, candidates=candidates, second_path=second_path, cost_model=cost_model, feasible=feasible, failure_rate=failure_rate, memo=memo, pool=pool, parallel_candidates=parallel_candidates, debug=debug)
+        while not run.finished():
+            run.step()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            shutil.rmtree(workroot, ignore_errors=True)
+    return run.result()
+
+def _stale_evaluation(G_new, start, evaluation):
+    # True if a candidate simulated in the pool got other attributes than it would have got here. As in the original
+    # algorithm, the candidates rejected before it leave their attributes in the edges of the network, and the ones its
+    # own evaluation does not set (e.g. a valve the network no longer needs) are simulated too. 'start' has the
+    # attributes the pool started with. An attribute that has changed since then and still has its value of 'start' in
+    # the evaluated graph was not set by the evaluation (or set to the same value, which is evaluated again anyway).
+    if "epanet" not in evaluation:
+        return False
+    graph = evaluation["graph"]
+    for (u,v), data in start.items():
+        current = G_new[u][v]
+        if current == data:
+            continue
+        evaluated = graph[u][v]
+        for key in set(data) | set(current):
+            if data.get(key) != current.get(key) and evaluated.get(key) == data.get(key):
+                return True
+    return False
+
+# Per process state of the candidate evaluation workers, set once by '_init_candidate_worker'.
+_candidate_state = {}
+
+def _init_candidate_worker(G, cost_model, origin, precomputed_data, memo, workroot):
+    cost_model = build_cost_model(cost_model, origin, precomputed_data, memo)
+    _candidate_state["network"] = zmod_network.NetworkOverlay(G)
+    _candidate_state["cost_model"] = cost_model
+    _candidate_state["origin"] = origin
+    _candidate_state["precomputed_data"] = precomputed_data
+    _candidate_state["workdir"] = tempfile.mkdtemp(dir=workroot)
+
+def _evaluate_candidate(task):
+    # Evaluates the network plus the new edges of a candidate, as 'greedy_network' does.
+    G_pickled, state, new_edges, cons_nodes, total_cons, budget = task
+    G_new = _candidate_state["network"]
+    G_new.load_adjacency(pickle.loads(G_pickled))
+    G_new.add_edges_from(new_edges)
+    cost_model = _candidate_state["cost_model"]
+    if state is not None:
+        cost_model.set_state(pickle.loads(state))
+    evaluation = cost_model(G_new, _candidate_state["origin"], cons_nodes, total_cons, _candidate_state["precomputed_data"], new_edges=new_edges, workdir=_candidate_state["workdir"], budget=budget)
+    if hasattr(cost_model, "rollback"):
+        cost_model.rollback()
+    G_new.rollback()
+    return evaluation
+
+########################################################################################################
+################################### BUDGET SWEEP #######################################################
+########################################################################################################
+
+class BudgetDivergence(Exception):
+    # Raised when the budgets of a 'BudgetSet' take different decisions. 'groups' has the positions of the budgets
+    # that take the same one, for each decision.
+    def __init__(self, groups):
+        super().__init__(groups)
+        self.groups = groups
+
+class BudgetSet:
+    """
+    Budgets of the sweep runs that took the same decisions so far, used as the budget 'b' of a shared 'GreedyRun'.
+    Arithmetic applies to each budget (e.g. the remaining budgets are b - cost) and comparisons behave like the ones of
+    a number while all the budgets give the same answer. When they do not, 'BudgetDivergence' is raised.
+
+    Args:
+        values (iterable): budgets (in €).
+    """
+
+    # Numpy numbers must leave the comparisons to this class.
+    __array_ufunc__ = None
+
+    def __init__(self, values):
+        self.values = tuple(values)
+
+    def __repr__(self):
+        return "BudgetSet(%s)" % (self.values,)
+
+    def _each(self, other):
+        return other.values if isinstance(other, BudgetSet) else [other]*len(self.values)
+
+    def _decide(self, outcomes):
+        outcomes = list(outcomes)
+        if all(outcome == outcomes[0] for outcome in outcomes):
+            return outcomes[0]
+        groups = {}
+        for i, outcome in enumerate(outcomes):
+            groups.setdefault(outcome, []).append(i)
+        raise BudgetDivergence(list(groups.values()))
+
+    def __add__(self, other):
+        return BudgetSet(v + o for v, o in zip(self.values, self._each(other)))
+
+    def __radd__(self, other):
+        return BudgetSet(o + v for v, o in zip(self.values, self._each(other)))
+
+    def __sub__(self, other):
+        return BudgetSet(v - o for v, o in zip(self.values, self._each(other)))
+
+    def __rsub__(self, other):
+        return BudgetSet(o - v for v, o in zip(self.values, self._each(other)))
+
+    def __mul__(self, other):
+        return BudgetSet(v * o for v, o in zip(self.values, self._each(other)))
+
+    def __rmul__(self, other):
+        return BudgetSet(o * v for v, o in zip(self.values, self._each(other)))
+
+    def __lt__(self, other):
+        return self._decide(v < o for v, o in zip(self.values, self._each(other)))
+
+    def __le__(self, other):
+        return self._decide(v <= o for v, o in zip(self.values, self._each(other)))
+
+    def __gt__(self, other):
+        return self._decide(v > o for v, o in zip(self.values, self._each(other)))
+
+    def __ge__(self, other):
+        return self._decide(v >= o for v, o in zip(self.values, self._each(other)))
+
+class _RunSnapshots:
+    # Pickled copies of sweep runs. The data shared by every run and never modified (precomputed data, original graph,
+    # profit and feasibility functions, node attributes) is referenced, not copied. The graph of a legacy second path
+    # (modified by each run) is left out of the per iteration copies: its calls are undone instead.
+    # References are only replaced in the attributes of objects (and in the nodes of graphs), so that builtin types
+    # are pickled at full speed.
+    # 'dump' pickles a run with a reducer that, for each object met:
+    # - a shared object (see '_shared_objects'): writes its position in 'shared' instead of the object.
+    # - a 'BudgetSet': writes its budgets. 'load' keeps only the ones at the given positions, so the copy of each group
+    #   of budgets that diverged (see 'BudgetDivergence') gets a 'BudgetSet' with the budgets of the group.
+    # - the graph of a legacy second path: writes a placeholder, 'load' puts the graph it is given instead.
+    # - any other object with a '__dict__': pickles its attributes, after the same replacements. Builtin types and
+    #   objects with their own reduction are pickled as usual.
+    # Each placeholder is a '_SharedRef', which unpickles through '_resolve_shared' with the context of the 'load'.
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.index = {id(obj): i for i, obj in enumerate(shared)}
+
+    def _shared(self, obj):
+        i = self.index.get(id(obj))
+        if i is not None and self.shared[i] is obj:
+            return _SharedRef("shared", i)
+        return obj
+
+    def dump(self, run, share_graph=True):
+        graph = None
+        if share_graph and hasattr(run.second_path, "undo"):
+            graph = run.second_path.G
+        def reducer_override(obj):
+            ref = self._shared(obj)
+            if ref is not obj:
+                return ref.__reduce__()
+            if isinstance(obj, BudgetSet):
+                return _SharedRef("budget", obj.values).__reduce__()
+            if graph is not None and obj is graph:
+                return _SharedRef("graph", None).__reduce__()
+            if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType, _SharedRef)) or type(obj).__reduce_ex__ is not object.__reduce_ex__:
+                return NotImplemented
+            getstate = getattr(obj, "__getstate__", None)
+            state = getstate() if getstate is not None else getattr(obj, "__dict__", None)
+            if not isinstance(state, dict):
+                return NotImplemented
+            # Cached properties (e.g. the views of a graph) are rebuilt when used.
+            state = {key: self._shared(value) for key, value in state.items() if not isinstance(getattr(type(obj), key, None), functools.cached_property)}
+            if isinstance(obj, nx.Graph):
+                state["_node"] = {node: self._shared(data) for node, data in state["_node"].items()}
+            return copyreg.__newobj__, (type(obj),), state
+        buffer = io.BytesIO()
+        _RunPickler(buffer, reducer_override).dump(run)
+        return buffer.getvalue()
+
+    def load(self, data, positions=None, graph=None):
+        # 'positions' selects the budgets of the copy, 'graph' is the graph of its legacy second path.
+        _load_context["shared"] = self.shared
+        _load_context["positions"] = positions
+        _load_context["graph"] = graph
+        try:
+            return pickle.loads(data)
+        finally:
+            _load_context.clear()
+
+class _RunPickler(pickle.Pickler):
+    def __init__(self, file, reducer):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.reducer = reducer
+
+    def reducer_override(self, obj):
+        return self.reducer(obj)
+
+# References of the copy being loaded by '_RunSnapshots.load'.
+_load_context = {}
+
+class _SharedRef:
+    # Placeholder of a shared object in a pickled run (see '_RunSnapshots').
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    def __reduce__(self):
+        return _resolve_shared, (self.kind, self.value)
+
+def _resolve_shared(kind, value):
+    if kind == "budget":
+        positions = _load_context["positions"]
+        return BudgetSet(value if positions is None else [value[i] for i in positions])
+    if kind == "graph":
+        return _load_context["graph"]
+    return _load_context["shared"][value]
+
+def _shared_objects(run):
+    # Objects referenced (not copied) by the sweep run copies.
+    shared = [run.precomputed_data, run.G_original, run.feasible, getattr(run.queue, "profit", None), getattr(run.second_path, "bridges", None)]
+    shared += list(run.precomputed_data.values())
+    if run.second_path is not None and not hasattr(run.second_path, "undo"):
+        # Second paths without state (see 'MaskedSecondPath') are shared as they are.
+        shared.append(run.second_path)
+    # The node attributes and the edge positions of the network are read, never modified.
+    shared += [run.G_new._node, run.G_new.edge_ids]
+    # The evaluation cache is shared too.
+    shared.append(run.memo)
+    return [obj for obj in shared if obj is not None]
+
+def _advance(run, snapshots):
+    # Runs 'run' until it finishes or its budgets diverge. Returns the finished run, or the runs that continue each 
+    # group of budgets from the start of the iteration that diverged.
+    while not run.finished():
+        if len(run.b.values) == 1:
+            if hasattr(run.second_path, "checkpoint"):
+                run.second_path.checkpoint(False)
+            run.step()
+            continue
+        if hasattr(run.second_path, "checkpoint"):
+            run.second_path.checkpoint()
+        data = snapshots.dump(run)
+        try:
+            run.step()
+        except BudgetDivergence as divergence:
+            graph = None
+            if hasattr(run.second_path, "undo"):
+                # Back to the graph of the start of the iteration.
+                run.second_path.undo(len(run.second_path.log))
+                graph = run.second_path.G
+            branches = []
+            for i, positions in enumerate(divergence.groups):
+                branch_graph = graph if i == 0 or graph is None else pickle.loads(pickle.dumps(graph))
+                branches.append(snapshots.load(data, positions, branch_graph))
+            return branches
+    return run
+
+def _run_branches(runs, snapshots):
+    # Runs to the end the given runs and the ones they fork into. Returns a list of (budgets, result).
+    results = []
+    while len(runs) > 0:
+        outcome = _advance(runs.pop(), snapshots)
+        if isinstance(outcome, list):
+            runs.extend(outcome)
+        else:
+            results.append((outcome.b.values, outcome.result()))
+    return results
+
+def sweep(G, budgets, origin, precomputed_data, workers=1, **options):
+    """
+    Runs 'greedy_network' for several budgets at once. All the budgets take the same greedy decisions until one of
+    them rejects a candidate that others accept (or parks one that others keep): the common part is run once, and at
+    each of these iterations the run is copied and continued separately for each group of budgets.
+    The results are the same as running 'greedy_network' for each budget.
+
+    Args:
+        G (nx undirected graph): original graph. If a legacy second path is used, each run modifies its own copy.
+        budgets (list): maximum costs (in €).
+        origin (int): Origin node of the reuse network graph. Must be a node in G.
+        precomputed_data (object): see "zmod_algorithms.precompute_data_lb_algorithms".
+        workers (int): if greater than 1, the runs that split off are run in a pool of this many processes.
+        options: other arguments of 'greedy_network' (profit, candidates, second_path, cost_model, feasible, 
+            failure_rate, memo, debug).
+    Returns:
+        results (dict): Dict keyed by budget with the (G_new, result_data, evaluation) tuples of 'greedy_network'.
+    """
+    budgets = sorted(set(budgets))
+    run = GreedyRun(G, BudgetSet(budgets), origin, precomputed_data, **options)
+    shared = _shared_objects(run)
+    snapshots = _RunSnapshots(shared)
+    results = []
+    if workers <= 1:
+        results = _run_branches([run], snapshots)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_sweep_worker, initargs=(shared,)) as pool:
+            # The common part runs here, the runs it splits into are sent to the pool.
+            runs = [run]
+            pending = []
+            while len(runs) > 0:
+                outcome = _advance(runs.pop(), snapshots)
+                if isinstance(outcome, list):
+                    for branch in outcome:
+                        pending.append(pool.apply_async(_sweep_worker, (snapshots.dump(branch, share_graph=False),)))
+                else:
+                    results.append((outcome.b.values, outcome.result()))
+            for async_result in pending:
+                results += async_result.get()
+    # Budgets that never diverged get their own copy of the same result.
+    outputs = {}
+    for values, result in results:
+        for i, value in enumerate(values):
+            outputs[value] = result if i == 0 else copy.deepcopy(result)
+    return outputs
+
+# Per process state of the sweep workers, set once by '_init_sweep_worker'.
+_sweep_state = {}
+
+def _init_sweep_worker(shared):
+    _sweep_state["snapshots"] = _RunSnapshots(shared)
+
+def _sweep_worker(data):
+    snapshots = _sweep_state["snapshots"]
+    return _run_branches([snapshots.load(data)], snapshots)
@@ -0,0 +1,263 @@
+########################################################################################################
+########################################################################################################
+################################### WORKING NETWORK ####################################################
+########################################################################################################
+########################################################################################################
+
+import hashlib
+import networkx as nx
+import numpy as np
+
+def zobrist_key(u, v):
+    """
+    Returns the 64 bit key of the edge u-v for 'NetworkOverlay.edge_hash': a hash of its sorted node ids, so it depends
+    only on the edge (not on its position in a graph) and is the same in every process.
+
+    Args:
+        u, v (int): nodes of the edge, in any order.
+    Returns:
+        key (int): key of the edge.
+    """
+    a, b = sorted((repr(u), repr(v)))
+    return int.from_bytes(hashlib.blake2b((a + "-" + b).encode(), digest_size=8).digest(), "little")
+
+def attribute_key(u, v, data):
+    """
+    Returns the 64 bit key of the attributes of the edge u-v for 'NetworkOverlay.attribute_hash': a hash of the edge and
+    its attributes, the same in every process. 0 if the edge has no attributes.
+
+    Args:
+        u, v (int): nodes of the edge, in any order.
+        data (dict): attributes of the edge.
+    Returns:
+        key (int): key of the attributes.
+    """
+    if len(data) == 0:
+        return 0
+    a, b = sorted((repr(u), repr(v)))
+    items = ",".join(str(key) + "=" + repr(data[key]) for key in sorted(data))
+    return int.from_bytes(hashlib.blake2b((a + "-" + b + ":" + items).encode(), digest_size=8).digest(), "little")
+
+def set_edge_attributes(graph, values):
+    # nx.set_edge_attributes with a dict of dicts keyed by edge, that keeps the hashes of a 'NetworkOverlay' up to date.
+    if isinstance(graph, NetworkOverlay):
+        graph.update_edges(values)
+    else:
+        nx.set_edge_attributes(graph, values)
+
+class NetworkOverlay:
+    """
+    Network under design as a subset of the edges of a street graph, without copying it: a boolean mask of the edges of
+    the base graph, the adjacency of the added edges and an undo log to discard the edges of a rejected candidate.
+    It reads like the graph the algorithms used to build edge by edge (nx.create_empty_copy(G) plus add_edge): all the
+    nodes of the base graph with their attributes (shared, not copied), the neighbors in the order their edges were
+    added, and only the edge attributes set on the network (e.g. by the cost models), not the ones of the base graph.
+    The networkx views and the functions that do not add nodes or set attributes (neighbors, degree, edges,
+    shortest_path, nx.Graph(network), ...) work on it.
+    'edge_hash' identifies its edge set (Zobrist hashing: the XOR of the keys of its edges, see 'zobrist_key'), updated
+    with each change, so two networks with the same edges have the same hash whatever the order the edges were added
+    in, or the order of the edges of the base graph.
+    'attribute_hash' does the same with the attributes of its edges (see 'attribute_key'), so both identify the network
+    as it would be simulated. The attributes must be set with 'update_edges' (or 'set_edge_attributes') to keep it up
+    to date.
+
+    Args:
+        G (nx undirected graph): base graph. It must not be modified while the overlay is in use.
+        edge_ids (dict): Dict keyed by (u,v) and (v,u) with the position of the edge in G.edges(), to share it between
+            the overlays of the same graph. Computed if not given.
+    """
+
+    def __init__(self, G, edge_ids=None):
+        self.base = G
+        self.graph = {}
+        self._node = G._node
+        self._adj = {node: {} for node in G}
+        if edge_ids is None:
+            edge_ids = {}
+            for i, (u,v) in enumerate(G.edges()):
+                edge_ids[(u,v)] = i
+                edge_ids[(v,u)] = i
+        self.edge_ids = edge_ids
+        self.edge_hash = 0
+        self.attribute_hash = 0
+        # Edges of the network, by position in G.edges().
+        self.mask = np.zeros(G.number_of_edges(), dtype=bool)
+        # Changes since the last 'commit': (u, v) for an added edge, (u, v, data, neighbors of u, neighbors of v) for a
+        # removed one.
+        self.log = []
+
+    #### Read only graph interface (networkx views work on '_node' and '_adj').
+
+    @property
+    def nodes(self):
+        return nx.reportviews.NodeView(self)
+
+    @property
+    def adj(self):
+        return nx.classes.coreviews.AdjacencyView(self._adj)
+
+    @property
+    def edges(self):
+        return nx.reportviews.EdgeView(self)
+
+    @property
+    def degree(self):
+        return nx.reportviews.DegreeView(self)
+
+    def is_directed(self):
+        return False
+
+    def is_multigraph(self):
+        return False
+
+    def __iter__(self):
+        return iter(self._node)
+
+    def __contains__(self, node):
+        return node in self._node
+
+    def __len__(self):
+        return len(self._node)
+
+    def __getitem__(self, node):
+        return self.adj[node]
+
+    def neighbors(self, node):
+        return iter(self._adj[node])
+
+    def has_node(self, node):
+        return node in self._node
+
+    def has_edge(self, u, v):
+        return u in self._adj and v in self._adj[u]
+
+    def number_of_nodes(self):
+        return len(self._node)
+
+    def number_of_edges(self):
+        return int(np.count_nonzero(self.mask))
+
+    #### Changes, undone by 'rollback'.
+
+    def add_edge(self, u, v, **attr):
+        """
+        Adds an edge of the base graph (or updates the attributes of an edge of the network).
+        """
+        if self.has_edge(u, v):
+            self.update_edges({(u,v): attr})
+            return
+        if (u,v) not in self.edge_ids:
+            raise nx.NetworkXError("The edge %s-%s is not in the base graph." % (u, v))
+        data = dict(attr)
+        self._adj[u][v] = data
+        self._adj[v][u] = data
+        self._toggle(u, v, True, data)
+        self.log.append((u, v))
+
+    def add_edges_from(self, ebunch):
+        for edge in ebunch:
+            self.add_edge(edge[0], edge[1], **(edge[2] if len(edge) > 2 else {}))
+
+    def remove_edge(self, u, v):
+        if not self.has_edge(u, v):
+            raise nx.NetworkXError("The edge %s-%s is not in the network." % (u, v))
+        data = self._adj[u][v]
+        self.log.append((u, v, data, list(self._adj[u]), list(self._adj[v])))
+        del self._adj[u][v]
+        del self._adj[v][u]
+        self._toggle(u, v, False, data)
+
+    def remove_edges_from(self, ebunch):
+        for u, v in ebunch:
+            if self.has_edge(u, v):
+                self.remove_edge(u, v)
+
+    def update_edges(self, values):
+        """
+        Updates the attributes of the edges of the network, as nx.set_edge_attributes with a dict of dicts keyed by edge
+        (the edges that are not in the network are skipped), and 'attribute_hash' with them. Not undone by 'rollback'.
+        """
+        for (u, v), attrs in values.items():
+            if not self.has_edge(u, v):
+                continue
+            data = self._adj[u][v]
+            self.attribute_hash ^= attribute_key(u, v, data)
+            data.update(attrs)
+            self.attribute_hash ^= attribute_key(u, v, data)
+
+    def commit(self):
+        # The changes so far are kept, 'rollback' undoes only the following ones.
+        self.log = []
+
+    def rollback(self):
+        """
+        Undoes the changes since the last 'commit'. The neighbors get back their order, so the network is the same as if
+        the changes had never been made.
+        """
+        while len(self.log) > 0:
+            change = self.log.pop()
+            u, v = change[0], change[1]
+            if len(change) == 2:
+                data = self._adj[u].pop(v)
+                del self._adj[v][u]
+                self._toggle(u, v, False, data)
+            else:
+                data, neighbors_u, neighbors_v = change[2:]
+                for node, neighbors, other in ((u, neighbors_u, v), (v, neighbors_v, u)):
+                    adjacency = self._adj[node]
+                    adjacency[other] = data
+                    restored = {neighbor: adjacency[neighbor] for neighbor in neighbors}
+                    adjacency.clear()
+                    adjacency.update(restored)
+                self._toggle(u, v, True, data)
+
+    def _toggle(self, u, v, value, data):
+        # Adds (or removes) the edge u-v, with attributes 'data', to the mask and the hashes.
+        self.mask[self.edge_ids[(u,v)]] = value
+        self.edge_hash ^= zobrist_key(u, v)
+        self.attribute_hash ^= attribute_key(u, v, data)
+
+    #### Transfer and materialisation.
+
+    def active_adjacency(self):
+        # Adjacency of the nodes with edges (in node order, neighbors in the order of the network), for 'load_adjacency'.
+        return {node: neighbors for node, neighbors in self._adj.items() if len(neighbors) > 0}
+
+    def load_adjacency(self, adjacency):
+        """
+        Replaces the edges of the network by the ones of an 'active_adjacency' (e.g. sent by another process), with the
+        same order of the neighbors. The undo log is cleared.
+        """
+        for node in self.active_adjacency():
+            self._adj[node] = {}
+        self.mask[:] = False
+        self.edge_hash = 0
+        self.attribute_hash = 0
+        for node, neighbors in adjacency.items():
+            self._adj[node] = neighbors
+            for neighbor, data in neighbors.items():
+                if not self.mask[self.edge_ids[(node,neighbor)]]:
+                    self._toggle(node, neighbor, True, data)
+        self.log = []
+
+    def to_graph(self, base_attributes=False):
+        """
+        Materialises the network as a nx graph with the nodes that have edges (and a copy of their attributes). Nodes and
+        edges are in the same order as in nx.Graph(network) once its isolated nodes are removed.
+
+        Args:
+            base_attributes (bool): if true, the edges get a copy of their attributes in the base graph (e.g. "length")
+                instead of the ones set on the network.
+        Returns:
+            graph (nx undirected graph): the network.
+        """
+        graph = nx.Graph()
+        nodes = list(self.active_adjacency())
+        graph.add_nodes_from((node, self._node[node]) for node in nodes)
+        seen = set()
+        for u in nodes:
+            for v, data in self._adj[u].items():
+                if v not in seen:
+                    graph.add_edge(u, v, **(self.base[u][v] if base_attributes else data))
+            seen.add(u)
+        return graph
@@ -12,6 +12,8 @@ import folium
 import matplotlib.lines as mlines
 import matplotlib.pyplot as plt
 
+import zmod_connectivity
+
 sns.set_theme(style="darkgrid")
 
 # [Roser] Function that prints a clustered solution.
@@ -291,14 +293,10 @@ def plot_network_with_folium(G_original, G_result, origin, precomputed_data, to_
     # Resulting network graph: Reclaimed water network in opac purple. Including popup with edge lengths.
     m = ox.plot_graph_folium(nx.MultiDiGraph(G_result), popup_attribute="length", graph_map = m, weight=2, color="#a259ff")
 
-    # Get critical edges.
-    G_test = nx.Graph(G_result)
+    # Get critical edges (see 'zmod_connectivity.bridge_index').
+    bridges = zmod_connectivity.bridge_index(G_result)
     G_critical = nx.Graph(G_result)
-    for u,v in G_result.edges():
-        G_test.remove_edge(u,v)
-        if nx.is_connected(G_test):
-            G_critical.remove_edge(u,v)
-        G_test.add_edge(u,v)
+    G_critical.remove_edges_from([(u,v) for u,v in G_result.edges() if not zmod_connectivity.is_critical(bridges, u, v)])
     m = ox.plot_graph_folium(nx.MultiDiGraph(G_critical), graph_map = m, weight=2, color="#FF0000")
     
     # Add nodes in graph with different gradient color from red to green depending on their consumption (red = Low cons, green = High cons).
@@ -469,14 +467,10 @@ def plot_network_with_folium_hydraulic(G_original, G_result, origin, node_data,
     # Resulting network graph: Reclaimed water network in opac purple. Including popup with edge lengths.
     m = ox.plot_graph_folium(nx.MultiDiGraph(G_result), popup_attribute="length", graph_map = m, weight=2, color="#a259ff")
 
-    # Get critical edges.
-    G_test = nx.Graph(G_result)
+    # Get critical edges (see 'zmod_connectivity.bridge_index').
+    bridges = zmod_connectivity.bridge_index(G_result)
     G_critical = nx.Graph(G_result)
-    for u,v in G_result.edges():
-        G_test.remove_edge(u,v)
-        if nx.is_connected(G_test):
-            G_critical.remove_edge(u,v)
-        G_test.add_edge(u,v)
+    G_critical.remove_edges_from([(u,v) for u,v in G_result.edges() if not zmod_connectivity.is_critical(bridges, u, v)])
     m = ox.plot_graph_folium(nx.MultiDiGraph(G_critical), graph_map = m, weight=2, color="#FF0000")
     
     for node, data in G_result.nodes(data = True):
@@ -0,0 +1,129 @@
+########################################################################################################
+########################################################################################################
+################################### GRAPH REDUCTION ####################################################
+########################################################################################################
+########################################################################################################
+
+import networkx as nx
+
+def contract_chains(G, keep=()):
+    """
+    Contracts the chains of degree 2 nodes without consumption (street segments split by OSM) into single edges, so that
+    the precomputations, the algorithms and EPANET work on less nodes. Consumption nodes and the nodes in 'keep' (e.g. the
+    origin) are never contracted. Chains that would become a self loop or an edge parallel to an existing one are left
+    as they are. Nothing contracts the graph implicitly: pass the reduced graph to the precomputation and the algorithms,
+    and expand their results with 'expand_graph', or let the algorithms do it
+    (see the 'reduce' option of 'zmod_algorithms.precompute_data_lb_algorithms').
+    The shortest path lengths between the kept nodes do not change, but the designs are an approximation of the ones of
+    the original graph, not the same: the interior nodes of a chain can no longer be attachment points of new paths, and
+    the BFS order by hops of the diameter selection and of the consumption aggregation changes, so flows, diameters and
+    costs can differ.
+
+    Args:
+        G (nx undirected graph): city street graph with the "length" edge and "consumption" node attributes.
+        keep (iterable): nodes that must stay in the reduced graph.
+    Returns:
+        G_reduced (nx undirected graph): reduced graph. Contracted edges have the total "length" and a "chain" attribute
+            with the original nodes from one end to the other (both ends included). Other edges keep their attributes.
+    """
+    keep = set(keep)
+
+    def contractible(node):
+        return node not in keep and G.degree(node) == 2 and G.nodes[node]["consumption"] == 0 and not G.has_edge(node, node)
+
+    G_reduced = nx.Graph(G)
+    visited = set()
+    for node in G.nodes():
+        if node in visited or not contractible(node):
+            continue
+        # Walk the chain in both directions from 'node' until a node that is kept.
+        ends = []
+        for neighbor in G.neighbors(node):
+            side = []
+            prev, current = node, neighbor
+            while current != node and contractible(current):
+                side.append(current)
+                prev, current = current, next(n for n in G.neighbors(current) if n != prev)
+            ends.append((side, current))
+        (left, u), (right, v) = ends
+        interior = list(reversed(left)) + [node] + right
+        visited.update(interior)
+        if u == node or u == v or G_reduced.has_edge(u, v):
+            # Ring without kept nodes, self loop or parallel edge.
+            continue
+        chain = [u] + interior + [v]
+        length = sum(G[a][b]["length"] for a, b in zip(chain, chain[1:]))
+        G_reduced.remove_nodes_from(interior)
+        G_reduced.add_edge(u, v, length=length, chain=chain)
+    return G_reduced
+
+def expand_path(G_reduced, path):
+    """
+    Expands a path (list of nodes) of the reduced graph into the path of the original street graph.
+
+    Args:
+        G_reduced (nx undirected graph): reduced graph (see 'contract_chains').
+        path (list): nodes of the path in the reduced graph.
+    Returns:
+        path (list): nodes of the path in the original graph.
+    """
+    expanded = path[:1]
+    for u, v in zip(path, path[1:]):
+        chain = G_reduced[u][v].get("chain")
+        if chain is None:
+            expanded.append(v)
+        elif chain[0] == u:
+            expanded.extend(chain[1:])
+        else:
+            expanded.extend(reversed(chain[:-1]))
+    return expanded
+
+def expand_graph(G, G_result, G_reduced=None):
+    """
+    Expands a result network built on the reduced graph (e.g. the graph returned by 'lbr_algorithm_hydraulic' or the
+    EPANET test graph) back to the original street segments, for plotting and reporting.
+    Each contracted edge becomes its segments, with their original attributes plus the result attributes of the edge
+    (flow, diameter, ...). A valve of a contracted edge is kept only in its first segment, so that the valves (and their
+    costs) are not counted once per segment.
+
+    Args:
+        G (nx undirected graph): original city street graph, before 'contract_chains'.
+        G_result (nx undirected graph): result network with nodes and edges of the reduced graph.
+        G_reduced (nx undirected graph): if given, the reduced graph the chains are read from, for results whose edges
+            do not keep the "chain" attribute.
+    Returns:
+        G_expanded (nx undirected graph): result network with nodes and edges of G.
+    """
+    G_expanded = nx.Graph()
+    G_expanded.add_nodes_from(G_result.nodes(data=True))
+    for u, v, data in G_result.edges(data=True):
+        chain = (data if G_reduced is None else G_reduced[u][v]).get("chain", [u, v])
+        result_attrs = {key: value for key, value in data.items() if key not in ("length", "chain")}
+        for i, (a, b) in enumerate(zip(chain, chain[1:])):
+            if a not in G_expanded:
+                G_expanded.add_node(a, **G.nodes[a])
+            attrs = dict(G[a][b])
+            attrs.update(result_attrs)
+            if i > 0:
+                attrs.pop("valve", None)
+            G_expanded.add_edge(a, b, **attrs)
+    return G_expanded
+
+def expand_links(G_reduced, link_data):
+    """
+    Expands the link results of EPANET (see 'zmod_epanet.compute_epanet') on a network of the reduced graph to the
+    original street segments. The flow, velocity and headloss are the same along a pipe, so each segment of a
+    contracted edge gets the results of its edge, keyed in the direction of the link.
+
+    Args:
+        G_reduced (nx undirected graph): reduced graph (see 'contract_chains').
+        link_data (dict): link results keyed by (u,v) edges of the reduced graph.
+    Returns:
+        link_data (dict): link results keyed by (u,v) edges of the original graph.
+    """
+    expanded = {}
+    for (u, v), data in link_data.items():
+        path = expand_path(G_reduced, [u, v])
+        for a, b in zip(path, path[1:]):
+            expanded[(a, b)] = data
+    return expanded
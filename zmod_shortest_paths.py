@@ -0,0 +1,931 @@
+########################################################################################################
+########################################################################################################
+################################### SHORTEST PATHS (ARRAY BACKEND) #####################################
+########################################################################################################
+########################################################################################################
+
+import heapq
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import count
+
+# Number of sources solved per Dijkstra call. Keeps the temporary float64 output of scipy bounded.
+block_size = 256
+
+def build_node_index(G):
+    """
+    Maps the nodes of a graph to contiguous indices, so that they can be used as rows/columns of a matrix.
+
+    Args:
+        G (nx undirected graph): city street graph.
+    Returns:
+        nodes (list): Node id for each index.
+        index (dict): Dict keyed by node id with value its index.
+    """
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    return nodes, index
+
+def build_csr_graph(G, index, weight='length'):
+    """
+    Builds a symmetric CSR matrix with the edge weights of an undirected graph.
+    Zero length edges are kept as explicit entries, scipy csgraph treats them as edges.
+
+    Args:
+        G (nx undirected graph): city street graph.
+        index (dict): Dict keyed by node id with value its index (see 'build_node_index').
+        weight (string): edge attribute used as weight.
+    Returns:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+    """
+    n_edges = G.number_of_edges()
+    rows = np.empty(2*n_edges, dtype=np.int32)
+    cols = np.empty(2*n_edges, dtype=np.int32)
+    data = np.empty(2*n_edges, dtype=np.float64)
+    i = 0
+    for u,v,w in G.edges(data=weight, default=1):
+        rows[i], cols[i], data[i] = index[u], index[v], w
+        rows[i+1], cols[i+1], data[i+1] = index[v], index[u], w
+        i += 2
+    n = len(index)
+    return sp.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+def all_sources_distances(csr, sources=None, dtype=np.float32, return_predecessors=False, limit=np.inf):
+    """
+    Runs Dijkstra from the given sources of the CSR graph and stores the distances in a single dense matrix.
+    Sources are solved in blocks of 'block_size' rows and cast to 'dtype' to keep memory bounded.
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+        sources (numpy array): node indices used as sources (one row each), all the nodes by default.
+        dtype (numpy dtype): type of the resulting matrix, float32 by default.
+        return_predecessors (bool): if true, also return the int32 predecessor matrix of the shortest path trees.
+        limit (double): maximum distance searched. Farther nodes are left unreachable.
+    Returns:
+        dist (numpy array): S x V matrix with the shortest path lengths (inf if unreachable).
+        pred (numpy array): Only if 'return_predecessors'. S x V matrix where pred[r,v] is the node before v in the
+            shortest path from sources[r] to v (-1 for the source itself and for unreachable nodes).
+    """
+    n = csr.shape[0]
+    if sources is None:
+        sources = np.arange(n)
+    dist = np.empty((len(sources), n), dtype=dtype)
+    if return_predecessors:
+        pred = np.empty((len(sources), n), dtype=np.int32)
+    for start in range(0, len(sources), block_size):
+        rows = slice(start, min(start+block_size, len(sources)))
+        if return_predecessors:
+            dist[rows], block_pred = dijkstra(csr, directed=True, indices=sources[rows], return_predecessors=True, limit=limit)
+            pred[rows] = np.where(block_pred < 0, -1, block_pred)
+        else:
+            dist[rows] = dijkstra(csr, directed=True, indices=sources[rows], limit=limit)
+    if return_predecessors:
+        return dist, pred
+    return dist
+
+class PairTable(Mapping):
+    """
+    Read only dict-of-dicts view keyed by node ids, so that the algorithms can still index it as [u][v].
+    Values are stored by rows, one per source node. When only some sources are stored, [u][v] is answered from the row
+    of v if u has no row (the graph is undirected). Subclasses implement 'value(s, t)' and 'reverse_value(s, t)' with
+    node indices, where s has a row.
+    """
+
+    def __init__(self, nodes, index, sources=None):
+        self.nodes = nodes
+        self.index = index
+        if sources is None:
+            self.rows = None
+        else:
+            self.rows = {s: r for r, s in enumerate(sources)}
+
+    def row(self, s):
+        # Row of the node index 's', or None if it is not a source.
+        if self.rows is None:
+            return s
+        return self.rows.get(s)
+
+    def value(self, s, t):
+        raise NotImplementedError
+
+    def reverse_value(self, s, t):
+        # Value for the pair (t, s) computed from the row of s.
+        raise NotImplementedError
+
+    def get(self, u, v):
+        s = self.index[u]
+        t = self.index[v]
+        if self.row(s) is not None:
+            return self.value(s, t)
+        if self.row(t) is not None:
+            return self.reverse_value(t, s)
+        raise KeyError((u, v))
+
+    def __getitem__(self, u):
+        if u not in self.index:
+            raise KeyError(u)
+        return _TableRow(self, u)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, u):
+        return u in self.index
+
+class _TableRow(Mapping):
+    # Row of a 'PairTable', keyed by destination node.
+
+    def __init__(self, table, u):
+        self.table = table
+        self.u = u
+
+    def __getitem__(self, v):
+        return self.table.get(self.u, v)
+
+    def __iter__(self):
+        return iter(self.table.nodes)
+
+    def __len__(self):
+        return len(self.table.nodes)
+
+    def __contains__(self, v):
+        return v in self.table.index
+
+class MatrixTable(PairTable):
+    """
+    'PairTable' over a dense S x V matrix of symmetric values (distances).
+    Unreachable pairs return inf instead of raising KeyError.
+    """
+
+    def __init__(self, matrix, nodes, index, sources=None):
+        PairTable.__init__(self, nodes, index, sources)
+        self.matrix = matrix
+
+    def value(self, s, t):
+        return float(self.matrix[self.row(s), t])
+
+    def reverse_value(self, s, t):
+        return float(self.matrix[self.row(s), t])
+
+    def row_values(self, r, columns):
+        # Values of the stored row r at the given node indices.
+        return self.matrix[r, columns]
+
+    def column_values(self, rows, t):
+        # Values of the given stored rows at the node index t.
+        return self.matrix[rows, t]
+
+class ConsumptionTable(MatrixTable):
+    """
+    'MatrixTable' with the consumption of the nodes of each shortest path, source excluded and destination included.
+    The reversed path of (t, s) excludes t instead of s, so 'reverse_value' corrects it with the node consumptions.
+    """
+
+    def __init__(self, matrix, nodes, index, cons_array, sources=None):
+        MatrixTable.__init__(self, matrix, nodes, index, sources)
+        self.cons_array = cons_array
+
+    def reverse_value(self, s, t):
+        return float(self.matrix[self.row(s), t] + self.cons_array[s] - self.cons_array[t])
+
+class PathTable(PairTable):
+    """
+    'PairTable' over a predecessor matrix. Paths (list of node ids, both ends included) are rebuilt on demand walking
+    the shortest path tree of the source, so only the paths that are actually used are ever materialised.
+    """
+
+    def __init__(self, pred, nodes, index, sources=None):
+        PairTable.__init__(self, nodes, index, sources)
+        self.pred = pred
+
+    def value(self, s, t):
+        return [self.nodes[i] for i in self.path_indices(s, t)]
+
+    def reverse_value(self, s, t):
+        return [self.nodes[i] for i in reversed(self.path_indices(s, t))]
+
+    def path_indices(self, s, t):
+        # Walk the predecessors from t back to s ('s' must have a row).
+        return _walk_predecessors(self.pred[self.row(s)], s, t, self.nodes)
+
+def _walk_predecessors(pred, s, t, nodes):
+    # Path of node indices from s to t in the shortest path tree 'pred' of s.
+    path = [t]
+    while t != s:
+        t = pred[t]
+        if t < 0:
+            raise KeyError(nodes[path[0]])
+        path.append(t)
+    path.reverse()
+    return path
+
+def path_consumptions(pred, cons_array, out=None, block=None):
+    """
+    Computes, for every stored row, the consumption of the nodes of the shortest path from the source to each node
+    (source excluded, destination included). Each row of 'pred' is a shortest path tree, so the sums are accumulated
+    down the tree by pointer jumping: every pass doubles the stretch of path summed by each node, so a row needs
+    log2(depth) vectorised passes instead of walking every path.
+
+    Args:
+        pred (numpy array): S x V predecessor matrix (see 'all_sources_distances').
+        cons_array (numpy array): consumption of each node index.
+        out (numpy array): S x V float64 array to write into instead of allocating it (e.g. a memory map).
+        block (int): rows accumulated at once, 'block_size' by default.
+    Returns:
+        total_cons (numpy array): S x V float64 matrix aligned with 'pred' (0 for the source and unreachable nodes).
+    """
+    n_rows, n = pred.shape
+    if block is None:
+        block = block_size
+    total_cons = out
+    if total_cons is None:
+        total_cons = np.empty((n_rows, n), dtype=np.float64)
+    for start in range(0, n_rows, block):
+        rows = slice(start, min(start+block, n_rows))
+        jump = pred[rows].astype(np.int64)
+        # Sources and unreachable nodes point to themselves with value 0, so adding them again changes nothing.
+        no_pred = jump < 0
+        jump[no_pred] = np.nonzero(no_pred)[1]
+        values = np.where(no_pred, 0.0, cons_array[np.newaxis, :])
+        next_jump = np.take_along_axis(jump, jump, axis=1)
+        while not np.array_equal(next_jump, jump):
+            values += np.take_along_axis(values, jump, axis=1)
+            jump = next_jump
+            next_jump = np.take_along_axis(jump, jump, axis=1)
+        total_cons[rows] = values
+    return total_cons
+
+def shortest_path_rows(csr, cons_array=None, sources=None, workers=1, out=None, block=None):
+    """
+    Computes the distance, predecessor and (optionally) path consumption rows of the given sources.
+    With workers > 1 the sources are split across a process pool. The matrices live in shared memory blocks (or in the
+    memory mapped .npy files given in 'out') and every worker writes its own rows straight into them, so nothing but the
+    row ranges travels between processes.
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+        cons_array (numpy array): consumption of each node index. If None, the path consumptions are not computed.
+        sources (numpy array): node indices used as sources (one row each), all the nodes by default.
+        workers (int): number of processes.
+        out (tuple): arrays to write the rows into instead of allocating them, e.g. memory maps from 'np.lib.format.open_memmap'
+            to stream the rows to disk. Only one block of rows per process is then kept in memory.
+        block (int): rows solved at once, 'block_size' by default.
+    Returns:
+        dist (numpy array): S x V float32 matrix with the shortest path lengths (see 'all_sources_distances').
+        pred (numpy array): S x V int32 predecessor matrix (see 'all_sources_distances').
+        total_cons (numpy array): Only if 'cons_array' is given. S x V float64 path consumptions (see 'path_consumptions').
+    """
+    n = csr.shape[0]
+    if sources is None:
+        sources = np.arange(n)
+    if block is None:
+        block = block_size
+    dtypes = [np.float32, np.int32]
+    if cons_array is not None:
+        dtypes.append(np.float64)
+    chunks = [(start, min(start+block, len(sources))) for start in range(0, len(sources), block)]
+
+    if workers <= 1 or len(chunks) <= 1:
+        if out is None:
+            out = tuple(np.empty((len(sources), n), dtype=dtype) for dtype in dtypes)
+        for start, stop in chunks:
+            _write_rows(csr, cons_array, sources, out, start, stop)
+        return out
+
+    blocks = []
+    try:
+        if out is None or not all(isinstance(array, np.memmap) for array in out):
+            blocks = [shared_memory.SharedMemory(create=True, size=max(1, len(sources)*n*np.dtype(dtype).itemsize)) for dtype in dtypes]
+            layout = [("shm", block.name, dtype) for block, dtype in zip(blocks, dtypes)]
+        else:
+            for array in out:
+                array.flush()
+            layout = [("file", array.filename, dtype) for array, dtype in zip(out, dtypes)]
+        with multiprocessing.Pool(workers, initializer=_init_rows_worker, initargs=(csr, cons_array, sources, layout)) as pool:
+            pool.map(_rows_worker, chunks)
+        if not blocks:
+            return out
+        # Copy out of the shared blocks so that they can be released.
+        shared = [np.ndarray((len(sources), n), dtype=dtype, buffer=block.buf) for block, dtype in zip(blocks, dtypes)]
+        if out is None:
+            return tuple(array.copy() for array in shared)
+        for target, array in zip(out, shared):
+            target[:] = array
+        return out
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def _write_rows(csr, cons_array, sources, out, start, stop):
+    # Solves the rows [start, stop) and writes them into the 'out' arrays.
+    dist, pred = all_sources_distances(csr, sources[start:stop], return_predecessors=True)
+    out[0][start:stop] = dist
+    out[1][start:stop] = pred
+    if cons_array is not None:
+        out[2][start:stop] = path_consumptions(pred, cons_array)
+
+# Per process state of the precompute workers, set once by '_init_rows_worker'.
+_worker_state = {}
+
+def _init_rows_worker(csr, cons_array, sources, layout):
+    n = csr.shape[0]
+    _worker_state["csr"] = csr
+    _worker_state["cons_array"] = cons_array
+    _worker_state["sources"] = sources
+    _worker_state["blocks"] = []
+    arrays = []
+    for kind, name, dtype in layout:
+        if kind == "shm":
+            block = shared_memory.SharedMemory(name=name)
+            _worker_state["blocks"].append(block)
+            arrays.append(np.ndarray((len(sources), n), dtype=dtype, buffer=block.buf))
+        else:
+            arrays.append(np.load(name, mmap_mode='r+'))
+    _worker_state["arrays"] = arrays
+
+def _rows_worker(chunk):
+    start, stop = chunk
+    _write_rows(_worker_state["csr"], _worker_state["cons_array"], _worker_state["sources"], _worker_state["arrays"], start, stop)
+    for array in _worker_state["arrays"]:
+        if isinstance(array, np.memmap):
+            array.flush()
+
+def plan_storage(n_nodes, n_consumers, max_memory_bytes):
+    """
+    Chooses how to store the precomputed tables of a graph within a memory budget, from the cheapest to the most
+    degraded layout: every row in memory, only the consumer rows in memory, or the consumer rows streamed to disk in
+    chunks (memory maps, the OS page cache keeps what fits).
+    Each stored row takes 16 bytes per node: float32 distance, int32 predecessor and float64 path consumption.
+
+    Args:
+        n_nodes (int): number of nodes V.
+        n_consumers (int): number of rows needed with consumer rows only (consumption nodes plus origin).
+        max_memory_bytes (int): memory budget for the tables.
+    Returns:
+        plan (object): Includes the following:
+            "layout" (string): "dense", "consumers" or "disk".
+            "rows" (int): number of stored rows.
+            "block" (int): rows solved at once.
+            "estimated_bytes" (int): estimated peak memory of the tables plus the working block (only the block for "disk").
+            "max_memory_bytes" (int): the given budget.
+    """
+    row_bytes = 16*n_nodes
+    # Working memory per row being solved: scipy float64 distances and int32 predecessors plus the pointer jumping arrays.
+    work_row_bytes = 40*n_nodes
+    plan = {"max_memory_bytes": max_memory_bytes}
+    for layout, rows in (("dense", n_nodes), ("consumers", n_consumers)):
+        # The rows stay in memory, the blocks being solved use what is left of the budget.
+        block = min(block_size, int((max_memory_bytes - rows*row_bytes) // work_row_bytes))
+        if block >= 1:
+            plan.update({"layout": layout, "rows": rows, "block": block, "estimated_bytes": rows*row_bytes + block*work_row_bytes})
+            return plan
+    # Only a block of rows is in memory at once, the rest is written to disk.
+    block = max(1, min(block_size, int(max_memory_bytes // (row_bytes + work_row_bytes))))
+    plan.update({"layout": "disk", "rows": n_consumers, "block": block, "estimated_bytes": block*(row_bytes + work_row_bytes)})
+    return plan
+
+########################################################################################################
+################################### LAZY ROWS ##########################################################
+########################################################################################################
+
+class LazyRows:
+    """
+    Shortest path rows computed on demand: the first time the row of a source is needed it is solved with a single
+    source Dijkstra and kept in an LRU cache of at most 'max_rows' rows, so memory stays bounded and nothing is
+    computed in advance.
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+        max_rows (int): maximum number of cached rows.
+        limit (double): maximum distance searched from each source (see 'SparseRows').
+    """
+
+    def __init__(self, csr, max_rows=1024, limit=np.inf):
+        if max_rows < 1:
+            raise ValueError("Lazy rows need max_rows >= 1.")
+        self.csr = csr
+        self.max_rows = max_rows
+        self.limit = limit
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, s):
+        return s in self.cache
+
+    def get(self, s):
+        """
+        Returns the row of the node index 's' as a (dist, pred) tuple of V float32 and V int32 arrays
+        (see 'all_sources_distances'), solving it if it is not cached.
+        """
+        row = self.cache.get(s)
+        if row is not None:
+            self.hits += 1
+            self.cache.move_to_end(s)
+            return row
+        self.misses += 1
+        dist, pred = all_sources_distances(self.csr, np.array([s]), return_predecessors=True, limit=self.limit)
+        row = (dist[0], pred[0])
+        self.cache[s] = row
+        if len(self.cache) > self.max_rows:
+            self.cache.popitem(last=False)
+        return row
+
+class LazyTable(PairTable):
+    """
+    'PairTable' where any node can have a row, computed on demand. [u][v] is answered from the row of u, unless only
+    v has its row cached (the graph is undirected). Subclasses implement 'cached(s)', 'value(s, t)' and
+    'reverse_value(s, t)'.
+    """
+
+    def __init__(self, lazy_rows, nodes, index):
+        PairTable.__init__(self, nodes, index)
+        self.lazy_rows = lazy_rows
+
+    def cached(self, s):
+        return s in self.lazy_rows
+
+    def get(self, u, v):
+        s = self.index[u]
+        t = self.index[v]
+        if not self.cached(s) and self.cached(t):
+            return self.reverse_value(t, s)
+        return self.value(s, t)
+
+class LazyMatrixTable(LazyTable):
+    # 'MatrixTable' over the distances of some 'LazyRows'.
+
+    def value(self, s, t):
+        return float(self.lazy_rows.get(s)[0][t])
+
+    def reverse_value(self, s, t):
+        return float(self.lazy_rows.get(s)[0][t])
+
+class LazyPathTable(LazyTable):
+    # 'PathTable' over the predecessors of some 'LazyRows'.
+
+    def value(self, s, t):
+        return [self.nodes[i] for i in self.path_indices(s, t)]
+
+    def reverse_value(self, s, t):
+        return [self.nodes[i] for i in reversed(self.path_indices(s, t))]
+
+    def path_indices(self, s, t):
+        return _walk_predecessors(self.lazy_rows.get(s)[1], s, t, self.nodes)
+
+class LazyConsumptionTable(LazyTable):
+    """
+    'ConsumptionTable' over the predecessors of some 'LazyRows'. The path consumptions of a row are accumulated when
+    the row is first needed and kept in a cache of its own (same limit), so that the rows of 'LazyRows' can be shared
+    by the tables of different consumptions.
+    """
+
+    def __init__(self, lazy_rows, nodes, index, cons_array):
+        LazyTable.__init__(self, lazy_rows, nodes, index)
+        self.cons_array = cons_array
+        self.cache = OrderedDict()
+
+    def cached(self, s):
+        return s in self.cache
+
+    def consumption_row(self, s):
+        row = self.cache.get(s)
+        if row is not None:
+            self.cache.move_to_end(s)
+            return row
+        row = path_consumptions(self.lazy_rows.get(s)[1][np.newaxis, :], self.cons_array)[0]
+        self.cache[s] = row
+        if len(self.cache) > self.lazy_rows.max_rows:
+            self.cache.popitem(last=False)
+        return row
+
+    def value(self, s, t):
+        return float(self.consumption_row(s)[t])
+
+    def reverse_value(self, s, t):
+        return float(self.consumption_row(s)[t] + self.cons_array[s] - self.cons_array[t])
+
+########################################################################################################
+################################### SPARSE ROWS ########################################################
+########################################################################################################
+
+class SparseRows:
+    """
+    Shortest path rows cut at a maximum distance: each source is solved with a Dijkstra limited to 'limit' and only the
+    nodes within it are stored, in CSR layout (row pointers, sorted node indices, distances and predecessors). Memory
+    and time grow with the pairs within the limit instead of S x V. Farther nodes are unreachable (inf).
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+        sources (numpy array): node indices used as sources (one row each), all the nodes by default.
+        limit (double): maximum distance searched from each source.
+        block (int): rows solved at once, 'block_size' by default.
+        arrays (dict): "indptr", "indices", "dist" and "pred" arrays of already computed rows (e.g. from a cache), so that
+            nothing is solved.
+    """
+
+    def __init__(self, csr, sources=None, limit=np.inf, block=None, arrays=None):
+        self.n = csr.shape[0]
+        self.limit = limit
+        if sources is None:
+            sources = np.arange(self.n)
+        if block is None:
+            block = block_size
+        self.block = block
+        if arrays is None:
+            arrays = self._solve(csr, sources)
+        self.indptr = arrays["indptr"]
+        self.indices = arrays["indices"]
+        self.dist = arrays["dist"]
+        self.pred = arrays["pred"]
+
+    def _solve(self, csr, sources):
+        counts, indices, dist, pred = [], [], [], []
+        for start in range(0, len(sources), self.block):
+            block_dist, block_pred = all_sources_distances(csr, sources[start:start+self.block], return_predecessors=True, limit=self.limit)
+            reached = np.isfinite(block_dist)
+            counts.append(np.count_nonzero(reached, axis=1))
+            # Row major order, so the node indices of each row are sorted.
+            indices.append(np.nonzero(reached)[1].astype(np.int32))
+            dist.append(block_dist[reached])
+            pred.append(block_pred[reached])
+        indptr = np.zeros(len(sources)+1, dtype=np.int64)
+        if len(counts) > 0:
+            np.cumsum(np.concatenate(counts), out=indptr[1:])
+        return {
+            "indptr": indptr,
+            "indices": np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+            "dist": np.concatenate(dist) if dist else np.empty(0, dtype=np.float32),
+            "pred": np.concatenate(pred) if pred else np.empty(0, dtype=np.int32)
+        }
+
+    def arrays(self):
+        # Arrays of the rows, to store them (see 'zmod_cache.save_arrays').
+        return {"indptr": self.indptr, "indices": self.indices, "dist": self.dist, "pred": self.pred}
+
+    def positions(self, r, columns):
+        """
+        Returns the positions of the entries of the row r at the given node indices, -1 where they are not stored.
+        """
+        start, stop = self.indptr[r], self.indptr[r+1]
+        row = self.indices[start:stop]
+        if len(row) == 0:
+            return np.full(np.shape(columns), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(row, columns), len(row)-1)
+        return np.where(row[found] == columns, start + found, -1)
+
+    def position(self, r, t):
+        # Position of the entry of the row r at the node index t, or -1.
+        return int(self.positions(r, np.array([t]))[0])
+
+    def path_consumptions(self, cons_array):
+        """
+        Consumption of the nodes of the shortest path of each stored entry (see 'path_consumptions'), aligned with
+        the entries. The rows are expanded a block at a time.
+        """
+        total_cons = np.empty(len(self.indices), dtype=np.float64)
+        n_rows = len(self.indptr)-1
+        for start in range(0, n_rows, self.block):
+            stop = min(start+self.block, n_rows)
+            first, last = self.indptr[start], self.indptr[stop]
+            rows = np.repeat(np.arange(stop-start), np.diff(self.indptr[start:stop+1]))
+            pred = np.full((stop-start, self.n), -1, dtype=np.int32)
+            pred[rows, self.indices[first:last]] = self.pred[first:last]
+            total_cons[first:last] = path_consumptions(pred, cons_array)[rows, self.indices[first:last]]
+        return total_cons
+
+class _SparsePredecessors:
+    # Predecessor row of a 'SparseRows', indexed by node index like a dense one (-1 for the nodes not stored).
+
+    def __init__(self, sparse_rows, r):
+        self.sparse_rows = sparse_rows
+        self.r = r
+
+    def __getitem__(self, t):
+        position = self.sparse_rows.position(self.r, t)
+        if position < 0:
+            return -1
+        return self.sparse_rows.pred[position]
+
+class SparseMatrixTable(PairTable):
+    """
+    'MatrixTable' over values aligned with the entries of some 'SparseRows' (the distances by default). The pairs that
+    are not stored return 'missing' (inf).
+    """
+
+    def __init__(self, sparse_rows, nodes, index, sources=None, values=None, missing=np.inf):
+        PairTable.__init__(self, nodes, index, sources)
+        self.sparse_rows = sparse_rows
+        self.values = sparse_rows.dist if values is None else values
+        self.missing = missing
+
+    def value(self, s, t):
+        position = self.sparse_rows.position(self.row(s), t)
+        if position < 0:
+            return float(self.missing)
+        return float(self.values[position])
+
+    def reverse_value(self, s, t):
+        return self.value(s, t)
+
+    def row_values(self, r, columns):
+        positions = self.sparse_rows.positions(r, columns)
+        return np.where(positions < 0, self.missing, self.values[positions])
+
+    def column_values(self, rows, t):
+        return np.array([self.row_values(r, np.array([t]))[0] for r in rows], dtype=np.float64)
+
+class SparseConsumptionTable(SparseMatrixTable):
+    # 'ConsumptionTable' over the path consumptions of some 'SparseRows' (see 'SparseRows.path_consumptions').
+
+    def __init__(self, sparse_rows, nodes, index, cons_array, sources=None, values=None):
+        if values is None:
+            values = sparse_rows.path_consumptions(cons_array)
+        SparseMatrixTable.__init__(self, sparse_rows, nodes, index, sources, values, missing=0.0)
+        self.cons_array = cons_array
+
+    def reverse_value(self, s, t):
+        return self.value(s, t) + float(self.cons_array[s] - self.cons_array[t])
+
+class SparsePathTable(PairTable):
+    # 'PathTable' over the predecessors of some 'SparseRows'. Paths to nodes that are not stored raise KeyError.
+
+    def __init__(self, sparse_rows, nodes, index, sources=None):
+        PairTable.__init__(self, nodes, index, sources)
+        self.sparse_rows = sparse_rows
+
+    def value(self, s, t):
+        return [self.nodes[i] for i in self.path_indices(s, t)]
+
+    def reverse_value(self, s, t):
+        return [self.nodes[i] for i in reversed(self.path_indices(s, t))]
+
+    def path_indices(self, s, t):
+        return _walk_predecessors(_SparsePredecessors(self.sparse_rows, self.row(s)), s, t, self.nodes)
+
+########################################################################################################
+################################### ATTACHMENT INDEX ###################################################
+########################################################################################################
+
+class AttachmentIndex:
+    """
+    Keeps, for each consumer, its nearest node of the growing network (the attachment node) and the length of the
+    shortest path to it. Each call to 'add_nodes' only compares the consumers against the new nodes, so the greedy
+    algorithms do not rescan every added node on every iteration. With a 'MatrixTable' (or a 'SparseMatrixTable') the
+    comparison is a vectorised min-reduction over the rows; with other tables the values are looked up one by one.
+    On ties the node added first is kept.
+
+    Args:
+        lengths (dict or PairTable): shortest path lengths indexed as [u][v] (precomputed "shortest_paths_length").
+        consumers (iterable): nodes whose attachment is tracked.
+    """
+
+    def __init__(self, lengths, consumers):
+        self.lengths = lengths
+        self.consumers = list(consumers)
+        self.position = {consumer: i for i, consumer in enumerate(self.consumers)}
+        self.best_length = np.full(len(self.consumers), np.inf)
+        self.best_node = [None]*len(self.consumers)
+        self.attached = set()
+        if isinstance(lengths, (MatrixTable, SparseMatrixTable)):
+            self.consumer_indices = np.array([lengths.index[consumer] for consumer in self.consumers], dtype=np.int64)
+            # Rows of the consumers, used for the added nodes without a row of their own.
+            self.consumer_rows = None
+            if lengths.rows is not None and all(s in lengths.rows for s in self.consumer_indices):
+                self.consumer_rows = np.array([lengths.rows[s] for s in self.consumer_indices], dtype=np.int64)
+
+    def add_nodes(self, nodes):
+        """
+        Adds nodes to the network, updating the attachment of every consumer. Nodes already added are skipped.
+
+        Args:
+            nodes (iterable): new nodes of the network.
+        Returns:
+            changed (list): consumers whose attachment changed.
+        """
+        new_nodes = []
+        for node in nodes:
+            if node not in self.attached:
+                self.attached.add(node)
+                new_nodes.append(node)
+        if len(new_nodes) == 0 or len(self.consumers) == 0:
+            return []
+        if isinstance(self.lengths, (MatrixTable, SparseMatrixTable)):
+            lengths = self._matrix_lengths(new_nodes)
+        else:
+            lengths = np.array([[self.lengths[node][consumer] for consumer in self.consumers] for node in new_nodes], dtype=np.float64)
+        nearest = np.argmin(lengths, axis=0)
+        nearest_length = lengths[nearest, np.arange(len(self.consumers))]
+        better = nearest_length < self.best_length
+        self.best_length[better] = nearest_length[better]
+        changed = []
+        for i in np.nonzero(better)[0]:
+            self.best_node[i] = new_nodes[nearest[i]]
+            changed.append(self.consumers[i])
+        return changed
+
+    def _matrix_lengths(self, new_nodes):
+        # Len(new_nodes) x C lengths, read from the same row as '[node][consumer]' would.
+        table = self.lengths
+        lengths = np.empty((len(new_nodes), len(self.consumers)), dtype=np.float64)
+        for k, node in enumerate(new_nodes):
+            s = table.index[node]
+            r = table.row(s)
+            if r is not None:
+                lengths[k] = table.row_values(r, self.consumer_indices)
+            elif self.consumer_rows is not None:
+                lengths[k] = table.column_values(self.consumer_rows, s)
+            else:
+                lengths[k] = [table[node][consumer] for consumer in self.consumers]
+        return lengths
+
+    def nearest(self, consumer):
+        """
+        Returns the attachment of a consumer.
+
+        Args:
+            consumer (int): tracked consumer node.
+        Returns:
+            node (int): nearest added node (None if no added node reaches it).
+            length (double): length of the shortest path from that node (inf if none).
+        """
+        i = self.position[consumer]
+        return self.best_node[i], float(self.best_length[i])
+
+########################################################################################################
+################################### EDGE-DISJOINT PATHS ################################################
+########################################################################################################
+
+def csr_entry(csr, u, v):
+    """
+    Returns the position in csr.data (and csr.indices) of the entry u -> v of a CSR graph.
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix.
+        u (int): row node index.
+        v (int): column node index.
+    Returns:
+        position (int): position of the entry.
+    """
+    start, stop = csr.indptr[u], csr.indptr[u+1]
+    found = np.flatnonzero(csr.indices[start:stop] == v)
+    if len(found) == 0:
+        raise KeyError((u, v))
+    return start + found[0]
+
+def _masked_dijkstra(csr, weights, s):
+    # Distances and predecessors from s with the given weights for the entries of 'csr' (inf for unusable ones).
+    graph = sp.csr_matrix((weights, csr.indices, csr.indptr), shape=csr.shape, copy=False)
+    return dijkstra(graph, directed=True, indices=s, return_predecessors=True)
+
+def masked_shortest_path(csr, s, t, exclude=None):
+    """
+    Shortest path from s to t on a read only CSR graph without some of its entries. The graph is not modified, so
+    several searches can share it (and run concurrently).
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix (see 'build_csr_graph').
+        s (int): source node index.
+        t (int): target node index.
+        exclude (numpy array): entries that can not be used, as positions in csr.data or as a boolean mask of them.
+            Exclude both directions (u -> v and v -> u) to remove an undirected edge.
+    Returns:
+        path (list): node indices from s to t, [] if there is no path.
+    """
+    weights = csr.data.copy()
+    if exclude is not None:
+        weights[exclude] = np.inf
+    dist, pred = _masked_dijkstra(csr, weights, s)
+    if not np.isfinite(dist[t]):
+        return []
+    return _walk_predecessors(pred, s, t, None)
+
+def edge_disjoint_pair(csr, s, t, exclude=None, shared=None):
+    """
+    Pair of edge-disjoint paths from s to t with the minimum total length (Suurballe's algorithm): a shortest path P1,
+    then a shortest path P2 in the residual graph, where the edges of P1 can only be used backwards, with the edge
+    weights reduced by the distances from s so that they are all non negative. The edges of P1 that P2 uses backwards
+    cancel out, and the rest are split into the two paths. Two Dijkstra runs on the read only CSR graph, which is not
+    modified.
+
+    Args:
+        csr (scipy csr_matrix): V x V weighted adjacency matrix (see 'build_csr_graph').
+        s (int): source node index.
+        t (int): target node index.
+        exclude (numpy array): entries that can not be used, as positions in csr.data or as a boolean mask of them.
+        shared (numpy array): entries that both paths can use, as a boolean mask of csr.data (e.g. the bridges, that
+            every path from s to t may have to cross).
+    Returns:
+        paths (tuple): the two paths (lists of node indices from s to t), the shorter one first. None if there is no
+            pair of paths.
+    """
+    weights = csr.data.copy()
+    if exclude is not None:
+        weights[exclude] = np.inf
+    dist, pred = _masked_dijkstra(csr, weights, s)
+    if not np.isfinite(dist[t]):
+        return None
+    first = _walk_predecessors(pred, s, t, None)
+
+    # Reduced weights: non negative, zero along the shortest paths from s. Entries out of reach of s are not used.
+    rows = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+    reachable = np.isfinite(dist[rows]) & np.isfinite(dist[csr.indices])
+    reduced = np.full(len(weights), np.inf)
+    reduced[reachable] = np.maximum(weights[reachable] + dist[rows[reachable]] - dist[csr.indices[reachable]], 0)
+    for u, v in zip(first, first[1:]):
+        forward, backward = csr_entry(csr, u, v), csr_entry(csr, v, u)
+        if shared is None or not shared[forward]:
+            reduced[forward] = np.inf
+        reduced[backward] = 0
+    dist, pred = _masked_dijkstra(csr, reduced, s)
+    if not np.isfinite(dist[t]):
+        return None
+    second = _walk_predecessors(pred, s, t, None)
+
+    # Directed edges used by the pair: the ones of the second path going back along the first one cancel out.
+    used = {}
+    for u, v in zip(first, first[1:]):
+        used[(u,v)] = used.get((u,v), 0) + 1
+    for u, v in zip(second, second[1:]):
+        if used.get((v,u), 0) > 0:
+            used[(v,u)] -= 1
+        else:
+            used[(u,v)] = used.get((u,v), 0) + 1
+    successors = {}
+    for (u, v), multiplicity in used.items():
+        successors.setdefault(u, []).extend([v]*multiplicity)
+    paths = []
+    for _ in range(2):
+        path = [s]
+        while path[-1] != t:
+            path.append(successors[path[-1]].pop())
+        paths.append(path)
+    lengths = [sum(csr.data[csr_entry(csr, u, v)] for u, v in zip(path, path[1:])) for path in paths]
+    if lengths[1] < lengths[0]:
+        paths.reverse()
+    return tuple(paths)
+
+def bidirectional_path(indptr, indices, weights, available, s, t):
+    """
+    Shortest path from s to t on CSR adjacency lists without the unavailable entries, by bidirectional Dijkstra.
+    It expands the nodes and breaks the ties as nx.bidirectional_dijkstra (the one nx.shortest_path uses with a weight),
+    so on lists built in the neighbor order of a graph it returns the same path as a copy of the graph without the
+    unavailable edges, without making the copy.
+
+    Args:
+        indptr (list), indices (list), weights (list): CSR adjacency of an undirected graph (both directions of each
+            edge), node indices and edge weights.
+        available (bytearray): 1 for the entries that can be used. Clear both directions to remove an edge.
+        s (int): source node index.
+        t (int): target node index.
+    Returns:
+        path (list): node indices from s to t, [] if there is no path.
+    """
+    if s == t:
+        return [s]
+    # Forward (from s) and backward (from t) searches.
+    dists = [{}, {}]
+    paths = [{s: [s]}, {t: [t]}]
+    fringe = [[], []]
+    seen = [{s: 0}, {t: 0}]
+    c = count()
+    heapq.heappush(fringe[0], (0, next(c), s))
+    heapq.heappush(fringe[1], (0, next(c), t))
+    final_dist = None
+    final_path = []
+    direction = 1
+    while len(fringe[0]) > 0 and len(fringe[1]) > 0:
+        direction = 1 - direction
+        dist, _, v = heapq.heappop(fringe[direction])
+        if v in dists[direction]:
+            continue
+        dists[direction][v] = dist
+        if v in dists[1-direction]:
+            # Scanned in both directions, the shortest path has been found.
+            return final_path
+        for e in range(indptr[v], indptr[v+1]):
+            if not available[e]:
+                continue
+            w = indices[e]
+            length = dist + weights[e]
+            if w in dists[direction]:
+                continue
+            if w not in seen[direction] or length < seen[direction][w]:
+                seen[direction][w] = length
+                heapq.heappush(fringe[direction], (length, next(c), w))
+                paths[direction][w] = paths[direction][v] + [w]
+                if w in seen[0] and w in seen[1]:
+                    total = seen[0][w] + seen[1][w]
+                    if len(final_path) == 0 or final_dist > total:
+                        final_dist = total
+                        final_path = paths[0][w] + paths[1][w][-2::-1]
+    return []